@@ -1,6 +1,6 @@
 import sys
+import threading
 import mido
-from muses_echoes.muses import MuseEchoes
 
 """
 Change these variables to easily modify the
@@ -18,15 +18,69 @@ _chord_octave_range = (3, 4)
 _rhythm_midi_note = 36  # C2
 _markov_chains_order = 3
 _markov_chains_inertia = 0.78
+_lookahead_measures = 1
+_metrics_port = None  # localhost port of the metrics endpoint (e.g. 9137), None disables it
+_generation_processes = 0  # worker processes of the generation, 0 generates in the main process
+_melody_candidates = 1  # melodies sampled for each measure, the best one is played (e.g. 128), 1 plays the first sampled melody
+_record_path = None  # path of the session log for the replay (e.g. 'session.log'), None disables recording
+_chord_constraints = None  # constraints of the chord progressions (e.g. {'last': ['I', 'V'], 'no_repeats': True}), None disables them
+_midi_clock = False  # True follows the midi clock and the start/stop of the input port (e.g. sent by the DAW)
+_latency_config = None  # path of the latency offsets of the ports (e.g. 'latency.json', see python -m muses_echoes.latency), None disables them
+_snapshot_path = None  # path of the snapshot of the learned state (e.g. 'session.snapshot'), restored at startup, None disables the snapshots
+
+
+def _parse_indices(arguments, input_count, output_count):
+    """
+    Utility function that validates the port indices of the command line.
+
+    :param arguments: command line arguments, without the program name
+    :param input_count: number of midi input ports
+    :param output_count: number of midi output ports
+    :return: list of the four port indices, or None if the arguments are not valid
+    """
+    if len(arguments) < 4:
+        return None
+    try:
+        indices = [int(argument) for argument in arguments[:4]]
+    except ValueError:
+        return None
+    if not 0 <= indices[0] < input_count or not all(0 <= i < output_count for i in indices[1:]):
+        return None
+    return indices
+
+
+def _warm_up(modules):
+    """
+    Imports the generation modules and loads the chord model, run in
+    a background thread while the midi ports are opened.
+
+    :param modules: dictionary receiving the imported classes, or the exception of the warm-up under 'error'
+    """
+    try:
+        from muses_echoes.muses import MuseEchoes
+        from muses_echoes.chords import get_chord_markov_chain
+        modules['MuseEchoes'] = MuseEchoes
+        if _generation_processes > 0:
+            from muses_echoes.generation_pool import GenerationPool
+            modules['GenerationPool'] = GenerationPool
+        if _record_path is not None:
+            from muses_echoes.replay import SessionRecorder
+            modules['SessionRecorder'] = SessionRecorder
+        get_chord_markov_chain()
+    except BaseException as e:  # raised again by the main thread, after the join
+        modules['error'] = e
+
 
 if __name__ == '__main__':
     # =========================================
     # command line feedback for the users
+    # (only mido is imported until the arguments are valid)
     # =========================================
     midi_input_names = mido.get_input_names()
     midi_output_names = mido.get_output_names()
 
-    if len(sys.argv) <= 3:
+    port_indices = _parse_indices(sys.argv[1:], len(midi_input_names), len(midi_output_names))
+    if port_indices is None:
         print('usage: python -m muses_echoes [in] [melodies] [chords] [rhythm]',
               '__________\n',
               'midi in ports: {}'.format(midi_input_names),
@@ -40,10 +94,7 @@ if __name__ == '__main__':
               sep='\n')
         exit(-1)
 
-    midi_in_index = int(sys.argv[1])
-    midi_sequence_out_index = int(sys.argv[2])
-    midi_chord_out_index = int(sys.argv[3])
-    midi_rhythm_out_index = int(sys.argv[4])
+    midi_in_index, midi_sequence_out_index, midi_chord_out_index, midi_rhythm_out_index = port_indices
     print('selected midi input: {}'.format(midi_input_names[midi_in_index]),
           'selected midi sequence output: {}'.format(midi_output_names[midi_sequence_out_index]),
           'selected midi chord output: {}'.format(midi_output_names[midi_chord_out_index]),
@@ -53,12 +104,23 @@ if __name__ == '__main__':
     # =========================================
     # =========================================
 
+    # the generation modules are loaded in the background while the output ports are opened
+    generation_modules = {}
+    warm_up_thread = threading.Thread(target=_warm_up, args=(generation_modules,), daemon=True)
+    warm_up_thread.start()
+    midi_sequence_out_port = mido.open_output(midi_output_names[midi_sequence_out_index])
+    midi_chord_out_port = mido.open_output(midi_output_names[midi_chord_out_index])
+    midi_rhythm_out_port = mido.open_output(midi_output_names[midi_rhythm_out_index])
+    warm_up_thread.join()
+    if 'error' in generation_modules:
+        raise generation_modules['error']
+
     # creating and starting the multi-threaded application
-    midiServer = MuseEchoes(
+    midiServer = generation_modules['MuseEchoes'](
         midi_in_port=midi_input_names[midi_in_index],
-        midi_sequence_out_port=midi_output_names[midi_sequence_out_index],
-        midi_chord_out_port=midi_output_names[midi_chord_out_index],
-        midi_rhythm_out_port=midi_output_names[midi_rhythm_out_index],
+        midi_sequence_out_port=midi_sequence_out_port,
+        midi_chord_out_port=midi_chord_out_port,
+        midi_rhythm_out_port=midi_rhythm_out_port,
         midi_mapping=_midi_mapping,
         osc_ip=_osc_ip,
         osc_port=_osc_port,
@@ -69,6 +131,15 @@ if __name__ == '__main__':
         chord_octave_range=_chord_octave_range,
         rhythm_midi_note=_rhythm_midi_note,
         markov_chains_order=_markov_chains_order,
-        markov_chains_inertia=_markov_chains_inertia
+        markov_chains_inertia=_markov_chains_inertia,
+        lookahead_measures=_lookahead_measures,
+        metrics_port=_metrics_port,
+        generation_pool=generation_modules['GenerationPool'](_generation_processes) if _generation_processes > 0 else None,
+        melody_candidates=_melody_candidates,
+        recorder=generation_modules['SessionRecorder'](_record_path) if _record_path is not None else None,
+        chord_constraints=_chord_constraints,
+        midi_clock=_midi_clock,
+        latency_config=_latency_config,
+        snapshot_path=_snapshot_path
     )
     midiServer.start()
@@ -0,0 +1,363 @@
+import os
+import sys
+import bisect
+import pickle
+import random
+import threading
+import numpy as np
+
+"""
+Chord model trained on The Beatles chord database.
+
+The model is stored in a flat, versioned numpy array (chords_markov_chain.npy)
+that can be memory mapped, instead of the pickled pomegranate object
+(chords_markov_chain.bin) it was converted from.
+
+============================
+FORMAT (version 1)
+============================
+[0]: format version
+[1]: order k of the markov chain
+[2]: number n of symbols (the chord degrees, in the order of the degrees list)
+[3:]: the k + 1 probability tables, one after the other
+      table i (i < k) has n^(i+1) values: probability of the symbol i of a
+      sequence given the first i symbols
+      table k has n^(k+1) values: probability of a symbol given the previous k symbols
+      each table is flattened in row-major order, the last index being the next symbol
+============================
+"""
+
+# degree to number mapping
+degrees = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII']
+
+# version of the binary format of the chord model
+format_version = 1
+
+# default location of the chord model
+model_path = os.path.join(os.path.dirname(__file__), 'chords_markov_chain.npy')
+
+# location of the original pomegranate model
+pomegranate_model_path = os.path.join(os.path.dirname(__file__), 'chords_markov_chain.bin')
+
+# chord model loaded on first use
+_chordMarkovChain = None
+_chordMarkovChainLock = threading.Lock()
+
+
+class ChordMarkovChain:
+    """
+    Read-only k-order Markov Chain over the chord degrees,
+    sampling progressions from dense probability tables.
+    """
+
+    # max number of constraint sets whose sampling tables are cached
+    _maxConstraintSets = 64
+
+    def __init__(self, tables, symbols=degrees, rng=None):
+        """
+        Constructor.
+
+        :param tables: list of k + 1 numpy arrays, table i having i + 1 dimensions of size len(symbols)
+        :param symbols: list of symbols indexed by the tables
+        :param rng: random generator exposing a random() method, if None a new random.Random is used
+        """
+
+        # probability tables for each order
+        self.tables = tables
+
+        # order of the markov chain
+        self.order = len(tables) - 1
+
+        # symbols indexed by the tables
+        self.symbols = list(symbols)
+
+        # random generator used for the sampling
+        self.rng = rng if rng is not None else random.Random()
+
+        # cumulative rows used for the sampling: {context tuple of indices: cumulative list}
+        self._cumulative = {}
+
+        # dense transition tables, transitions[i] has i + 1 dimensions: probability of a symbol given i previous symbols
+        self.transitions = self._transition_tables()
+
+        # backward sampling tables of the constrained progressions: {constraint set: list of nested cumulative lists}
+        self._constrained = {}
+
+    def sample(self, length, rng=None):
+        """
+        Generate a chord progression of a certain length.
+
+        :param length: number of chords
+        :param rng: random generator exposing a random() method, if None the one of the chain is used
+        :return: list of chord degrees in roman notation
+        """
+        if rng is None:
+            rng = self.rng
+        indices = []
+        for _ in range(length):
+            indices.append(self._sample_next(indices, rng))
+        return [self.symbols[i] for i in indices]
+
+    def sample_constrained(self, length, previous=None, first=None, last=None, no_repeats=False, rng=None):
+        """
+        Generate a chord progression of a certain length satisfying some constraints.
+        The progressions are drawn exactly from the distribution of the chain conditioned
+        on the constraints, without rejections: the probability that the rest of the
+        progression can satisfy the constraints is computed backwards once for each
+        constraint set, and cached.
+
+        :param length: number of chords
+        :param previous: list of chord degrees preceding the progression (e.g. the previous one), its last chords are the context of the first chord
+        :param first: list of chord degrees allowed as first chord, if None any chord is allowed
+        :param last: list of chord degrees allowed as last chord, if None any chord is allowed
+        :param no_repeats: if True, a chord is never followed by the same chord (including the last previous chord)
+        :param rng: random generator exposing a random() method, if None the one of the chain is used
+        :return: list of chord degrees in roman notation
+        """
+        if length <= 0:
+            return []
+        if rng is None:
+            rng = self.rng
+        context = [self.symbols.index(degree) for degree in previous[max(0, len(previous) - self.order):]] if previous else []
+
+        key = (length, len(context), self._mask(first), self._mask(last), no_repeats)
+        tables = self._constrained.get(key)
+        if tables is None:
+            tables = self._constrained_tables(*key)
+
+        indices = list(context)
+        for step in range(length):
+            row = tables[step]
+            for index in indices[len(indices) - self.order:] if len(indices) >= self.order else indices:
+                row = row[index]
+            if row[-1] <= 0:
+                raise ValueError('no progression of {} chords satisfies the constraints'.format(length))
+            r = rng.random() * row[-1]
+            indices.append(min(bisect.bisect_right(row, r), len(row) - 1))
+        return [self.symbols[i] for i in indices[len(context):]]
+
+    def _mask(self, allowed):
+        """
+        Utility method that converts a list of allowed symbols to a hashable mask.
+
+        :param allowed: list of symbols, or None for all the symbols
+        :return: tuple of 0/1 values for each symbol
+        """
+        if allowed is None:
+            return (1,) * len(self.symbols)
+        return tuple(int(symbol in allowed) for symbol in self.symbols)
+
+    def _transition_tables(self):
+        """
+        Utility method that computes the dense, normalized transition tables of the chain.
+        Contexts never observed in the training fall back to the distribution of the first chord.
+
+        :return: list of numpy arrays, as the tables attribute
+        """
+        first = np.asarray(self.tables[0], dtype=np.float64)
+        first = first / first.sum()
+        transitions = []
+        for table in self.tables:
+            table = np.array(table, dtype=np.float64)
+            totals = table.sum(axis=-1, keepdims=True)
+            transitions.append(np.where(totals > 0, table / np.where(totals > 0, totals, 1), first))
+        return transitions
+
+    def _constrained_tables(self, length, context_length, first, last, no_repeats):
+        """
+        Utility method that computes and caches the sampling tables of a constraint set.
+
+        beta[t] is the probability that the steps from t on satisfy the constraints,
+        given the context of step t (its last min(t + context_length, order) symbols).
+        The row of step t is the cumulative distribution of the next symbol, weighted by
+        beta[t + 1] of the context it leads to.
+
+        :param length: number of chords
+        :param context_length: number of symbols preceding the progression (at most the order)
+        :param first: mask of the first symbol
+        :param last: mask of the last symbol
+        :param no_repeats: if True, a symbol is never followed by itself
+        :return: list of nested cumulative lists, one for each step, indexed by the context
+        """
+        n = len(self.symbols)
+        different = 1 - np.eye(n)
+        weights = []
+        for step in range(length):
+            size = min(step + context_length, self.order)
+            weight = self.transitions[size].copy()
+            if step == 0:
+                weight = weight * np.array(first, dtype=np.float64)
+            if step == length - 1:
+                weight = weight * np.array(last, dtype=np.float64)
+            if no_repeats and size > 0:
+                # the previous symbol is the last index of the context
+                weight = weight * different.reshape((1,) * (size - 1) + (n, n))
+            weights.append(weight)
+
+        # backward pass: beta of the steps from the last one to the first one
+        beta = np.ones((n,) * min(length + context_length, self.order))
+        rows = [None] * length
+        for step in reversed(range(length)):
+            weight = weights[step]
+            if weight.ndim - 1 < self.order:
+                # the context grows by one symbol
+                transition = weight * beta
+                beta = np.einsum('...s->...', transition)
+            else:
+                # the first symbol of the context is dropped
+                transition = weight * beta[np.newaxis]
+                beta = np.einsum('a...s->a...', transition)
+            rows[step] = np.cumsum(transition, axis=-1).tolist()
+
+        if len(self._constrained) >= self._maxConstraintSets:
+            self._constrained.clear()
+        self._constrained[(length, context_length, first, last, no_repeats)] = rows
+        return rows
+
+    def _sample_next(self, indices, rng):
+        """
+        Utility method used to sample the index of the symbol following a sequence.
+
+        :param indices: list of the indices of the previous symbols
+        :param rng: random generator exposing a random() method
+        :return: index of the next symbol
+        """
+        if len(indices) < self.order:
+            context = tuple(indices)
+        else:
+            context = tuple(indices[len(indices) - self.order:])
+
+        cumulative = self._cumulative.get(context)
+        if cumulative is None:
+            cumulative = self._cumulative_row(context)
+        r = rng.random() * cumulative[-1]
+        return min(bisect.bisect_right(cumulative, r), len(cumulative) - 1)
+
+    def _cumulative_row(self, context):
+        """
+        Utility method that computes and caches the cumulative distribution following a context.
+        Contexts never observed in the training fall back to the distribution of the first chord.
+
+        :param context: tuple of symbol indices
+        :return: list of cumulative probabilities
+        """
+        row = self.tables[len(context)][context]
+        if row.sum() <= 0:
+            row = self.tables[0]
+        cumulative = np.cumsum(row).tolist()
+        self._cumulative[context] = cumulative
+        return cumulative
+
+
+def load_chord_markov_chain(path=None):
+    """
+    Loads the chord model from its binary file, memory mapping it.
+
+    :param path: path of the model file, if None the default model is used
+    :return: ChordMarkovChain object
+    """
+    if path is None:
+        path = model_path
+    data = np.load(path, mmap_mode='r')
+    if int(data[0]) != format_version:
+        raise ValueError('unsupported chord model version {} in {}'.format(int(data[0]), path))
+    order = int(data[1])
+    n = int(data[2])
+
+    tables = []
+    offset = 3
+    for i in range(order + 1):
+        size = n ** (i + 1)
+        tables.append(data[offset:offset + size].reshape((n,) * (i + 1)))
+        offset = offset + size
+
+    return ChordMarkovChain(tables, degrees[:n])
+
+
+def get_chord_markov_chain():
+    """
+    Gets the default chord model, loading it on the first call.
+
+    :return: ChordMarkovChain object shared by all the callers
+    """
+    global _chordMarkovChain
+    with _chordMarkovChainLock:  # critical section
+        if _chordMarkovChain is None:
+            _chordMarkovChain = load_chord_markov_chain()
+        return _chordMarkovChain
+    # end of critical section
+
+
+class _PomegranateObject:
+    """
+    Stand-in for the pomegranate classes, keeping only their constructor arguments.
+    """
+
+    def __init__(self, *args):
+        self.args = args
+
+
+class _PomegranateUnpickler(pickle.Unpickler):
+    """
+    Unpickler of the pomegranate chord model that doesn't need (nor import) pomegranate.
+    Only the classes composing a pomegranate MarkovChain are allowed.
+    """
+
+    _allowed = {
+        ('pomegranate', 'MarkovChain'),
+        ('pomegranate.MarkovChain', 'MarkovChain'),
+        ('pomegranate.distributions', 'DiscreteDistribution'),
+        ('pomegranate.distributions.DiscreteDistribution', 'DiscreteDistribution'),
+        ('pomegranate.distributions', 'ConditionalProbabilityTable'),
+        ('pomegranate.distributions.ConditionalProbabilityTable', 'ConditionalProbabilityTable'),
+    }
+
+    def find_class(self, module, name):
+        if (module, name) in self._allowed:
+            return _PomegranateObject
+        if (module, name) in {('numpy.core.multiarray', 'scalar'), ('numpy._core.multiarray', 'scalar'),
+                              ('numpy', 'dtype')}:
+            return super().find_class(module, name)
+        raise pickle.UnpicklingError('forbidden global {}.{}'.format(module, name))
+
+
+def convert_pomegranate_model(source_path=None, destination_path=None):
+    """
+    One-time converter from the pickled pomegranate MarkovChain
+    to the binary format of the chord model.
+
+    :param source_path: path of the pickled model, if None the original model is used
+    :param destination_path: path of the converted model, if None the default model path is used
+    :return: flat numpy array written in the destination file
+    """
+    if source_path is None:
+        source_path = pomegranate_model_path
+    if destination_path is None:
+        destination_path = model_path
+
+    with open(source_path, 'rb') as f:
+        markov_chain = _PomegranateUnpickler(f).load()
+
+    # the first distribution is a DiscreteDistribution, the others are ConditionalProbabilityTables
+    distributions = markov_chain.args[0]
+    order = len(distributions) - 1
+    n = len(degrees)
+
+    tables = [np.zeros(n)]
+    for symbol, probability in distributions[0].args[0].items():
+        tables[0][degrees.index(symbol)] = float(probability)
+    for i in range(1, order + 1):
+        table = np.zeros((n,) * (i + 1))
+        for row in distributions[i].args[0]:
+            table[tuple(degrees.index(symbol) for symbol in row[:-1])] = float(row[-1])
+        tables.append(table)
+
+    data = np.concatenate([np.array([format_version, order, n], dtype=np.float64)] +
+                          [table.ravel() for table in tables])
+    np.save(destination_path, data)
+    return data
+
+
+if __name__ == '__main__':
+    # usage: python -m muses_echoes.chords [pomegranate model] [converted model]
+    convert_pomegranate_model(*sys.argv[1:3])
@@ -0,0 +1,137 @@
+import threading
+import time
+
+
+class Clock:
+    """
+    Shared clock used to schedule the events of the application
+    against absolute time.perf_counter() deadlines.
+
+    Instead of advancing the time with relative sleeps, each timing
+    thread computes the absolute deadline of its next event and waits
+    for it through the wait_until method. The latency introduced by the
+    midi sends, the locks and the prints is thus absorbed by the next wait,
+    and never accumulates as drift between the melody, chord, rhythm and
+    measure threads.
+
+    The wait is hybrid: the thread sleeps until spinThreshold seconds before
+    the deadline, and then spins on the perf_counter to wake up on time.
+    For each named stream of events the clock keeps the statistics of the
+    jitter (actual wake up time minus deadline) and of the cumulative drift
+    (how much the stream slid against its own schedule since its first event).
+    """
+
+    def __init__(self, spin_threshold=0.002):
+        """
+        Constructor.
+
+        :param spin_threshold: seconds before a deadline in which the clock stops sleeping and starts spinning
+        """
+
+        # seconds of busy waiting before each deadline
+        self.spinThreshold = spin_threshold
+
+        # lock used to protect the statistics
+        self.lock = threading.Lock()
+
+        # statistics for each named stream of events
+        self._stats = {}
+
+    @staticmethod
+    def now():
+        """
+        Current time of the clock.
+
+        :return: time.perf_counter() value in seconds
+        """
+        return time.perf_counter()
+
+    def wait_until(self, deadline, stream=None):
+        """
+        Blocks the calling thread until an absolute deadline.
+        If the deadline is already passed, the method returns immediately.
+
+        :param deadline: absolute time.perf_counter() value in seconds
+        :param stream: optional name of the event stream used for the statistics
+        :return: jitter in seconds between the deadline and the actual wake up time
+        """
+        remaining = deadline - time.perf_counter()
+
+        # coarse sleep
+        if remaining > self.spinThreshold:
+            time.sleep(remaining - self.spinThreshold)
+
+        # fine spinning, yielding the GIL to the other threads
+        while time.perf_counter() < deadline:
+            time.sleep(0)
+
+        wake_up = time.perf_counter()
+        jitter = wake_up - deadline
+        if stream is not None:
+            self._update_stats(stream, deadline, wake_up)
+        return jitter
+
+    def get_stats(self):
+        """
+        Gets the timing statistics for each stream of events.
+
+        events: number of events waited
+        jitter_mean: mean lateness of the events in seconds
+        jitter_max: maximum lateness of the events in seconds
+        jitter_last: lateness of the last event in seconds
+        drift: slide of the stream against its own schedule since the first event, in seconds
+
+        :return: dictionary containing a dictionary of statistics for each stream name
+        """
+        result = {}
+        with self.lock:  # critical section
+            for stream, stats in self._stats.items():
+                result[stream] = {
+                    'events': stats['events'],
+                    'jitter_mean': stats['jitter_sum'] / stats['events'],
+                    'jitter_max': stats['jitter_max'],
+                    'jitter_last': stats['jitter_last'],
+                    'drift': (stats['last_wake_up'] - stats['first_wake_up']) -
+                             (stats['last_deadline'] - stats['first_deadline'])
+                }
+        # end of critical section
+        return result
+
+    def reset_stats(self):
+        """
+        Removes all the collected statistics.
+        """
+        with self.lock:  # critical section
+            self._stats = {}
+        # end of critical section
+
+    def _update_stats(self, stream, deadline, wake_up):
+        """
+        Utility method used to add an event to the statistics of a stream.
+
+        :param stream: name of the stream
+        :param deadline: deadline of the event
+        :param wake_up: actual wake up time of the event
+        """
+        jitter = wake_up - deadline
+        with self.lock:  # critical section
+            stats = self._stats.get(stream)
+            if stats is None:
+                stats = {
+                    'events': 0,
+                    'jitter_sum': 0.0,
+                    'jitter_max': 0.0,
+                    'jitter_last': 0.0,
+                    'first_deadline': deadline,
+                    'first_wake_up': wake_up,
+                    'last_deadline': deadline,
+                    'last_wake_up': wake_up
+                }
+                self._stats[stream] = stats
+            stats['events'] = stats['events'] + 1
+            stats['jitter_sum'] = stats['jitter_sum'] + jitter
+            stats['jitter_max'] = max(stats['jitter_max'], jitter)
+            stats['jitter_last'] = jitter
+            stats['last_deadline'] = deadline
+            stats['last_wake_up'] = wake_up
+        # end of critical section
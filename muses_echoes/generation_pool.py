@@ -0,0 +1,408 @@
+import threading
+import itertools
+import multiprocessing
+from multiprocessing import shared_memory
+import numpy as np
+from muses_echoes.markov_chain import MarkovChain
+from muses_echoes.chords import degrees, get_chord_markov_chain
+
+"""
+Process-pool backend of the generation.
+
+The Markov chains of the melodies and the chord sampling can be moved into
+worker processes, so that an expensive generation step never competes for
+the interpreter lock with the timing threads of the sequencer. Each chain
+lives in one worker, and is driven from the main process through a proxy
+with the same interface of the local MarkovChain. The symbols are encoded
+as integers: the sequences are written in a shared memory block of the
+proxy, and the pipe of the worker only carries the short requests and replies.
+"""
+
+
+class GenerationPool:
+    """
+    Pool of worker processes hosting the generation models.
+    Every model is assigned to a worker, in round-robin order, and
+    all its requests are served by that worker.
+    """
+
+    def __init__(self, processes=2, capacity=4096):
+        """
+        Constructor.
+
+        :param processes: number of worker processes
+        :param capacity: maximum length of the sequences exchanged with the workers
+        """
+        self.capacity = capacity
+
+        # the workers are spawned, the timing threads of the parent are not forked
+        context = multiprocessing.get_context('spawn')
+
+        # (process, connection, lock) tuples of the workers
+        self._workers = []
+        for _ in range(processes):
+            parent_connection, child_connection = context.Pipe()
+            process = context.Process(target=_worker_main, args=(child_connection,), daemon=True)
+            process.start()
+            child_connection.close()
+            self._workers.append((process, parent_connection, threading.Lock()))
+
+        # identifiers of the models
+        self._ids = itertools.count()
+
+        # models not closed yet, released when the pool is closed
+        self._models = {}
+
+    def markov_chain(self, order=3, inertia=0.7, seed=None):
+        """
+        Creates a Markov chain in a worker process.
+
+        :param order: order of the markov chain
+        :param inertia: value between 0 and 1 that indicates how old melodies still influence the probabilities
+        :param seed: seed of the random generator of the chain
+        :return: RemoteMarkovChain object
+        """
+        return RemoteMarkovChain(self, order, inertia, seed)
+
+    def chord_sampler(self):
+        """
+        Creates a sampler of the chord model in a worker process.
+
+        :return: RemoteChordSampler object
+        """
+        return RemoteChordSampler(self)
+
+    def close(self):
+        """
+        Releases all the models and stops the worker processes.
+        """
+        for model in list(self._models.values()):
+            model.close()
+        for process, connection, lock in self._workers:
+            with lock:  # critical section
+                connection.send(None)
+                connection.close()
+            # end of critical section
+            process.join()
+        self._workers = []
+
+    def _request(self, worker, message):
+        """
+        Utility method that sends a request to a worker and waits for its reply.
+
+        :param worker: index of the worker
+        :param message: request tuple
+        :return: reply of the worker
+        """
+        _, connection, lock = self._workers[worker]
+        with lock:  # critical section
+            connection.send(message)
+            reply = connection.recv()
+        # end of critical section
+        if isinstance(reply, Exception):
+            raise reply
+        return reply
+
+
+class _RemoteModel:
+    """
+    Base class of the proxies of the models hosted by a GenerationPool,
+    owning the shared memory block used to exchange the sequences.
+    """
+
+    def __init__(self, pool, model_type, *params):
+        self.pool = pool
+        self.modelId = next(pool._ids)
+        self.worker = self.modelId % len(pool._workers)
+
+        # integer symbols exchanged with the worker
+        self._memory = shared_memory.SharedMemory(create=True, size=pool.capacity * np.dtype(np.int32).itemsize)
+        self._buffer = np.ndarray((pool.capacity,), dtype=np.int32, buffer=self._memory.buf)
+
+        self.pool._request(self.worker, ('create', self.modelId, model_type, self._memory.name, pool.capacity) + params)
+        self.pool._models[self.modelId] = self
+
+    def close(self):
+        """
+        Deletes the model from its worker and releases the shared memory.
+        """
+        if self.pool._models.pop(self.modelId, None) is None:
+            return  # already closed
+        self.pool._request(self.worker, ('close', self.modelId))
+        self._buffer = None
+        self._memory.close()
+        self._memory.unlink()
+
+
+class RemoteMarkovChain(_RemoteModel):
+    """
+    Proxy of a MarkovChain hosted by a worker process, that can replace a local MarkovChain.
+    """
+
+    def __init__(self, pool, order=3, inertia=0.7, seed=None):
+        """
+        Constructor.
+
+        :param pool: GenerationPool hosting the chain
+        :param order: order of the markov chain
+        :param inertia: value between 0 and 1 that indicates how old melodies still influence the probabilities
+        :param seed: seed of the random generator of the chain
+        """
+        super().__init__(pool, 'markov_chain', order, inertia, seed)
+        self.order = order
+        self.keepOldMelodies = inertia
+
+        # integer codes of the symbols
+        self._codes = {}
+        self._symbols = []
+
+    def learn(self, sequence):
+        """
+        Learn from a new symbol input sequence.
+
+        :param sequence: list of symbols
+        """
+        if len(sequence) > self.pool.capacity:
+            raise ValueError('the sequence is longer than the capacity of the pool')
+        for i, symbol in enumerate(sequence):
+            code = self._codes.get(symbol)
+            if code is None:
+                code = len(self._symbols)
+                self._codes[symbol] = code
+                self._symbols.append(symbol)
+            self._buffer[i] = code
+        self.pool._request(self.worker, ('learn', self.modelId, len(sequence)))
+
+    def generate(self, length):
+        """
+        Generate a new sequence of symbols of a certain length.
+
+        :param length: length of the generated sequence
+        :return: list of symbols
+        """
+        length = self.pool._request(self.worker, ('generate', self.modelId, min(length, self.pool.capacity)))
+        return [self._symbols[code] for code in self._buffer[:length].tolist()]
+
+    def generate_batch(self, count, length):
+        """
+        Generate many sequences of symbols at once (see MarkovChain.generate_batch).
+        A batch larger than the capacity of the pool is generated in many requests,
+        each one filling the shared memory with as many sequences as it can hold.
+
+        :param count: number of sequences
+        :param length: length of each sequence, clipped to the capacity of the pool
+        :return: (list of symbols, [count, length] numpy array of symbol indices) tuple
+        """
+        length = min(length, self.pool.capacity)
+        chunk = self.pool.capacity // max(length, 1)
+        codes = []
+        parts = []
+        for start in range(0, count, chunk):
+            size = min(chunk, count - start)
+            codes, generated_length = self.pool._request(self.worker, ('generate_batch', self.modelId, size, length))
+            parts.append(self._buffer[:size * generated_length].astype(np.int64).reshape(size, generated_length))
+        if not parts:
+            return [], np.zeros((0, length), dtype=np.int64)
+        indices = parts[0] if len(parts) == 1 else np.concatenate(parts)
+        return [self._symbols[code] for code in codes], indices
+
+    def get_state(self):
+        """
+        Exports the learned transitions (see MarkovChain.get_state).
+
+        :return: dictionary of the state
+        """
+        state = self.pool._request(self.worker, ('get_state', self.modelId))
+        state['symbols'] = [self._symbols[code] for code in state['symbols']]
+        return state
+
+    def copy(self):
+        """
+        Gets a copy of the learned transitions, taken by the worker (see MarkovChain.copy).
+        The copy is exported later by its get_state method, that can be called by another thread.
+        The worker keeps only the last copy of the chain: a new copy replaces the previous one.
+
+        :return: RemoteMarkovChainCopy object
+        """
+        copy_id = next(self.pool._ids)
+        self.pool._request(self.worker, ('copy', self.modelId, copy_id))
+        return RemoteMarkovChainCopy(self.pool, self.worker, self.modelId, copy_id, list(self._symbols))
+
+    def set_state(self, state):
+        """
+        Replaces the learned transitions with a state exported by get_state.
+
+        :param state: dictionary of the state
+        """
+        # the symbols of the state become the integer codes of the chain
+        self._symbols = list(state['symbols'])
+        self._codes = {symbol: code for code, symbol in enumerate(self._symbols)}
+        state = dict(state, symbols=list(range(len(self._symbols))))
+        self.pool._request(self.worker, ('set_state', self.modelId, state))
+
+
+class RemoteMarkovChainCopy:
+    """
+    Copy of a RemoteMarkovChain kept by its worker process until it is exported.
+    """
+
+    def __init__(self, pool, worker, model_id, copy_id, symbols):
+        """
+        Constructor.
+
+        :param pool: GenerationPool hosting the copy
+        :param worker: index of the worker hosting the copy
+        :param model_id: identifier of the copied chain in the worker
+        :param copy_id: identifier of the copy
+        :param symbols: symbols of the integer codes of the chain when it was copied
+        """
+        self.pool = pool
+        self.worker = worker
+        self.modelId = model_id
+        self.copyId = copy_id
+        self._symbols = symbols
+
+    def get_state(self):
+        """
+        Exports the copied transitions (see MarkovChain.get_state), releasing the copy in the worker.
+
+        :return: dictionary of the state, None if the copy was replaced by a newer one
+        """
+        state = self.pool._request(self.worker, ('export_copy', self.modelId, self.copyId))
+        if state is None:
+            return None
+        state['symbols'] = [self._symbols[code] for code in state['symbols']]
+        return state
+
+
+class RemoteChordSampler(_RemoteModel):
+    """
+    Proxy of the chord model sampled by a worker process, that can replace the local ChordMarkovChain.
+    """
+
+    def __init__(self, pool):
+        """
+        Constructor.
+
+        :param pool: GenerationPool hosting the sampler
+        """
+        super().__init__(pool, 'chord_sampler')
+
+    def sample(self, length, rng=None):
+        """
+        Generate a chord progression of a certain length.
+
+        :param length: number of chords
+        :param rng: numpy random generator used to seed the sampling, if None the sampling is not reproducible
+        :return: list of chord degrees in roman notation
+        """
+        seed = int(rng.integers(2 ** 63)) if rng is not None else None
+        length = self.pool._request(self.worker, ('sample', self.modelId, min(length, self.pool.capacity), seed))
+        return [degrees[index] for index in self._buffer[:length].tolist()]
+
+    def sample_constrained(self, length, previous=None, first=None, last=None, no_repeats=False, rng=None):
+        """
+        Generate a chord progression of a certain length satisfying some constraints
+        (see ChordMarkovChain.sample_constrained).
+
+        :param length: number of chords
+        :param previous: list of chord degrees preceding the progression
+        :param first: list of chord degrees allowed as first chord, if None any chord is allowed
+        :param last: list of chord degrees allowed as last chord, if None any chord is allowed
+        :param no_repeats: if True, a chord is never followed by the same chord
+        :param rng: numpy random generator used to seed the sampling, if None the sampling is not reproducible
+        :return: list of chord degrees in roman notation
+        """
+        seed = int(rng.integers(2 ** 63)) if rng is not None else None
+        constraints = (list(previous) if previous else None, first, last, no_repeats)
+        length = self.pool._request(self.worker, ('sample_constrained', self.modelId,
+                                                  min(length, self.pool.capacity), seed, constraints))
+        return [degrees[index] for index in self._buffer[:length].tolist()]
+
+
+def _worker_main(connection):
+    """
+    Main loop of a worker process, serving the requests of the GenerationPool.
+
+    :param connection: pipe connection with the main process
+    """
+
+    # models hosted by the worker: {model id: (model, shared memory, buffer)}
+    models = {}
+
+    # last copy of each markov chain, waiting to be exported: {model id: (copy id, MarkovChain)}
+    copies = {}
+
+    while True:
+        try:
+            message = connection.recv()
+        except EOFError:
+            break
+        if message is None:
+            break
+
+        try:
+            op, model_id = message[0], message[1]
+            if op == 'create':
+                model_type, memory_name, capacity = message[2:5]
+                memory = shared_memory.SharedMemory(name=memory_name)
+                buffer = np.ndarray((capacity,), dtype=np.int32, buffer=memory.buf)
+                if model_type == 'markov_chain':
+                    order, inertia, seed = message[5:]
+                    model = MarkovChain(order=order, inertia=inertia, rng=np.random.default_rng(seed))
+                else:
+                    model = get_chord_markov_chain()
+                models[model_id] = (model, memory, buffer)
+                reply = model_id
+            elif op == 'learn':
+                model, _, buffer = models[model_id]
+                model.learn(buffer[:message[2]].tolist())
+                reply = message[2]
+            elif op == 'generate':
+                model, _, buffer = models[model_id]
+                sequence = model.generate(message[2])
+                buffer[:len(sequence)] = sequence
+                reply = len(sequence)
+            elif op == 'generate_batch':
+                model, _, buffer = models[model_id]
+                symbols, indices = model.generate_batch(message[2], message[3])
+                buffer[:indices.size] = indices.ravel()
+                reply = (symbols, indices.shape[1])
+            elif op == 'get_state':
+                reply = models[model_id][0].get_state()
+            elif op == 'copy':
+                copies[model_id] = (message[2], models[model_id][0].copy())
+                reply = message[2]
+            elif op == 'export_copy':
+                copy_id, chain = copies.get(model_id, (None, None))
+                reply = None
+                if copy_id == message[2]:
+                    del copies[model_id]
+                    reply = chain.get_state()
+            elif op == 'set_state':
+                models[model_id][0].set_state(message[2])
+                reply = model_id
+            elif op == 'sample':
+                model, _, buffer = models[model_id]
+                progression = model.sample(message[2], np.random.default_rng(message[3]))
+                buffer[:len(progression)] = [degrees.index(degree) for degree in progression]
+                reply = len(progression)
+            elif op == 'sample_constrained':
+                model, _, buffer = models[model_id]
+                progression = model.sample_constrained(message[2], *message[4], rng=np.random.default_rng(message[3]))
+                buffer[:len(progression)] = [degrees.index(degree) for degree in progression]
+                reply = len(progression)
+            elif op == 'close':
+                copies.pop(model_id, None)
+                memory = models.pop(model_id)[1]
+                memory.close()
+                reply = model_id
+            else:
+                raise ValueError('unknown request {}'.format(op))
+        except Exception as e:  # the error is raised in the main process
+            reply = e
+        connection.send(reply)
+
+    for model_id in list(models):
+        memory = models.pop(model_id)[1]
+        memory.close()
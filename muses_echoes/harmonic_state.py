@@ -0,0 +1,191 @@
+import threading
+from collections import deque
+import melodically
+import numpy as np
+
+"""
+Incremental mode detection.
+
+The input notes are accumulated in a histogram of their pitch classes as
+soon as they are received, and the modes are scored all at once by a
+product of the histogram with a template matrix, so the cost of a mode
+estimate doesn't depend on the number of notes played.
+"""
+
+# affinity points of each degree of a modal scale (as in melodically.harmonic_affinities)
+positive_weights = [1, 0.5, 3, 0.2, 0.4, 2, 0.1]
+
+# affinity points subtracted for each note out of the scale (as in melodically.harmonic_affinities)
+negative_weight = 2
+
+
+def _mode_templates():
+    """
+    Utility function that builds the template matrix of the modes.
+
+    :return: [12, 12 * 7] matrix, whose column root * 7 + mode contains the affinity points of each pitch class
+    """
+    templates = np.full((12, 12 * 7), -float(negative_weight))
+    for root_index, root in enumerate(melodically.musical_notes):
+        for mode_index, mode in enumerate(melodically.modes_dict[root][0]):
+            for degree, note in enumerate(mode):
+                templates[melodically.musical_notes.index(note), root_index * 7 + mode_index] = positive_weights[degree]
+    return templates
+
+
+# template matrix of the 84 modes (12 roots x 7 modes)
+mode_templates = _mode_templates()
+
+
+class PitchClassHarmonicState:
+    """
+    Drop-in replacement of melodically.HarmonicState, updated one note at a time.
+
+    The state is a histogram of the pitch classes of the last notes. By default it
+    covers a sliding window of buffer_size notes, as the buffer of HarmonicState;
+    with a decay the window is replaced by an exponential decay of the old notes.
+    As in HarmonicState, the root of the mode is the most frequent pitch class, and
+    the mode is the one of the root with the highest affinity with the histogram.
+    The decay is applied, as in the MarkovChain, by growing the weight of the new
+    notes, and rescaling the histogram only when this weight becomes too large.
+    """
+
+    # weight of a new note triggering a rescaling of the histogram
+    _maxScale = 1e12
+
+    def __init__(self, buffer_size=8, decay=None):
+        """
+        Constructor.
+
+        :param buffer_size: number of notes of the sliding window, used if decay is None
+        :param decay: value between 0 and 1 multiplying the weight of the old notes at each new note, None uses the window
+        """
+
+        # lock protecting the histogram, updated by the midi input thread
+        self.lock = threading.Lock()
+
+        # max number of notes of the sliding window
+        self.bufferSize = buffer_size
+
+        # exponential decay of the old notes
+        self.decay = decay
+
+        # weights of the pitch classes
+        self._histogram = np.zeros(12)
+
+        # pitch classes in the sliding window
+        self._window = deque()
+
+        # weight of a new note
+        self._scale = 1.0
+
+        # mode dictionary used to represent a modal scale (see melodically.HarmonicState)
+        self.currentMode = {'root': 'C', 'mode_signature_index': 0, 'mode_index': 0}
+
+    def push_pitch_class(self, pitch_class):
+        """
+        Adds a note to the histogram.
+
+        :param pitch_class: pitch class of the note (midi note % 12)
+        """
+        with self.lock:  # critical section
+            if self.decay is None:
+                self._histogram[pitch_class] += 1
+                self._window.append(pitch_class)
+                if len(self._window) > self.bufferSize:
+                    # removing the oldest note
+                    self._histogram[self._window.popleft()] -= 1
+            else:
+                self._histogram[pitch_class] += self._scale
+                self._scale = self._scale / self.decay
+                if self._scale > self._maxScale:
+                    self._histogram = self._histogram / self._scale
+                    self._scale = 1.0
+        # end of critical section
+
+    def push_notes(self, new_notes):
+        """
+        Adds some notes to the histogram.
+
+        :param new_notes: list of notes in std notation
+        """
+        for note in new_notes:
+            self.push_pitch_class(melodically.std_to_midi(note) % 12)
+
+    def get_state(self):
+        """
+        Exports the histogram, the sliding window and the current mode.
+
+        :return: dictionary of the state, with the histogram and the window as numpy arrays
+        """
+        with self.lock:  # critical section
+            return {
+                'histogram': self._histogram.copy(),
+                'window': np.array(self._window, dtype=np.int8),
+                'scale': self._scale,
+                'current_mode': dict(self.currentMode)
+            }
+        # end of critical section
+
+    def set_state(self, state):
+        """
+        Replaces the histogram, the sliding window and the current mode with a state exported by get_state.
+
+        :param state: dictionary of the state
+        """
+        with self.lock:  # critical section
+            self._histogram = np.array(state['histogram'], dtype=np.float64)
+            self._window = deque(state['window'].tolist())
+            self._scale = state['scale']
+            self.currentMode = dict(state['current_mode'])
+        # end of critical section
+
+    def get_histogram(self):
+        """
+        Gets the histogram of the pitch classes, normalized to a unit sum.
+
+        :return: numpy array of 12 weights, all zeros if no note was pushed
+        """
+        with self.lock:  # critical section
+            histogram = self._histogram.copy()
+        # end of critical section
+        total = histogram.sum()
+        return histogram / total if total > 0 else histogram
+
+    def estimate(self):
+        """
+        Estimates the current mode from the histogram, at any time.
+
+        :return: mode dictionary (see currentMode), or None if no note was pushed
+        """
+        histogram = self.get_histogram()
+        if not histogram.any():
+            return None
+        # affinities of all the modes, the mode is chosen among the ones of the root
+        # (rounded, so that equal affinities are resolved by the order of the modes)
+        scores = np.round(histogram @ mode_templates, 9)
+        root_index = int(np.argmax(histogram))
+        return {'root': melodically.musical_notes[root_index],
+                'mode_signature_index': 0,
+                'mode_index': int(np.argmax(scores[root_index * 7:root_index * 7 + 7]))}
+
+    def update_scale(self):
+        """
+        Updates the currentMode attribute with the current estimate.
+
+        :return: currentMode
+        """
+        mode = self.estimate()
+        if mode is not None:
+            self.currentMode = mode
+        return self.currentMode
+
+    def get_mode_notes(self):
+        """
+        Gets the current notes of the current modal scale.
+
+        :return: list of notes of the current modal scale
+        """
+        self.update_scale()
+        return melodically.modes_dict[self.currentMode['root']][self.currentMode['mode_signature_index']][
+            self.currentMode['mode_index']]
@@ -0,0 +1,128 @@
+import melodically
+import numpy as np
+from muses_echoes.chords import degrees
+
+# classes of the abstract melody symbols
+# c: chord tone, l: color tone, x: random tone
+note_classes = {'c': 0, 'l': 1, 'x': 2}
+
+
+class HarmonyTable:
+    """
+    Harmony lookup tables built once at startup.
+
+    For each root, mode index and degree the table stores the chord in
+    melodically notation. For each chord it stores its chord tones, color
+    tones and all the notes, already expanded to midi numbers across the
+    octaves of the melody, and the pitch classes of its voicing.
+    The generation of the notes is then reduced to vectorized index
+    sampling with a numpy random Generator.
+    """
+
+    def __init__(self, melody_octave_range=(4, 6), chord_octave_range=(2, 5)):
+        """
+        Constructor.
+
+        :param melody_octave_range: tuple containing the lowest and the highest octaves used for the melodies
+        :param chord_octave_range: tuple containing the lowest and the highest octaves used for the chords
+        """
+
+        # range of octaves for the melody and for the chords
+        self.melodyOctaveRange = melody_octave_range
+        self.chordOctaveRange = chord_octave_range
+
+        # chord names indexed by [root index, mode index, degree index]
+        self.chords = np.empty((len(melodically.musical_notes), 7, len(degrees)), dtype=object)
+        for i, root in enumerate(melodically.musical_notes):
+            for j in range(7):
+                for k in range(len(degrees)):
+                    self.chords[i, j, k] = melodically.modes_chords_dict[root][j][k]
+
+        # root note to root index mapping
+        self.rootIndices = {root: i for i, root in enumerate(melodically.musical_notes)}
+
+        # melody notes of each chord: {chord: (padded [3, max notes] midi array, [3] sizes array)}
+        # the rows are indexed by the note classes
+        self.melodyNotes = {}
+
+        # pitch classes of the chord tones of each chord, used for the voicings
+        self.chordPitchClasses = {}
+
+        # melodic symbol of each pitch class over each chord: {chord: list of 12 symbols}
+        self.pitchClassSymbols = {}
+
+        melody_octaves = np.arange(melody_octave_range[0], melody_octave_range[1] + 1)
+        for chord, tones in melodically.chord_tones.items():
+            pools = [self._expand(tones['c'], melody_octaves),
+                     self._expand(tones['l'], melody_octaves),
+                     self._expand(melodically.musical_notes, melody_octaves)]
+            sizes = np.array([len(pool) for pool in pools])
+            padded = np.zeros((len(pools), sizes.max()), dtype=np.int64)
+            for i, pool in enumerate(pools):
+                padded[i, :len(pool)] = pool
+            self.melodyNotes[chord] = (padded, sizes)
+            self.chordPitchClasses[chord] = np.array([melodically.std_to_midi(n) for n in tones['c']])
+            self.pitchClassSymbols[chord] = [melodically.parse_musical_note(melodically.midi_to_std(pc), chord)
+                                             for pc in range(12)]
+
+    def chord(self, root, mode_index, degree):
+        """
+        Gets the chord of a degree of a modal scale.
+
+        :param root: root note of the scale in std notation
+        :param mode_index: index of the mode
+        :param degree: chord degree in roman notation
+        :return: chord in melodically notation
+        """
+        return self.chords[self.rootIndices[root], mode_index, degrees.index(degree)]
+
+    def melody(self, note_sequence, chord, rng):
+        """
+        Generates the midi notes of an abstract melody over a chord.
+
+        :param note_sequence: abstract notes sequence
+        :param chord: chord in melodically notation
+        :param rng: numpy random Generator
+        :return: list of midi notes
+        """
+        padded, sizes = self.melodyNotes[chord]
+        classes = np.array([note_classes.get(note, 2) for note in note_sequence], dtype=np.int64)
+        indices = (rng.random(len(classes)) * sizes[classes]).astype(np.int64)
+        return padded[classes, indices].tolist()
+
+    def melody_batch(self, classes, chord, rng):
+        """
+        Generates the midi notes of many abstract melodies at once.
+
+        :param classes: numpy array of note classes (see note_classes), of any shape
+        :param chord: chord in melodically notation
+        :param rng: numpy random Generator
+        :return: numpy array of midi notes, with the shape of classes
+        """
+        padded, sizes = self.melodyNotes[chord]
+        indices = (rng.random(classes.shape) * sizes[classes]).astype(np.int64)
+        return padded[classes, indices]
+
+    def chord_voicing(self, chord, rng):
+        """
+        Generates the midi notes of a chord with a random octave for each note.
+
+        :param chord: chord in melodically notation
+        :param rng: numpy random Generator
+        :return: list of midi notes
+        """
+        pitch_classes = self.chordPitchClasses[chord]
+        octaves = rng.integers(self.chordOctaveRange[0], self.chordOctaveRange[1] + 1, size=len(pitch_classes))
+        return (pitch_classes + (octaves + 1) * 12).tolist()
+
+    @staticmethod
+    def _expand(notes, octaves):
+        """
+        Utility method that expands a list of notes across a range of octaves.
+
+        :param notes: list of notes in std notation
+        :param octaves: numpy array of octaves
+        :return: numpy array of midi notes
+        """
+        pitch_classes = np.array([melodically.std_to_midi(n) for n in notes])
+        return (pitch_classes[None, :] + (octaves[:, None] + 1) * 12).ravel()
@@ -0,0 +1,158 @@
+import threading
+from collections import deque
+
+"""
+Streaming parser of the input melodies.
+
+The note_on/note_off messages are turned into rhythmic symbols as soon as
+they are received, with the same rules of melodically.parse_rhythm, so that
+the sequences of a measure are ready when its downbeat comes.
+"""
+
+# codes of the midi message types of the input records
+NOTE_OFF = 0
+NOTE_ON = 1
+
+# minimum interval in seconds between two note_on messages (as in melodically.MidiNoteQueue)
+_MINIMUM_INTERVAL = 0.06
+
+# minimum interval in seconds between a note_off and the next note for a rest (as in melodically.parse_rhythm)
+_REST_THRESHOLD = 0.08
+
+
+class StreamingParser:
+    """
+    Incremental parser of the input notes into rhythmic symbols and pitch classes.
+
+    The push method is called by the midi input thread for each message:
+    a note_on opens a note, and its note_off appends the rhythmic symbol of
+    the note, followed by a rest if the note was played alone and the next
+    note starts later than a threshold. The pitch class of the note is
+    appended at the same time, so the notes of the two sequences stay in
+    step also when the notes overlap, and it is converted into a melodic
+    symbol once the chord of the measure is known.
+    At the downbeat the take method swaps the parsed sequences with empty
+    ones, so the lock of the parser is held only for a few assignments.
+    Notes still held at the downbeat are kept open, and are parsed in the
+    following measure. If the sequences are not taken for a long time
+    (e.g. before the generation starts) only the last max_length symbols
+    are kept.
+    """
+
+    def __init__(self, durations, max_length=256):
+        """
+        Constructor.
+
+        :param durations: dictionary containing the durations for each rhythmic figure
+        :param max_length: maximum number of symbols kept between two takes
+        """
+        self.maxLength = max_length
+
+        # lock protecting the parsed sequences, shared by the input thread and the downbeat
+        self.lock = threading.Lock()
+
+        # rhythmic figures and their durations, in the order of the dictionary
+        self._figures = list(durations.keys())
+        self._figureDurations = list(durations.values())
+
+        # rhythmic symbols and pitch classes parsed since the last take
+        self._rhythmSequence = deque(maxlen=max_length)
+        self._pitchClasses = deque(maxlen=max_length)
+
+        # open notes: {midi note: timestamp of the note_on}
+        self._openNotes = {}
+
+        # timestamp of the last accepted note_on
+        self._lastOnset = 0
+
+        # last accepted message as a (type, note) tuple
+        self._lastEvent = None
+
+        # (timestamp, figure) of the note_off that could be followed by a rest
+        self._pendingRest = None
+
+    def push(self, msg_type, note, timestamp):
+        """
+        Parses a new input message.
+
+        :param msg_type: NOTE_ON or NOTE_OFF
+        :param note: midi note value
+        :param timestamp: timestamp of the message in seconds
+        """
+        with self.lock:  # critical section
+            if msg_type == NOTE_ON:
+                # discarding the note_on messages too close to the last one
+                if timestamp - self._lastOnset <= _MINIMUM_INTERVAL:
+                    return
+                self._lastOnset = timestamp
+                self._check_rest(timestamp)
+                self._openNotes[note] = timestamp
+            else:
+                onset = self._openNotes.pop(note, None)
+                if onset is None:
+                    return  # the note_off doesn't close any note
+                self._check_rest(timestamp)
+                figure = self._nearest_figure(timestamp - onset)
+                self._rhythmSequence.append(figure)
+                self._pitchClasses.append(note % 12)
+                if self._lastEvent == (NOTE_ON, note):
+                    # no other messages during the note, a rest can follow
+                    self._pendingRest = (timestamp, figure)
+            self._lastEvent = (msg_type, note)
+        # end of critical section
+
+    def set_durations(self, durations):
+        """
+        Changes the durations of the rhythmic figures, after a tempo change.
+
+        :param durations: dictionary containing the durations for each rhythmic figure
+        """
+        with self.lock:  # critical section
+            self._figures = list(durations.keys())
+            self._figureDurations = list(durations.values())
+        # end of critical section
+
+    def take(self):
+        """
+        Takes the sequences parsed since the last call, leaving the open notes for the next measure.
+
+        :return: (list of rhythmic symbols, list of pitch classes of the notes) tuple
+        """
+        with self.lock:  # critical section
+            rhythm_sequence = self._rhythmSequence
+            pitch_classes = self._pitchClasses
+            self._rhythmSequence = deque(maxlen=self.maxLength)
+            self._pitchClasses = deque(maxlen=self.maxLength)
+            self._pendingRest = None
+            self._lastOnset = 0
+        # end of critical section
+        return list(rhythm_sequence), list(pitch_classes)
+
+    def _check_rest(self, timestamp):
+        """
+        Utility method that appends the rest preceding a new message, if any.
+        As in melodically.parse_rhythm, the rest takes the figure of the note preceding it.
+
+        :param timestamp: timestamp of the new message in seconds
+        """
+        if self._pendingRest is not None:
+            rest_start, figure = self._pendingRest
+            if timestamp - rest_start >= _REST_THRESHOLD:
+                self._rhythmSequence.append('r' + figure)
+            self._pendingRest = None
+
+    def _nearest_figure(self, interval):
+        """
+        Utility method that gets the rhythmic figure closest to an interval (see melodically.get_nearest_rhythm).
+
+        :param interval: duration in seconds
+        :return: rhythmic figure
+        """
+        best = 0
+        best_distance = abs(interval - self._figureDurations[0])
+        for i in range(1, len(self._figureDurations)):
+            distance = abs(interval - self._figureDurations[i])
+            if distance < best_distance:
+                best = i
+                best_distance = distance
+        return self._figures[best]
@@ -0,0 +1,180 @@
+import os
+import sys
+import json
+import time
+import statistics
+import mido
+from muses_echoes.clock import Clock
+
+"""
+Output latency compensation.
+
+Every output port and osc destination can have a latency offset: its
+messages are scheduled earlier by the offset, so that a soft synth with a
+large audio buffer or a slow visual sounds (or shows) on the beat together
+with the other parts. The offsets are stored in a json config file:
+
+{
+  "midi": {"<output port name>": seconds, ...},
+  "osc": {"<ip>:<port>": seconds, ...}
+}
+
+The offsets of the midi ports can be measured with a loopback: test
+pulses are sent on an output port and timed when they come back on an
+input port (a loopback cable, or the midi output of the instrument):
+
+usage: python -m muses_echoes.latency [config json file] [loopback in] [out] [out] ...
+
+The in and out arguments are port indices, as for the command line of
+the application. The osc offsets (e.g. measured with a camera filming
+the visuals and a click) are written in the config file by hand.
+"""
+
+# midi note and channel of the test pulses
+_PULSE_NOTE = 60
+_PULSE_CHANNEL = 15
+
+
+def load_latencies(path):
+    """
+    Reads the latency offsets from a config file.
+
+    :param path: path of the json config file
+    :return: (midi offsets by port name, osc offsets by (ip, port) tuple) tuple, in seconds
+    """
+    with open(path) as f:
+        config = json.load(f)
+    midi = {name: float(offset) for name, offset in config.get('midi', {}).items()}
+    osc = {}
+    for destination, offset in config.get('osc', {}).items():
+        ip, port = destination.rsplit(':', 1)
+        osc[(ip, int(port))] = float(offset)
+    return midi, osc
+
+
+def save_latencies(path, midi, osc):
+    """
+    Writes the latency offsets to a config file, replacing it atomically.
+
+    :param path: path of the json config file
+    :param midi: dictionary of the offsets in seconds by output port name
+    :param osc: dictionary of the offsets in seconds by (ip, port) tuple
+    """
+    config = {
+        'midi': dict(midi),
+        'osc': {'{}:{}'.format(*destination): offset for destination, offset in osc.items()}
+    }
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'w') as f:
+        json.dump(config, f, indent=2)
+    os.replace(temporary_path, path)
+
+
+def measure_round_trip(out_port, in_port, pulses=16, interval=0.1, timeout=0.5, clock=None):
+    """
+    Measures the round trip of test pulses from an output port back to a loopback input port.
+    The messages pending on the input port are discarded before each pulse.
+
+    round_trip: median round trip in seconds, None if no pulse came back
+    round_trip_min, round_trip_max: fastest and slowest pulses in seconds
+    jitter: standard deviation of the round trips in seconds
+    lost: number of pulses that didn't come back within the timeout
+
+    :param out_port: opened midi output port
+    :param in_port: opened midi input port, without callback
+    :param pulses: number of test pulses
+    :param interval: seconds between the pulses
+    :param timeout: seconds after which a pulse is considered lost
+    :param clock: Clock used to time the pulses, if None a new one is created
+    :return: dictionary of statistics
+    """
+    clock = clock if clock is not None else Clock()
+    note_on = mido.Message('note_on', note=_PULSE_NOTE, velocity=100, channel=_PULSE_CHANNEL)
+    note_off = mido.Message('note_off', note=_PULSE_NOTE, channel=_PULSE_CHANNEL)
+
+    round_trips = []
+    lost = 0
+    for pulse in range(pulses):
+        for _ in in_port.iter_pending():
+            pass
+        start_time = clock.now()
+        out_port.send(note_on)
+        arrival = None
+        while arrival is None and clock.now() - start_time < timeout:
+            msg = in_port.poll()
+            if msg is None:
+                time.sleep(0)
+            elif msg.type == 'note_on' and msg.note == _PULSE_NOTE and msg.velocity > 0:
+                arrival = clock.now()
+        out_port.send(note_off)
+        if arrival is None:
+            lost = lost + 1
+        else:
+            round_trips.append(arrival - start_time)
+        clock.wait_until(start_time + interval)
+
+    return {
+        'round_trip': statistics.median(round_trips) if round_trips else None,
+        'round_trip_min': min(round_trips) if round_trips else None,
+        'round_trip_max': max(round_trips) if round_trips else None,
+        'jitter': statistics.pstdev(round_trips) if round_trips else None,
+        'lost': lost
+    }
+
+
+def calibrate(config_path, in_port_name, out_port_names, pulses=16):
+    """
+    Measures the round trip of some output ports through a loopback input port,
+    and writes their offsets in a config file, keeping the osc offsets.
+    The offsets are relative to the fastest port: the latency of the input
+    path, shared by all the measures, doesn't delay the notes. The midi
+    offsets stored in the config file are replaced, since they are relative
+    to the fastest port of another run: all the output ports playing together
+    must be calibrated at once.
+
+    :param config_path: path of the json config file, created if it doesn't exist
+    :param in_port_name: name of the loopback midi input port
+    :param out_port_names: list of the names of the midi output ports
+    :param pulses: number of test pulses for each port
+    :return: dictionary of the round trip statistics by port name
+    """
+    osc = load_latencies(config_path)[1] if os.path.exists(config_path) else {}
+    results = {}
+    with mido.open_input(in_port_name) as in_port:
+        for name in out_port_names:
+            with mido.open_output(name) as out_port:
+                results[name] = measure_round_trip(out_port, in_port, pulses)
+
+    measured = {name: result['round_trip'] for name, result in results.items() if result['round_trip'] is not None}
+    if measured:
+        fastest = min(measured.values())
+        midi = {name: round_trip - fastest for name, round_trip in measured.items()}
+        save_latencies(config_path, midi, osc)
+    return results
+
+
+if __name__ == '__main__':
+    midi_input_names = mido.get_input_names()
+    midi_output_names = mido.get_output_names()
+    try:
+        indices = [int(argument) for argument in sys.argv[2:]]
+    except ValueError:
+        indices = []
+    if len(indices) < 2 or not 0 <= indices[0] < len(midi_input_names) or \
+            not all(0 <= i < len(midi_output_names) for i in indices[1:]):
+        print('usage: python -m muses_echoes.latency [config json file] [loopback in] [out] [out] ...',
+              '__________\n',
+              'midi in ports: {}'.format(midi_input_names),
+              'midi out ports: {}'.format(midi_output_names),
+              '',
+              sep='\n')
+        exit(-1)
+
+    calibration = calibrate(sys.argv[1], midi_input_names[indices[0]], [midi_output_names[i] for i in indices[1:]])
+    for port_name, stats in calibration.items():
+        if stats['round_trip'] is None:
+            print('{}: no pulse came back on the loopback port'.format(port_name))
+        else:
+            print('{}: round trip {:.2f} ms (jitter {:.2f} ms, {} lost)'.format(
+                port_name, stats['round_trip'] * 1e3, stats['jitter'] * 1e3, stats['lost']))
+    print('offsets written to {}'.format(sys.argv[1]))
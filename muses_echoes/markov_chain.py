@@ -1,7 +1,6 @@
-import pomegranate as pg
-import os
-import pickle
-import muses_echoes
+import random
+import bisect
+import numpy as np
 
 
 # prefixes = ['c', 'l', 'x', 'r']
@@ -11,13 +10,43 @@ import muses_echoes
 
 class MarkovChain:
     """
-    Adaptor class that wraps the pomegranate
-    implementation of a Markov Chain.
+    Incremental k-order Markov Chain.
+
+    The transitions are stored as weights in a dictionary keyed by the
+    context tuples (from the empty context up to the last order symbols),
+    so that learning a new sequence only touches the contexts it contains.
+    The inertia is applied as an exponential decay of the old weights:
+    instead of scaling the whole table at each learn, the weight of the
+    new observations grows by a factor 1 / inertia, and the table is
+    rescaled only when this factor becomes too large.
+    The sampling uses cumulative tables, computed once for each context
+    and invalidated only when the context learns new transitions. If the
+    context of the generated sequence was never observed, the chain backs
+    off to the longest observed suffix of it.
+    The table is bounded for long-running sessions: the transitions whose
+    weight decayed below a fraction of a new observation are forgotten when
+    the weights are rescaled, and when the number of contexts exceeds a
+    limit the lightest ones are dropped.
     """
 
-    def __init__(self, order=3, inertia=0.7):
-        # markov chain reference
-        self.markovChain = None
+    # scale of the new observations triggering a rescaling of the weights
+    _maxScale = 1e12
+
+    # weight, relative to a new observation, below which an old transition is forgotten
+    _minWeight = 1e-9
+
+    # bound of the codes of the contexts in generate_batch, so that they never overflow 64 bits
+    _maxCode = 2 ** 62
+
+    def __init__(self, order=3, inertia=0.7, rng=None, max_contexts=4096):
+        """
+        Constructor.
+
+        :param order: order of the markov chain
+        :param inertia: value between 0 and 1 that indicates how old melodies still influence the probabilities
+        :param rng: random generator exposing a random() method (or a numpy Generator), if None a new random.Random is used
+        :param max_contexts: maximum number of contexts kept in the table, None disables the limit
+        """
 
         # value between 0 and 1 that indicates how old melodies still
         # influence the probabilities of the markov chain
@@ -29,6 +58,30 @@ class MarkovChain:
         # flag to indicate if the first melody has already been learned
         self.isTheFirstMelody = True
 
+        # random generator used for the sampling
+        self.rng = rng if rng is not None else random.Random()
+
+        # transition weights: {context tuple: {symbol: weight}}
+        self._weights = {}
+
+        # cumulative tables used for the sampling: {context tuple: (symbols, cumulative weights)}
+        self._tables = {}
+
+        # weight of a new observation
+        self._scale = 1.0
+
+        # maximum number of contexts, the lightest ones are dropped above it
+        self.maxContexts = max_contexts
+
+        # dense table used by generate_batch, None until the first call
+        self._batch = None
+
+        # flag to indicate that contexts were dropped and the rows of the dense table must be rebuilt
+        self._staleBatchRows = False
+
+        # contexts learned since the last update of the dense table
+        self._dirtyContexts = set()
+
     def learn(self, sequence):
         """
         Learn from a new symbol input sequence.
@@ -36,9 +89,135 @@ class MarkovChain:
         :param sequence: list of symbols
         """
         if self.isTheFirstMelody:
-            self.markovChain = pg.MarkovChain.from_samples([sequence], k=self.order)
+            increment = 1.0
+            self.isTheFirstMelody = False
+        elif self.keepOldMelodies <= 0:
+            # the old melodies are completely forgotten
+            self._weights = {}
+            self._tables = {}
+            self._staleBatchRows = True
+            self._scale = 1.0
+            increment = 1.0
         else:
-            self.markovChain.fit([sequence], inertia=self.keepOldMelodies)
+            # decaying the old weights by growing the new ones
+            self._scale = self._scale / self.keepOldMelodies
+            if self._scale > self._maxScale:
+                self._rescale()
+            increment = self._scale * (1 - self.keepOldMelodies)
+
+        if increment <= 0:
+            return
+
+        for i, symbol in enumerate(sequence):
+            for n in range(min(i, self.order) + 1):
+                context = tuple(sequence[i - n:i])
+                transitions = self._weights.get(context)
+                if transitions is None:
+                    transitions = {}
+                    self._weights[context] = transitions
+                transitions[symbol] = transitions.get(symbol, 0.0) + increment
+                self._tables.pop(context, None)  # invalidating the cumulative table
+                self._dirtyContexts.add(context)
+
+        if self.maxContexts is not None and len(self._weights) > self.maxContexts:
+            self._prune_contexts()
+
+    def get_state(self):
+        """
+        Exports the learned transitions as flat arrays, in compressed sparse rows:
+        the contexts and the transitions are encoded as indices of the symbols list.
+
+        symbols: list of the learned symbols
+        scale: weight of a new observation
+        first: True if no melody was learned yet
+        contexts: [contexts, order] int32 array of symbol indices, padded with -1
+        context_lengths: int8 array of the lengths of the contexts
+        indptr: int64 array, the transitions of context i are in [indptr[i], indptr[i + 1])
+        transitions: int32 array of the symbol indices of the transitions
+        weights: float64 array of the weights of the transitions
+
+        :return: dictionary of the state
+        """
+        weights = self._weights
+        symbols = list(weights[()].keys()) if () in weights else []
+        indices = {symbol: i for i, symbol in enumerate(symbols)}
+
+        contexts = np.full((len(weights), self.order), -1, dtype=np.int32)
+        context_lengths = np.empty(len(weights), dtype=np.int8)
+        indptr = np.zeros(len(weights) + 1, dtype=np.int64)
+        transitions = []
+        values = []
+        for row, (context, context_transitions) in enumerate(weights.items()):
+            for symbol in context + tuple(context_transitions):
+                if symbol not in indices:
+                    # every symbol is observed in the empty context, unless it was pruned
+                    indices[symbol] = len(symbols)
+                    symbols.append(symbol)
+            contexts[row, :len(context)] = [indices[symbol] for symbol in context]
+            context_lengths[row] = len(context)
+            transitions.extend([indices[symbol] for symbol in context_transitions])
+            values.extend(context_transitions.values())
+            indptr[row + 1] = len(transitions)
+
+        return {
+            'symbols': symbols,
+            'scale': self._scale,
+            'first': self.isTheFirstMelody,
+            'contexts': contexts,
+            'context_lengths': context_lengths,
+            'indptr': indptr,
+            'transitions': np.array(transitions, dtype=np.int32),
+            'weights': np.array(values, dtype=np.float64)
+        }
+
+    def set_state(self, state):
+        """
+        Replaces the learned transitions with a state exported by get_state.
+
+        :param state: dictionary of the state
+        """
+        if state['contexts'].shape[1] != self.order:
+            raise ValueError('the state has order {}, not {}'.format(state['contexts'].shape[1], self.order))
+        symbols = state['symbols']
+        indptr = state['indptr'].tolist()
+        transitions = [symbols[index] for index in state['transitions'].tolist()]
+        values = state['weights'].tolist()
+
+        weights = {}
+        for row, (context, length) in enumerate(zip(state['contexts'].tolist(), state['context_lengths'].tolist())):
+            start, end = indptr[row], indptr[row + 1]
+            weights[tuple(symbols[index] for index in context[:length])] = dict(zip(transitions[start:end],
+                                                                                    values[start:end]))
+        self._weights = weights
+        self._scale = state['scale']
+        self.isTheFirstMelody = state['first']
+        self._tables = {}
+        self._batch = None
+        self._staleBatchRows = False
+        self._dirtyContexts = set()
+
+    def copy(self):
+        """
+        Gets a copy of the learned transitions, much cheaper than get_state: the
+        transition dictionaries are copied, while the sampling tables are not.
+        The copy can be exported with get_state by another thread.
+
+        :return: MarkovChain object
+        """
+        chain = MarkovChain(order=self.order, inertia=self.keepOldMelodies, rng=self.rng, max_contexts=self.maxContexts)
+        chain._weights = {context: dict(transitions) for context, transitions in self._weights.items()}
+        chain._scale = self._scale
+        chain.isTheFirstMelody = self.isTheFirstMelody
+        return chain
+
+    @property
+    def context_count(self):
+        """
+        Number of contexts in the transition table.
+
+        :return: integer
+        """
+        return len(self._weights)
 
     def generate(self, length):
         """
@@ -47,10 +226,246 @@ class MarkovChain:
         :param length: length of the generated sequence
         :return: list of symbols
         """
-        return self.markovChain.sample(length)
+        result = []
+        if not self._weights:
+            return result
 
+        for _ in range(length):
+            result.append(self._sample_next(result))
+        return result
 
-# getting the chord markov chain from the trained binary file
-cwd = os.path.dirname(muses_echoes.__file__)
-binary_path = os.path.join(cwd, 'chords_markov_chain.bin')
-chord_markov_chain = pickle.load(open(binary_path, 'rb'))
+    def generate_batch(self, count, length):
+        """
+        Generate many sequences of symbols at once, sampling all of them
+        step by step with a vectorized search in a dense cumulative table.
+        The suffixes of the history of each sequence are encoded as integers
+        (the symbols are their digits), and the longest observed context of
+        the history is found among the sorted codes of the observed contexts,
+        so the tables grow with the contexts and not with the possible
+        histories. The tables are kept between the calls: only the rows of
+        the contexts learned since the last call are recomputed, and the new
+        contexts are appended as new rows. If the codes don't fit in 64 bits
+        (too many symbols for the order), the sequences are generated one by
+        one. The sequences are sampled from the same distribution of generate.
+
+        :param count: number of sequences
+        :param length: length of each sequence
+        :return: (list of symbols, [count, length] numpy array of symbol indices) tuple
+        """
+        if not self._weights:
+            return [], np.zeros((count, 0), dtype=np.int64)
+
+        # every learned symbol is observed in the empty context
+        base = len(self._weights[()]) + 1
+        if base ** (self.order + 1) > self._maxCode:
+            symbols = list(self._weights[()].keys())
+            indices = {symbol: i for i, symbol in enumerate(symbols)}
+            result = [[indices[symbol] for symbol in self.generate(length)] for _ in range(count)]
+            return symbols, np.array(result, dtype=np.int64).reshape(count, length)
+
+        batch = self._batch_table()
+        symbols, offsets, position_symbols = batch['symbols'], batch['offsets'], batch['position_symbols']
+        context_codes, code_rows = batch['context_codes'], batch['code_rows']
+        last = len(context_codes) - 1
+        sequences = np.arange(count)
+
+        # codes of the suffixes of the histories, the column i has the last order - i symbols
+        # (the missing symbols at the start are 0 digits, so a short history has the code of its context)
+        suffixes = np.zeros((count, self.order + 1), dtype=np.int64)
+        result = np.empty((length, count), dtype=np.int64)
+        # the draws are kept below 1, so that each one falls inside the interval of its row
+        draws = np.minimum(self._random_array(count * length).reshape(length, count), 1 - 1e-9)
+        for step in range(length):
+            # the first suffix found is the longest observed one, the empty context is always found
+            index = np.minimum(context_codes.searchsorted(suffixes), last)
+            longest = (context_codes[index] == suffixes).argmax(axis=1)
+            rows = code_rows[index[sequences, longest]]
+
+            # each row spans the interval (row, row + 1] of the flattened table
+            chosen = position_symbols[offsets.searchsorted(rows + draws[step], side='right')]
+            result[step] = chosen
+            suffixes[:, :-1] = suffixes[:, 1:] * base + (chosen + 1)[:, None]
+        result = result.T
+        return symbols, result
+
+    def _batch_table(self):
+        """
+        Utility method that builds the dense cumulative table used by generate_batch,
+        or updates the rows of the contexts learned since the last call.
+        The new contexts get new rows, and all the rows are rebuilt only when
+        the symbols change or some contexts were dropped (see _rescale and _prune_contexts).
+
+        :return: dictionary with the symbols, the rows and the codes of the contexts, and the tables
+        """
+        learned_symbols = self._weights[()]
+        batch = self._batch
+        if batch is None or len(learned_symbols) != len(batch['symbols']) or \
+                any(symbol not in batch['symbol_indices'] for symbol in learned_symbols):
+            symbols = list(learned_symbols.keys())
+            batch = {
+                'symbols': symbols,
+                'symbol_indices': {symbol: i for i, symbol in enumerate(symbols)}
+            }
+            self._batch = batch
+            self._staleBatchRows = True
+
+        symbols = batch['symbols']
+        if self._staleBatchRows:
+            contexts = list(self._weights.keys())
+            capacity = max(len(contexts), 64)
+            batch['context_rows'] = {}
+            batch['row_codes'] = np.zeros(capacity, dtype=np.int64)
+            batch['weights'] = np.zeros((capacity, len(symbols)))
+            batch['table'] = np.zeros((capacity, len(symbols)))
+            # symbol of each position of the flattened table
+            batch['position_symbols'] = np.tile(np.arange(len(symbols)), capacity)
+            self._staleBatchRows = False
+            dirty = contexts
+        else:
+            dirty = self._dirtyContexts
+        self._dirtyContexts = set()
+        if not dirty:
+            return batch
+
+        context_rows = batch['context_rows']
+        new_contexts = [context for context in dirty if context not in context_rows]
+        if new_contexts:
+            self._add_batch_rows(new_contexts)
+
+        weights = batch['weights']
+        symbol_indices = batch['symbol_indices']
+        rows = []
+        for context in dirty:
+            row = context_rows[context]
+            for symbol, weight in self._weights[context].items():
+                weights[row, symbol_indices[symbol]] = weight
+            rows.append(row)
+
+        # normalized cumulative weights of the updated rows
+        cumulative = np.cumsum(weights[rows], axis=1)
+        table = batch['table']
+        table[rows] = cumulative / cumulative[:, -1:]
+
+        # flattened table of the used rows, increasing as each row is offset by its index
+        row_count = len(context_rows)
+        batch['offsets'] = (table[:row_count] + np.arange(row_count)[:, None]).ravel()
+        return batch
+
+    def _add_batch_rows(self, contexts):
+        """
+        Utility method that appends the rows of new contexts to the dense table,
+        growing it geometrically, and sorts again the codes of the contexts.
+        A context of n symbols has a code of n digits, none of them 0, so the
+        codes of the contexts of different lengths never collide.
+
+        :param contexts: list of context tuples without a row
+        """
+        batch = self._batch
+        context_rows = batch['context_rows']
+        symbol_indices = batch['symbol_indices']
+        base = len(batch['symbols']) + 1
+
+        capacity = len(batch['weights'])
+        if len(context_rows) + len(contexts) > capacity:
+            capacity = max(len(context_rows) + len(contexts), capacity * 2)
+            for key in ('weights', 'table', 'row_codes'):
+                grown = np.zeros((capacity,) + batch[key].shape[1:], dtype=batch[key].dtype)
+                grown[:len(batch[key])] = batch[key]
+                batch[key] = grown
+            batch['position_symbols'] = np.tile(np.arange(len(batch['symbols'])), capacity)
+
+        row_codes = batch['row_codes']
+        for context in contexts:
+            code = 0
+            for symbol in context:
+                code = code * base + symbol_indices[symbol] + 1
+            row = len(context_rows)
+            context_rows[context] = row
+            row_codes[row] = code
+
+        # codes of the contexts in increasing order, and the row of each one
+        code_rows = np.argsort(row_codes[:len(context_rows)])
+        batch['code_rows'] = code_rows
+        batch['context_codes'] = row_codes[code_rows]
+
+    def _random_array(self, count):
+        """
+        Utility method that draws uniform numbers from the random generator of the chain.
+
+        :param count: number of values
+        :return: numpy array of values in [0, 1)
+        """
+        if isinstance(self.rng, np.random.Generator):
+            return self.rng.random(count)
+        return np.array([self.rng.random() for _ in range(count)])
+
+    def _sample_next(self, history):
+        """
+        Utility method used to sample the symbol following a sequence.
+
+        :param history: list of the previous symbols
+        :return: symbol
+        """
+        n = min(len(history), self.order)
+        context = tuple(history[len(history) - n:])
+        while context not in self._weights:
+            context = context[1:]  # backing off to a shorter context
+
+        table = self._tables.get(context)
+        if table is None:
+            table = self._cumulative_table(context)
+        symbols, cumulative = table
+        r = self.rng.random() * cumulative[-1]
+        return symbols[min(bisect.bisect_right(cumulative, r), len(symbols) - 1)]
+
+    def _cumulative_table(self, context):
+        """
+        Utility method that computes and caches the cumulative table of a context.
+
+        :param context: context tuple
+        :return: (symbols, cumulative weights) tuple
+        """
+        symbols = list(self._weights[context].keys())
+        cumulative = []
+        total = 0.0
+        for symbol in symbols:
+            total = total + self._weights[context][symbol]
+            cumulative.append(total)
+        table = (symbols, cumulative)
+        self._tables[context] = table
+        return table
+
+    def _rescale(self):
+        """
+        Utility method that normalizes the weights to the current scale,
+        preventing them from overflowing, and forgets the transitions
+        whose weight decayed below _minWeight.
+        """
+        for context in list(self._weights):
+            transitions = self._weights[context]
+            for symbol in list(transitions):
+                weight = transitions[symbol] / self._scale
+                if weight < self._minWeight:
+                    del transitions[symbol]
+                else:
+                    transitions[symbol] = weight
+            if not transitions:
+                # the empty context sums all the others, it is emptied only with them
+                del self._weights[context]
+        self._tables = {}
+        self._staleBatchRows = True
+        self._scale = 1.0
+
+    def _prune_contexts(self):
+        """
+        Utility method that drops the lightest contexts, down to three quarters
+        of maxContexts, so that the pruning is amortized over many learns.
+        The empty context, needed by the back off, is never dropped.
+        """
+        keep = self.maxContexts * 3 // 4
+        totals = sorted(((sum(transitions.values()), context) for context, transitions in self._weights.items()
+                         if context), key=lambda item: item[0], reverse=True)
+        for _, context in totals[keep:]:
+            del self._weights[context]
+            self._tables.pop(context, None)
+        self._staleBatchRows = True
@@ -0,0 +1,96 @@
+import functools
+import melodically
+import numpy as np
+from muses_echoes.harmony_table import note_classes
+
+"""
+Scoring of the candidate melodies of a measure.
+
+Many rhythms and abstract melodies are sampled at once from the Markov
+chains, and the candidate played is the one that best fits the measure
+and the current chord. All the candidates are clipped to one measure and
+scored together with array operations, so that the cost of the choice
+grows slowly with the number of candidates.
+"""
+
+# weight of the fraction of the measure filled by the clipped rhythm
+fill_weight = 1.0
+
+# weight of the fraction of the played notes that are chord tones of the current chord
+chord_tone_weight = 1.0
+
+# weight of the mean interval between consecutive played notes, in octaves
+leap_weight = 0.5
+
+
+@functools.lru_cache(maxsize=64)
+def rhythm_table(symbols):
+    """
+    Gets the durations and the rest flags of some rhythmic symbols.
+    The tables are cached, the symbols of a chain rarely change.
+
+    :param symbols: tuple of rhythmic symbols
+    :return: (numpy array of durations in beats, numpy array of rest flags) tuple
+    """
+    durations = np.array([melodically.normalized_durations[symbol.replace('r', '')] for symbol in symbols])
+    rests = np.array(['r' in symbol for symbol in symbols], dtype=bool)
+    return durations, rests
+
+
+@functools.lru_cache(maxsize=64)
+def class_table(symbols):
+    """
+    Gets the note classes of some abstract melody symbols.
+    The tables are cached, the symbols of a chain rarely change.
+
+    :param symbols: tuple of abstract melody symbols
+    :return: numpy array of note classes (see harmony_table.note_classes)
+    """
+    return np.array([note_classes.get(symbol, 2) for symbol in symbols], dtype=np.int64)
+
+
+def clip_lengths(durations, measures=1):
+    """
+    Clips many rhythms to a number of measures, as melodically.clip_rhythmic_sequence.
+
+    :param durations: [candidates, length] numpy array of durations in beats
+    :param measures: number of 4/4 measures
+    :return: (numpy array of clipped lengths, numpy array of clipped durations in beats) tuple
+    """
+    fits = np.cumsum(durations, axis=1) <= 4 * measures
+    # the cumulative durations grow, so the symbols fitting the measures are a prefix
+    lengths = fits.sum(axis=1)
+    filled = np.where(fits, durations, 0).sum(axis=1)
+    return lengths, filled
+
+
+def score_melodies(midi_notes, rests, lengths, filled, chord_pitch_classes, measures=1):
+    """
+    Scores many candidate melodies of a measure.
+
+    The score adds the fraction of the measure filled by the rhythm and the
+    fraction of the played notes that are chord tones, and subtracts the mean
+    leap between consecutive played notes, weighted by the module weights.
+
+    :param midi_notes: [candidates, length] numpy array of midi notes
+    :param rests: [candidates, length] numpy array of rest flags
+    :param lengths: numpy array of the clipped lengths of the candidates
+    :param filled: numpy array of the clipped durations of the candidates in beats
+    :param chord_pitch_classes: pitch classes of the current chord
+    :param measures: number of 4/4 measures
+    :return: numpy array of scores
+    """
+    chord_tones = np.zeros(12, dtype=bool)
+    chord_tones[chord_pitch_classes] = True
+
+    played = (np.arange(midi_notes.shape[1])[None, :] < lengths[:, None]) & ~rests
+    played_count = played.sum(axis=1)
+    chord_tone_ratio = (played & chord_tones[midi_notes % 12]).sum(axis=1) / np.maximum(played_count, 1)
+
+    pairs = played[:, 1:] & played[:, :-1]
+    leaps = np.abs(np.diff(midi_notes, axis=1)) * pairs
+    mean_leap = leaps.sum(axis=1) / np.maximum(pairs.sum(axis=1), 1) / 12
+
+    return (fill_weight * filled / (4 * measures)
+            + chord_tone_weight * chord_tone_ratio
+            - leap_weight * mean_leap)
@@ -0,0 +1,430 @@
+import sys
+import bisect
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+
+"""
+Instrumentation of the hot paths of Muses' Echoes.
+
+The metrics are counters and histograms kept in memory, optionally
+partitioned by labels, and can be scraped in the Prometheus text format
+from a small http server listening on localhost.
+The logging of the timing threads is done asynchronously by the
+AsyncLogger, that formats and prints the messages in its own thread.
+"""
+
+# default buckets of the latency histograms, in seconds
+latency_buckets = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0)
+
+
+class _Metric(ABC):
+    """
+    Base class of the metrics, handling the labels.
+    A metric with label names is a family of children, one for each combination of label values,
+    while a metric without labels has a single child, used directly through the metric methods.
+    """
+
+    type = None
+
+    def __init__(self, name, description, label_names=()):
+        """
+        Constructor.
+
+        :param name: name of the metric
+        :param description: help string of the metric
+        :param label_names: tuple of label names
+        """
+        self.name = name
+        self.description = description
+        self.labelNames = tuple(label_names)
+        self.lock = threading.Lock()
+        self._children = {}
+        self._defaultChild = None
+
+    def labels(self, **label_values):
+        """
+        Gets the child of the metric for some label values, creating it if needed.
+
+        :param label_values: a value for each label name
+        :return: child metric
+        """
+        key = tuple(str(label_values[name]) for name in self.labelNames)
+        with self.lock:  # critical section
+            child = self._children.get(key)
+            if child is None:
+                child = self._new_child()
+                self._children[key] = child
+            return child
+        # end of critical section
+
+    def remove(self, **label_values):
+        """
+        Removes the child of some label values.
+
+        :param label_values: a value for each label name
+        """
+        key = tuple(str(label_values[name]) for name in self.labelNames)
+        with self.lock:  # critical section
+            self._children.pop(key, None)
+        # end of critical section
+
+    def children(self):
+        """
+        Gets all the children of the metric.
+
+        :return: list of (label dictionary, child) tuples
+        """
+        with self.lock:  # critical section
+            items = list(self._children.items())
+        # end of critical section
+        return [(dict(zip(self.labelNames, key)), child) for key, child in items]
+
+    def _default_child(self):
+        """
+        Utility method that gets the only child of a metric without labels.
+
+        :return: child metric
+        """
+        if self._defaultChild is None:
+            self._defaultChild = self.labels()
+        return self._defaultChild
+
+    @abstractmethod
+    def _new_child(self):
+        """
+        Creates a child of the metric.
+
+        :return: child metric
+        """
+
+
+class _CounterChild:
+    """
+    Monotonic counter.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        """
+        Increments the counter.
+
+        :param amount: increment
+        """
+        with self.lock:  # critical section
+            self.value = self.value + amount
+        # end of critical section
+
+
+class _HistogramChild:
+    """
+    Histogram of observed values, with fixed buckets.
+    """
+
+    def __init__(self, buckets):
+        self.lock = threading.Lock()
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """
+        Adds a value to the histogram.
+
+        :param value: observed value
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self.lock:  # critical section
+            self.counts[index] = self.counts[index] + 1
+            self.sum = self.sum + value
+            self.count = self.count + 1
+        # end of critical section
+
+    def snapshot(self):
+        """
+        Gets a consistent copy of the histogram.
+
+        :return: (cumulative bucket counts, sum, count) tuple
+        """
+        with self.lock:  # critical section
+            counts = list(self.counts)
+            total = self.sum
+            count = self.count
+        # end of critical section
+        cumulative = []
+        running = 0
+        for value in counts:
+            running = running + value
+            cumulative.append(running)
+        return cumulative, total, count
+
+
+class Counter(_Metric):
+    """
+    Family of counters.
+    """
+
+    type = 'counter'
+
+    def inc(self, amount=1):
+        self._default_child().inc(amount)
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class Histogram(_Metric):
+    """
+    Family of histograms.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=latency_buckets):
+        """
+        Constructor.
+
+        :param name: name of the metric
+        :param description: help string of the metric
+        :param label_names: tuple of label names
+        :param buckets: sorted upper bounds of the buckets
+        """
+        super().__init__(name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value):
+        self._default_child().observe(value)
+
+    def _new_child(self):
+        return _HistogramChild(self.buckets)
+
+
+class Registry:
+    """
+    Collection of metrics, rendered in the Prometheus text format.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._metrics = {}
+
+    def counter(self, name, description, label_names=()):
+        """
+        Gets a counter family, registering it if needed.
+        """
+        return self._register(Counter, name, description, label_names)
+
+    def histogram(self, name, description, label_names=(), buckets=latency_buckets):
+        """
+        Gets a histogram family, registering it if needed.
+        """
+        return self._register(Histogram, name, description, label_names, buckets=buckets)
+
+    def _register(self, metric_class, name, description, label_names, **kwargs):
+        with self.lock:  # critical section
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, description, label_names, **kwargs)
+                self._metrics[name] = metric
+            return metric
+        # end of critical section
+
+    def render(self):
+        """
+        Renders all the metrics in the Prometheus text format.
+
+        :return: string
+        """
+        with self.lock:  # critical section
+            metrics = list(self._metrics.values())
+        # end of critical section
+
+        lines = []
+        for metric in metrics:
+            lines.append('# HELP {} {}'.format(metric.name, metric.description))
+            lines.append('# TYPE {} {}'.format(metric.name, metric.type))
+            for labels, child in metric.children():
+                if metric.type == 'counter':
+                    lines.append('{}{} {}'.format(metric.name, _format_labels(labels), child.value))
+                else:
+                    cumulative, total, count = child.snapshot()
+                    bounds = [str(b) for b in metric.buckets] + ['+Inf']
+                    for bound, value in zip(bounds, cumulative):
+                        bucket_labels = dict(labels, le=bound)
+                        lines.append('{}_bucket{} {}'.format(metric.name, _format_labels(bucket_labels), value))
+                    lines.append('{}_sum{} {}'.format(metric.name, _format_labels(labels), total))
+                    lines.append('{}_count{} {}'.format(metric.name, _format_labels(labels), count))
+        return '\n'.join(lines) + '\n'
+
+
+def _format_labels(labels):
+    """
+    Utility function that formats a label dictionary.
+
+    :param labels: dictionary of label values
+    :return: string in the {name="value",...} format, empty if there are no labels
+    """
+    if not labels:
+        return ''
+    return '{' + ','.join('{}="{}"'.format(k, v) for k, v in labels.items()) + '}'
+
+
+class InstrumentedLock:
+    """
+    Lock measuring the time spent waiting for it and the time it is held.
+    It can replace a threading.Lock, also as a context manager.
+    """
+
+    def __init__(self, name, metrics_registry=None):
+        """
+        Constructor.
+
+        :param name: name of the lock, used as label of the metrics
+        :param metrics_registry: Registry of the metrics, if None the default one is used
+        """
+        if metrics_registry is None:
+            metrics_registry = registry
+        self._lock = threading.Lock()
+        self._acquireTime = 0.0
+        self.waitHistogram = metrics_registry.histogram(
+            'muses_lock_wait_seconds', 'time spent waiting for a lock', ('lock',)).labels(lock=name)
+        self.holdHistogram = metrics_registry.histogram(
+            'muses_lock_hold_seconds', 'time a lock is held', ('lock',)).labels(lock=name)
+
+    def acquire(self, blocking=True, timeout=-1):
+        start = time.perf_counter()
+        acquired = self._lock.acquire(blocking, timeout)
+        if acquired:
+            self._acquireTime = time.perf_counter()
+            self.waitHistogram.observe(self._acquireTime - start)
+        return acquired
+
+    def release(self):
+        hold_time = time.perf_counter() - self._acquireTime
+        self._lock.release()
+        self.holdHistogram.observe(hold_time)
+
+    def locked(self):
+        return self._lock.locked()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+
+
+class AsyncLogger:
+    """
+    Logger that formats and prints the messages in its own thread,
+    so that the timing threads only pay for a queue insertion.
+    The queue is bounded: if the stream blocks, the oldest messages
+    are dropped instead of growing the memory of the process.
+    """
+
+    def __init__(self, stream=None, queue_size=4096):
+        """
+        Constructor.
+
+        :param stream: file object used to write the messages, if None sys.stdout is used
+        :param queue_size: maximum number of messages waiting to be written
+        """
+        self.stream = stream
+        self._queue = deque(maxlen=queue_size)
+        self._event = threading.Event()
+
+        # number of messages dropped because the queue was full
+        self.dropped = 0
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def log(self, message, *args):
+        """
+        Logs a message, formatted later with str.format.
+
+        :param message: format string
+        :param args: arguments of the format string
+        """
+        if len(self._queue) == self._queue.maxlen:
+            self.dropped = self.dropped + 1
+        self._queue.append((message, args))
+        self._event.set()
+
+    def _run(self):
+        while True:
+            self._event.wait()
+            self._event.clear()
+            while self._queue:
+                message, args = self._queue.popleft()
+                stream = self.stream if self.stream is not None else sys.stdout
+                try:
+                    stream.write(message.format(*args) + '\n')
+                    stream.flush()
+                except Exception as e:  # a broken message must never stop the logger
+                    stream.write('logging error: {}\n'.format(e))
+
+
+# default registry of the application
+registry = Registry()
+
+# logger shared by all the objects of the process, created on first use
+_logger = None
+_loggerLock = threading.Lock()
+
+
+def get_logger():
+    """
+    Gets the AsyncLogger shared by the whole process, starting it on the first call.
+
+    :return: AsyncLogger object
+    """
+    global _logger
+    with _loggerLock:  # critical section
+        if _logger is None:
+            _logger = AsyncLogger()
+        return _logger
+    # end of critical section
+
+
+# =================================================
+# Metrics of the hot paths
+# =================================================
+
+input_latency = registry.histogram(
+    'muses_input_to_queue_seconds', 'time between the arrival of a midi input message and the queueing of its note')
+
+generation_time = registry.histogram(
+    'muses_generation_seconds', 'time spent generating a measure')
+
+send_lateness = registry.histogram(
+    'muses_send_lateness_seconds', 'actual minus scheduled send time of the scheduled events', ('stream',))
+
+empty_sequences = registry.counter(
+    'muses_empty_sequences_total', 'measures using the fallback for an empty sequence', ('sequence',))
+
+session_cpu_time = registry.counter(
+    'muses_session_cpu_seconds_total', 'cpu time used to generate the measures of a session', ('session',))
+
+session_processing_time = registry.histogram(
+    'muses_session_measure_seconds', 'time spent preparing a measure of a session', ('session',))
+
+osc_dropped = registry.counter(
+    'muses_osc_dropped_total', 'osc messages dropped by the queue and frames dropped by the destinations', ('stage',))
+
+
+def __getattr__(name):
+    """
+    Loads the MetricsServer on first use, so that the http modules
+    are imported only by the processes exposing the metrics.
+    """
+    if name == 'MetricsServer':
+        from muses_echoes.metrics_server import MetricsServer
+        return MetricsServer
+    raise AttributeError('module {} has no attribute {}'.format(__name__, name))
@@ -0,0 +1,67 @@
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from muses_echoes import metrics
+
+"""
+Http endpoint of the metrics.
+
+It is loaded on first use (see metrics.MetricsServer), the processes
+that don't expose the metrics never import the http modules.
+"""
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    """
+    Http handler serving the metrics of the server registry.
+    """
+
+    def do_GET(self):
+        if self.path.split('?')[0] not in ('/', '/metrics'):
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # the scrapes are not logged
+
+
+class MetricsServer:
+    """
+    Http server exposing the metrics on localhost, at the /metrics path.
+    """
+
+    def __init__(self, port, metrics_registry=None, host='127.0.0.1'):
+        """
+        Constructor.
+
+        :param port: tcp port of the server
+        :param metrics_registry: Registry of the metrics, if None the default one is used
+        :param host: interface of the server
+        """
+        self._server = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self._server.daemon_threads = True
+        self._server.registry = metrics_registry if metrics_registry is not None else metrics.registry
+        self._thread = None
+
+    @property
+    def port(self):
+        return self._server.server_address[1]
+
+    def start(self):
+        """
+        Starts serving in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the server.
+        """
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,363 @@
+import sys
+import math
+import random
+import threading
+import mido
+from muses_echoes.clock import Clock
+
+"""
+External midi clock synchronization.
+
+A MidiClockFollower receives the realtime messages of a midi input port
+(24 clock ticks per quarter note, start, continue, stop and song position)
+and steers the TempoMap of the application, so that the measure grid and
+the events of the sequencer follow the transport of the DAW.
+
+The tick times are filtered by a second order phase-locked loop (an
+alpha-beta filter, the steady state of a Kalman filter with a constant
+tempo model): the residual between each tick and its prediction corrects
+the phase with the alpha gain and the tick period with the beta gain, so
+the jitter of the usb drivers and of the virtual ports is averaged out
+instead of reaching the note timing. On each beat the tempo map gets a
+new segment, starting from the next beat, whose tempo brings the map on
+the locked phase within one beat.
+
+MidiClockGenerator is a software clock source, sending the same messages
+to any object with a send method (e.g. a virtual output port on Linux).
+
+usage: python -m muses_echoes.midi_clock [virtual output port name] [bpm] [jitter in ms]
+"""
+
+# clock ticks per quarter note of the midi clock
+PPQN = 24
+
+# clock ticks per song position unit (a sixteenth note)
+_TICKS_PER_SONG_POSITION = 6
+
+# range of the followed tempo, the tick periods out of the range are clipped
+_MIN_BPM = 20
+_MAX_BPM = 400
+
+
+class MidiClockFollower:
+    """
+    Follower of an external midi clock, steering a TempoMap.
+
+    The song position of the DAW is mapped on the beats of the tempo map with
+    an offset multiple of the measure length, chosen on start and continue so
+    that the downbeats of the DAW are the downbeats of the tempo map and the
+    map never moves backwards.
+    """
+
+    def __init__(self, tempo_map, ppqn=PPQN, gain=0.1, lock_ticks=4 * PPQN):
+        """
+        Constructor.
+
+        :param tempo_map: TempoMap steered by the clock
+        :param ppqn: clock ticks per quarter note
+        :param gain: phase gain (alpha) of the loop between 0 and 1, lower values smooth more jitter but lock slower
+        :param lock_ticks: ticks after a start before the clock is considered locked (the map converges in 3 beats)
+        """
+        self.tempoMap = tempo_map
+        self.ppqn = ppqn
+        self.lockTicks = lock_ticks
+
+        # gains of the alpha-beta filter (critically damped)
+        self.alpha = gain
+        self.beta = gain * gain / (2 - gain)
+
+        # lock protecting the state of the loop, written by the midi input thread and read by the other threads
+        # (the tempo map is never changed while holding it)
+        self.lock = threading.Lock()
+
+        # set while the transport of the external clock is running
+        self.running = threading.Event()
+
+        # ticks from the beginning of the song of the next clock tick
+        self._songTicks = 0
+
+        # True after a start or continue message, until the first tick
+        self._pendingStart = False
+
+        # beats of the tempo map minus the beats of the song
+        self._beatOffset = 0
+
+        # filtered time and period of the last tick, None before the first tick
+        self._tickTime = None
+        self._period = None
+
+        # ticks received since the last start
+        self._ticks = 0
+
+        # statistics: residuals of the loop and phase errors of the tempo map, in seconds
+        self._residualSum = 0.0
+        self._residualSquareSum = 0.0
+        self._residualMax = 0.0
+        self._phaseErrorSquareSum = 0.0
+        self._phaseErrorMax = 0.0
+        self._lockedTicks = 0
+
+    def receive(self, msg, timestamp):
+        """
+        Passes a realtime mido message to the follower.
+
+        :param msg: mido message, the messages that are not clock, start, continue, stop or songpos are ignored
+        :param timestamp: absolute clock time of the arrival of the message
+        """
+        if msg.type == 'clock':
+            self.tick(timestamp)
+        elif msg.type == 'start':
+            self.start()
+        elif msg.type == 'continue':
+            self.resume()
+        elif msg.type == 'stop':
+            self.stop()
+        elif msg.type == 'songpos':
+            self.song_position(msg.pos)
+
+    def start(self):
+        """
+        Starts the transport from the beginning of the song, on the next tick.
+        """
+        with self.lock:  # critical section
+            self._songTicks = 0
+            self._pendingStart = True
+        # end of critical section
+
+    def resume(self):
+        """
+        Resumes the transport from the current song position, on the next tick.
+        """
+        with self.lock:  # critical section
+            self._pendingStart = True
+        # end of critical section
+
+    def stop(self):
+        """
+        Stops the transport, the song position is kept.
+        """
+        self.running.clear()
+
+    def song_position(self, position):
+        """
+        Moves the song position, applied by the next continue.
+
+        :param position: song position in sixteenth notes
+        """
+        with self.lock:  # critical section
+            self._songTicks = position * _TICKS_PER_SONG_POSITION * self.ppqn // PPQN
+        # end of critical section
+
+    def tick(self, timestamp):
+        """
+        Processes a clock tick.
+
+        :param timestamp: absolute clock time of the arrival of the tick
+        """
+        with self.lock:  # critical section
+            pending_start = self._pendingStart
+            self._pendingStart = False
+        # end of critical section
+        if pending_start:
+            self._locate(timestamp)
+            return
+        if not self.running.is_set():
+            return
+
+        with self.lock:  # critical section
+            self._songTicks = self._songTicks + 1
+            if self._period is None:
+                # the first interval gives the initial period
+                self._period = self._clip_period(timestamp - self._tickTime)
+                self._tickTime = timestamp
+            else:
+                # alpha-beta update of the phase and of the period
+                predicted = self._tickTime + self._period
+                residual = timestamp - predicted
+                self._tickTime = predicted + self.alpha * residual
+                self._period = self._clip_period(self._period + self.beta * residual)
+                self._update_stats(residual, timestamp)
+            self._ticks = self._ticks + 1
+            beat = self._songTicks // self.ppqn + self._beatOffset
+            on_beat = self._songTicks % self.ppqn == 0
+            tick_time = self._tickTime
+            period = self._period
+        # end of critical section
+
+        if on_beat:
+            self._steer(beat, tick_time, period)
+
+    def get_stats(self):
+        """
+        Gets the statistics of the synchronization.
+
+        running: True while the transport is running
+        locked: True after lock_ticks ticks from the start
+        bpm: tempo estimated by the loop
+        ticks: ticks received since the last start
+        jitter_mean, jitter_rms, jitter_max: residuals of the ticks against the loop prediction in seconds
+        phase_error_rms, phase_error_max: distance between the ticks and the tempo map while locked, in seconds
+
+        :return: dictionary of statistics
+        """
+        with self.lock:  # critical section
+            count = max(self._ticks - 1, 1)
+            locked = max(self._lockedTicks, 1)
+            return {
+                'running': self.running.is_set(),
+                'locked': self.running.is_set() and self._ticks >= self.lockTicks,
+                'bpm': 60 / (self._period * self.ppqn) if self._period is not None else None,
+                'ticks': self._ticks,
+                'jitter_mean': self._residualSum / count,
+                'jitter_rms': math.sqrt(self._residualSquareSum / count),
+                'jitter_max': self._residualMax,
+                'phase_error_rms': math.sqrt(self._phaseErrorSquareSum / locked),
+                'phase_error_max': self._phaseErrorMax
+            }
+        # end of critical section
+
+    def _locate(self, timestamp):
+        """
+        Utility method that places the first tick after a start or a continue on the tempo map.
+
+        :param timestamp: absolute clock time of the tick
+        """
+        beats_per_measure = self.tempoMap.beatsPerMeasure
+        with self.lock:  # critical section
+            song_beat = self._songTicks / self.ppqn
+            # the first measure boundary of the song mapped at or after the current beat of the map
+            offset = math.ceil((self.tempoMap.beat_at(timestamp) - song_beat) / beats_per_measure) * beats_per_measure
+            period = self._period if self._period is not None else \
+                60 / (self.tempoMap.bpm_at(song_beat + offset) * self.ppqn)
+            self._beatOffset = offset
+            self._tickTime = timestamp
+            self._period = None
+            self._ticks = 1
+            self._residualSum = 0.0
+            self._residualSquareSum = 0.0
+            self._residualMax = 0.0
+            self._phaseErrorSquareSum = 0.0
+            self._phaseErrorMax = 0.0
+            self._lockedTicks = 0
+        # end of critical section
+
+        self.tempoMap.locate(song_beat + offset, timestamp, 60 / (period * self.ppqn))
+        self.running.set()
+
+    def _steer(self, beat, tick_time, period):
+        """
+        Utility method called on each beat, that sets the tempo of the map from the next beat,
+        so that the beat after it falls on the time predicted by the loop.
+
+        :param beat: beat position of the tick in the tempo map
+        :param tick_time: filtered time of the tick
+        :param period: filtered tick period in seconds
+        """
+        beat_duration = period * self.ppqn
+        next_time = self.tempoMap.time_at(beat + 1)
+        target_time = tick_time + 2 * beat_duration
+        bpm = 60 / self._clip_period((target_time - next_time) / self.ppqn) / self.ppqn
+        self.tempoMap.set_bpm(bpm, beat + 1)
+
+    def _clip_period(self, period):
+        """
+        Utility method that clips a tick period to the range of the followed tempo.
+
+        :param period: tick period in seconds
+        :return: clipped period
+        """
+        return min(max(period, 60 / (_MAX_BPM * self.ppqn)), 60 / (_MIN_BPM * self.ppqn))
+
+    def _update_stats(self, residual, timestamp):
+        """
+        Utility method that adds a tick to the statistics. It must be called inside a critical section.
+
+        :param residual: difference between the tick and its prediction in seconds
+        :param timestamp: absolute clock time of the tick
+        """
+        self._residualSum = self._residualSum + residual
+        self._residualSquareSum = self._residualSquareSum + residual * residual
+        self._residualMax = max(self._residualMax, abs(residual))
+        if self._ticks >= self.lockTicks:
+            song_beat = self._songTicks / self.ppqn
+            error = self.tempoMap.time_at(song_beat + self._beatOffset) - timestamp
+            self._phaseErrorSquareSum = self._phaseErrorSquareSum + error * error
+            self._phaseErrorMax = max(self._phaseErrorMax, abs(error))
+            self._lockedTicks = self._lockedTicks + 1
+
+
+class MidiClockGenerator:
+    """
+    Software midi clock, sending the ticks of a steady tempo (with an optional
+    random jitter) from its own thread, preceded by a start message.
+    """
+
+    def __init__(self, port, bpm=120, ppqn=PPQN, jitter=0.0, clock=None, seed=None):
+        """
+        Constructor.
+
+        :param port: object exposing a send method receiving the mido messages
+        :param bpm: beats per minutes
+        :param ppqn: clock ticks per quarter note
+        :param jitter: standard deviation of the delay added to each tick in seconds
+        :param clock: Clock used to wait for the ticks, if None a new one is created
+        :param seed: seed of the random jitter
+        """
+        self.port = port
+        self.bpm = bpm
+        self.ppqn = ppqn
+        self.jitter = jitter
+        self.clock = clock if clock is not None else Clock()
+        self.rng = random.Random(seed)
+
+        # ticks sent since the start
+        self.ticks = 0
+
+        self._stopEvent = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """
+        Sends a start message and starts sending the ticks, without blocking.
+        """
+        self._stopEvent.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the ticks and sends a stop message, if the generator was started.
+        """
+        if self._thread is None:
+            return
+        self._stopEvent.set()
+        self._thread.join()
+        self._thread = None
+        self.port.send(mido.Message('stop'))
+
+    def _run(self):
+        """
+        Thread sending the ticks on absolute deadlines, so that the jitter doesn't accumulate.
+        """
+        tick = mido.Message('clock')
+        period = 60 / (self.bpm * self.ppqn)
+        self.ticks = 0
+        self.port.send(mido.Message('start'))
+        start_time = self.clock.now() + period
+        while not self._stopEvent.is_set():
+            delay = abs(self.rng.gauss(0, self.jitter)) if self.jitter > 0 else 0.0
+            self.clock.wait_until(start_time + self.ticks * period + delay)
+            self.port.send(tick)
+            self.ticks = self.ticks + 1
+
+
+if __name__ == '__main__':
+    port_name = sys.argv[1] if len(sys.argv) > 1 else 'muses clock'
+    generator_bpm = float(sys.argv[2]) if len(sys.argv) > 2 else 120
+    generator_jitter = float(sys.argv[3]) / 1000 if len(sys.argv) > 3 else 0.0
+    with mido.open_output(port_name, virtual=True) as output_port:
+        generator = MidiClockGenerator(output_port, generator_bpm, jitter=generator_jitter)
+        generator.start()
+        print('sending midi clock at {} bpm on {}, press enter to stop'.format(generator_bpm, port_name))
+        input()
+        generator.stop()
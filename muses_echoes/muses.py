@@ -2,14 +2,27 @@ import mido
 import melodically
 import muses_echoes.markov_chain as markov_chain
 import threading
-from pythonosc.udp_client import SimpleUDPClient
+import contextlib
 import json
+import os
 import time
-import random
+import numpy as np
 from muses_echoes.sequencer import Sequencer
-
-# degree to number mapping
-degrees = ['I', 'II', 'III', 'IV', 'V', 'VI', 'VII']
+from muses_echoes.clock import Clock
+from muses_echoes.scheduler import Scheduler
+from muses_echoes.chords import get_chord_markov_chain
+from muses_echoes.harmony_table import HarmonyTable
+from muses_echoes.input_parser import StreamingParser, NOTE_ON, NOTE_OFF
+from muses_echoes.harmonic_state import PitchClassHarmonicState
+from muses_echoes.tempo import TempoMap, durations
+from muses_echoes.midi_clock import MidiClockFollower
+from muses_echoes.latency import load_latencies
+from muses_echoes.snapshot import SnapshotWriter, read_snapshot
+from muses_echoes import melody_scoring
+from muses_echoes import metrics
+
+# types of the realtime messages passed to the clock follower
+_clock_types = {'clock', 'start', 'continue', 'stop', 'songpos'}
 
 
 class MuseEchoes:
@@ -48,17 +61,34 @@ class MuseEchoes:
                  chord_octave_range=(2, 5),
                  rhythm_midi_note=24,  # C1
                  markov_chains_order=3,
-                 markov_chains_inertia=0.7):
+                 markov_chains_inertia=0.7,
+                 lookahead_measures=0,
+                 seed=None,
+                 sequencer=None,
+                 metrics_port=None,
+                 scheduler=None,
+                 osc_client=None,
+                 osc_address='/touchdesigner/mode',
+                 generation_pool=None,
+                 harmonic_decay=None,
+                 recorder=None,
+                 melody_candidates=1,
+                 chord_constraints=None,
+                 tempo_map=None,
+                 midi_clock=False,
+                 latency_config=None,
+                 snapshot_path=None,
+                 snapshot_measures=16):
         """
         Constructor.
 
         :param midi_in_port: name of the midi input port
-        :param midi_sequence_out_port: name of the midi output port for the melody
-        :param midi_chord_out_port: name of the midi output port for the chords
-        :param midi_rhythm_out_port: name of the midi output port for the rhythm
+        :param midi_sequence_out_port: name of the midi output port for the melody, or an already opened port
+        :param midi_chord_out_port: name of the midi output port for the chords, or an already opened port
+        :param midi_rhythm_out_port: name of the midi output port for the rhythm, or an already opened port
         :param midi_mapping: indicates how the modes are mapped to a certain midi channel
-        :param midi_buffer_size: size of the buffer used to store midi notes before pushing them in the MidiNoteQueue
-        :param osc_ip: ip string for the osc node receiving information about the scale
+        :param midi_buffer_size: number of input midi notes needed before starting the generation
+        :param osc_ip: ip string for the osc node receiving information about the scale, None disables osc
         :param osc_port: port string the osc node receiving information about the scale
         :param bpm: floats indicating the beats per minutes of the performance
         :param measures_for_scale_change: positive integer indicating the number of measures for a change of scale
@@ -67,10 +97,37 @@ class MuseEchoes:
         :param rhythm_midi_note: midi note used for the rhythmic sequencer track
         :param markov_chains_order: order of the Markov Chains used to generate the melodies
         :param markov_chains_inertia: value between [0-1] used to indicate the influence of old melodies in the learning
+        :param lookahead_measures: number of measures rendered in advance, 0 renders each measure on its downbeat
+        :param seed: seed of the random generator used for the generation, if None the output is not reproducible
+        :param sequencer: object exposing the play method of the Sequencer, if None a Sequencer on the output ports is used
+        :param metrics_port: localhost port of the metrics endpoint, None disables the endpoint
+        :param scheduler: Scheduler shared with other objects, if None a new one is created
+        :param osc_client: osc client shared with other objects, if None an OscOutput is created from osc_ip and osc_port
+        :param osc_address: osc address receiving the mode of the scale, the other values are sent to the same path
+        :param generation_pool: GenerationPool running the markov chains and the chord sampling, if None they run in this process
+        :param harmonic_decay: value between [0-1] used to decay the old notes in the scale detection, None uses the last 8 notes
+        :param recorder: SessionRecorder logging the input and the generation steps for a deterministic replay
+        :param melody_candidates: number of melodies sampled for each measure, the one fitting best the chord is played
+        :param tempo_map: TempoMap shared by the timing threads, if None the one of the sequencer or a new one is used
+        :param midi_clock: if True, the measures follow the midi clock, start, stop and song position messages of the input port
+        :param latency_config: path of the json file of the latency offsets of the output ports and of the osc destinations (see latency.py), applied to the sequencer and the osc client created here, None disables them
+        :param snapshot_path: path of the snapshot of the learned state, restored if it exists and rewritten in the background while playing, None disables the snapshots
+        :param snapshot_measures: number of measures between two snapshots
+        :param chord_constraints: dictionary of constraints of the chord progressions (first, last, no_repeats, see ChordMarkovChain.sample_constrained), each progression following the previous one, None samples them freely
         """
 
-        # lock used to protect the critical sections
-        self.lock = threading.Lock()
+        # lock used to protect the critical sections (measuring its wait and hold times),
+        # the recorder is never called while holding it: its lock is always taken first
+        self.lock = metrics.InstrumentedLock('muses')
+
+        # logger used by the timing threads, printing the messages in a background thread
+        self.logger = metrics.get_logger()
+
+        # port of the metrics endpoint
+        self.metricsPort = metrics_port
+
+        # histogram of the time between the arrival of the input messages and the queueing of their notes
+        self.inputLatency = metrics.input_latency
 
         # event triggered when a scale must be changed
         self.changeScaleEvent = threading.Event()
@@ -100,23 +157,33 @@ class MuseEchoes:
         # port for the osc protocol
         self.oscPort = osc_port
 
-        # setting up OSC
-        self.oscClient = SimpleUDPClient(osc_ip, osc_port)
+        # latency offsets of the midi output ports and of the osc destinations
+        midi_latencies, osc_latencies = load_latencies(latency_config) if latency_config is not None else (None, None)
+
+        # setting up OSC (disabled if no ip or client is provided)
+        if osc_client is None and osc_ip is not None:
+            # asyncio and pythonosc are imported only when osc is used
+            from muses_echoes.osc_output import OscOutput
+            osc_client = OscOutput([(osc_ip, osc_port)], latencies=osc_latencies)
+        self.oscClient = osc_client
+
+        # osc address receiving the mode of the scale
+        self.oscAddress = osc_address
+
+        # osc path of the other values (root, chord, measure and notes)
+        self.oscPath = osc_address.rsplit('/', 1)[0]
 
-        # length of the midi buffer used for the input
+        # number of input notes that triggers the buffer full event
         self.midiBufferLen = midi_buffer_size
 
-        # used to buffer the notes in std notation used for the harmonicState
-        self.noteBuffer = []
+        # number of input notes received since the last buffer full event
+        self.receivedNotes = 0
 
         # counter for the measures
         self.measureCount = 0
 
-        # midi note queue shared between the threads
-        self.midiNoteQueue = melodically.MidiNoteQueue()
-
-        # used to change the scale
-        self.harmonicState = melodically.HarmonicState(buffer_size=8)
+        # used to change the scale, updated as soon as the notes are received
+        self.harmonicState = PitchClassHarmonicState(buffer_size=8, decay=harmonic_decay)
 
         # current modal scale
         self.currentScale = []
@@ -124,16 +191,17 @@ class MuseEchoes:
         # current chord sequence
         self.chordSequence = []
 
-        # tempo in beats per minutes
+        # constraints of the chord progressions, None if they are sampled freely
+        self.chordConstraints = dict(chord_constraints) if chord_constraints is not None else None
+
+        # tempo in beats per minutes of the measure being rendered
         self.bpm = bpm
 
-        # dictionary containing the durations for each rhythmic figure
-        self.durations = melodically.get_durations(self.bpm)
+        # dictionary containing the durations for each rhythmic figure, without the triplets
+        self.durations = durations(self.bpm, triplets=False)
 
-        # removing triplets from the durations dictionary
-        del self.durations['16t']
-        del self.durations['8t']
-        del self.durations['4t']
+        # parser turning the input notes into rhythmic symbols as soon as they are received
+        self.inputParser = StreamingParser(self.durations)
 
         # number of measures for triggering a scale change
         self.measuresForScaleChange = measures_for_scale_change
@@ -145,22 +213,134 @@ class MuseEchoes:
         # midi note used for the rhythmic sequencer
         self.rhythmMidiNote = rhythm_midi_note
 
-        # midi sequencer
-        self.sequencer = Sequencer(sequence_port=self.midiSequenceOutPort,
-                                   chord_port=self.midiChordOutPort,
-                                   rhythm_port=self.midiRhythmOutPort,
+        # seed of the random generator, drawn from the OS entropy if not given so that it can be recorded
+        self.seed = seed if seed is not None else np.random.SeedSequence().entropy
+
+        # random generator shared by all the generation steps
+        self.rng = np.random.default_rng(self.seed)
+
+        # chords and notes lookup tables
+        self.harmonyTable = HarmonyTable(melody_octave_range=self.melodyOctaveRange,
+                                         chord_octave_range=self.chordOctaveRange)
+
+        # clock shared between all the timing threads
+        self.clock = scheduler.clock if scheduler is not None else Clock()
 
-                                   bpm=self.bpm)
+        # number of measures rendered in advance with respect to the one playing
+        self.lookaheadMeasures = lookahead_measures
+
+        # absolute clock time of the downbeat of the measure being rendered
+        self.measureStartTime = self.clock.now()
+
+        # single timing thread serving all the midi output ports
+        self.scheduler = scheduler if scheduler is not None else Scheduler(self.clock)
+
+        # tempo map shared by the measure grid, the input parser and the parts of the sequencer
+        if tempo_map is None:
+            tempo_map = getattr(sequencer, 'tempoMap', None)
+        self.tempoMap = tempo_map if tempo_map is not None else TempoMap(bpm, clock=self.clock)
+
+        # follower of the external midi clock steering the tempo map, None if the measures run on the internal tempo
+        self.clockFollower = MidiClockFollower(self.tempoMap) if midi_clock else None
+
+        # midi sequencer
+        if sequencer is None:
+            sequencer = Sequencer(sequence_port=self.midiSequenceOutPort,
+                                  chord_port=self.midiChordOutPort,
+                                  rhythm_port=self.midiRhythmOutPort,
+                                  bpm=self.bpm,
+                                  scheduler=self.scheduler,
+                                  tempo_map=self.tempoMap,
+                                  latencies=midi_latencies)
+        self.sequencer = sequencer
 
         # order and inertia parameters of the markov chains
         self.markovChainsOrder = markov_chains_order
         self.markovChainsInertia = markov_chains_inertia
 
+        # True after the markov chains are trained on the first input notes
+        self.generationInitialized = False
+
+        if generation_pool is None:
+            # markov chain used for generate a note sequence
+            self.notesMarkovChain = markov_chain.MarkovChain(order=self.markovChainsOrder,
+                                                             inertia=self.markovChainsInertia,
+                                                             rng=self.rng)
+
+            # markov chain used to generate the rhythmic sequence
+            self.rhythmMarkovChain = markov_chain.MarkovChain(order=self.markovChainsOrder,
+                                                              inertia=self.markovChainsInertia,
+                                                              rng=self.rng)
+
+            # chord model, loaded on first use
+            self.chordSampler = None
+        else:
+            # the same models, running in the worker processes of the pool
+            self.notesMarkovChain = generation_pool.markov_chain(order=self.markovChainsOrder,
+                                                                 inertia=self.markovChainsInertia,
+                                                                 seed=int(self.rng.integers(2 ** 63)))
+            self.rhythmMarkovChain = generation_pool.markov_chain(order=self.markovChainsOrder,
+                                                                  inertia=self.markovChainsInertia,
+                                                                  seed=int(self.rng.integers(2 ** 63)))
+            self.chordSampler = generation_pool.chord_sampler()
+
+        # max length of the generated sequences
+        self.generatedSequenceMaxLength = 10
+
+        # number of candidate melodies sampled for each measure
+        self.melodyCandidates = melody_candidates
+
+        # number of measures between two snapshots, and measures generated since the last one
+        self.snapshotMeasures = snapshot_measures
+        self._measuresSinceSnapshot = 0
+
+        # restoring the learned state of the previous run (warm start)
+        restored = False
+        if snapshot_path is not None and os.path.exists(snapshot_path):
+            try:
+                self.restore_snapshot(snapshot_path)
+                restored = True
+            except (ValueError, KeyError, OSError) as e:
+                self.logger.log('snapshot {} not restored, starting from scratch: {}', snapshot_path, e)
+
+        # thread writing the snapshots, None if the snapshots are disabled
+        self.snapshotWriter = SnapshotWriter(snapshot_path) if snapshot_path is not None else None
+
+        # recorder of the session, None if the session is not recorded
+        self.recorder = recorder
+        if recorder is not None:
+            recorder.write_header({
+                'midi_mapping': list(midi_mapping),
+                'midi_buffer_size': midi_buffer_size,
+                'bpm': bpm,
+                'measures_for_scale_change': measures_for_scale_change,
+                'melody_octave_range': list(melody_octave_range),
+                'chord_octave_range': list(chord_octave_range),
+                'rhythm_midi_note': rhythm_midi_note,
+                'markov_chains_order': markov_chains_order,
+                'markov_chains_inertia': markov_chains_inertia,
+                'lookahead_measures': lookahead_measures,
+                'seed': int(self.seed),
+                'harmonic_decay': harmonic_decay,
+                'melody_candidates': melody_candidates,
+                'chord_constraints': self.chordConstraints,
+                'remote_generation': generation_pool is not None,
+                'restored_snapshot': restored,
+                'midi_clock': midi_clock,
+                'tempo_segments': self.tempoMap.get_segments()
+            })
+            # the changes of the tempo map are recorded, to be replayed on the same beats
+            self.tempoMap.listeners.append(recorder.record_tempo_segments)
+
     def start(self):
         """
         Starts all the threads of the application
         """
 
+        # exposing the metrics on localhost
+        if self.metricsPort is not None:
+            metrics.MetricsServer(self.metricsPort).start()
+
         # spawning the threads
         thread1 = threading.Thread(target=self._listen_midi)
         thread2 = threading.Thread(target=self._fire_events)
@@ -182,15 +362,38 @@ class MuseEchoes:
     def _fire_events(self):
         """
         Thead that implements the synchronization between the threads using Events.
-        It loops forever, sleeping for one measure at each loop. It triggers the
-        sequencer event at each measure, and the scale based on the
+        It loops forever, waiting on the shared clock for the absolute deadline of the
+        next measure. It triggers the sequencer event at each measure, and the scale based on the
         measuresForScaleChange attribute (the default is a scale change every 4 measures).
+
+        The events are fired lookaheadMeasures measures before the downbeat of the
+        measure they prepare, whose absolute time is saved in the measureStartTime
+        attribute. With a positive lookahead the next measures are rendered while
+        the current one is still playing, and the sequencer receives them ahead of time.
         """
         measure_counter = self.measureCount
+        beats_per_measure = self.tempoMap.beatsPerMeasure
+        lookahead_beats = self.lookaheadMeasures * beats_per_measure
+        # the downbeats are the measure boundaries of the tempo map, the positions are counted in beats
+        measure_beat = self.tempoMap.next_measure(self.clock.now()) + lookahead_beats - beats_per_measure
         while True:
-            # one measure sleep
-            time.sleep(self.durations['1'])
-            print('[measure {}/{}]'.format(measure_counter + 1, self.measuresForScaleChange))
+            if self.clockFollower is not None and not self.clockFollower.running.is_set():
+                # waiting for the transport of the external clock, the measures restart on the downbeat
+                # it was started on (prepared at once, like the following ones already in the lookahead)
+                self.clockFollower.running.wait()
+                measure_beat = self.tempoMap.next_measure(self.clock.now()) - 2 * beats_per_measure
+
+            # waiting for the measure to be prepared
+            measure_beat = measure_beat + beats_per_measure
+            self.clock.wait_until(self.tempoMap.time_at(measure_beat - lookahead_beats), 'measure')
+            measure_start_time = self.tempoMap.time_at(measure_beat)
+            self.logger.log('[measure {}/{}]', measure_counter + 1, self.measuresForScaleChange)
+
+            # saving the downbeat of the measure as a class attribute
+            with self.lock:  # critical section
+                self.measureStartTime = measure_start_time
+            # critical section
+            self._update_tempo(measure_start_time)
 
             if measure_counter == 0:
                 # triggering a scale change
@@ -215,91 +418,83 @@ class MuseEchoes:
     def _listen_midi(self):
         """
         Thread implementing a never ending loop, listening for note_on/note_off
-        messages from the midiInPort, saving the messages into a buffer.
-        When the buffer is full, the messages are moved into the midiNoteQueue.
+        messages from the midiInPort and passing them to the push_input method.
+        The thread never acquires the lock: the messages are parsed by the
+        inputParser and the harmonicState as soon as they are received.
         """
 
-        # buffer used to store the incoming midi note messages
-        midi_buffer = []
-
         # receiving midi messages
         with mido.open_input(self.midiInPort) as midi_in_port:
             for midi_msg in midi_in_port:
-                if midi_msg.type == 'note_on' or 'note_off':
-                    # saving the message in a buffer
-                    midi_buffer.append({
-                        'msg': midi_msg,
-                        'timestamp': time.time()
-                    })
-
-                    if len(midi_buffer) >= self.midiBufferLen:
-                        # moving the messages from the midiBuffer to the midiNoteQueue
-                        # and adding the new notes to the noteBuffer
-                        with self.lock:  # critical section
-                            for msg in midi_buffer:
-                                self.midiNoteQueue.push(msg['msg'].type, msg['msg'].note, msg['timestamp'])
-                                self.noteBuffer = self.noteBuffer + self.midiNoteQueue.get_notes()
-                        # critical section
-
-                        # resetting the buffer
-                        midi_buffer = []
-
-                        # triggering the event
-                        self.bufferFullEvent.set()
+                self.receive_midi(midi_msg)
 
-    def _play_midi(self):
+    def receive_midi(self, midi_msg):
         """
-        This thread generates a melody using two Markov Chains, one for the
-        note sequence and one for the rhythmic sequence. It then uses a combination
-        of these sequences, and the current chord as an input for the midi sequencer.
-        """
-
-        # =================================================
-        # Local variables
-        # =================================================
-
-        # markov chain used for generate a note sequence
-        notes_markov_chain = markov_chain.MarkovChain(order=self.markovChainsOrder,
-                                                      inertia=self.markovChainsInertia)
-
-        # markov chain used to generate the rhythmic sequence
-        rhythm_markov_chain = markov_chain.MarkovChain(order=self.markovChainsOrder,
-                                                       inertia=self.markovChainsInertia)
-
-        # current chord to be played in melodically notation
-        current_chord = None
-
-        # first chord of the chord sequence
-        first_chord = None
+        Passes a note_on/note_off mido message to the push_input method, timestamping it.
+        With the midi clock, the clock and transport messages are passed to the clockFollower.
 
-        # sequence of input notes in std notation
-        note_input_sequence = []
-
-        # sequence of rhythmic symbols
-        rhythmic_input_sequence = []
-
-        # note fr the rhythmic part
-        rhythm_note = self.rhythmMidiNote
-
-        # max length of the generated sequences
-        generated_sequence_max_length = 10
-
-        # generated sequence for the notes in std notation
-        note_generated_sequence = []
-
-        # generated sequence for the notes as midi values
-        midi_generated_sequence = []
+        :param midi_msg: mido message
+        """
+        if midi_msg.type == 'note_on' or midi_msg.type == 'note_off':
+            # a note_on with zero velocity is a note_off
+            msg_type = NOTE_ON if midi_msg.type == 'note_on' and midi_msg.velocity > 0 else NOTE_OFF
+            self.push_input(msg_type, midi_msg.note, midi_msg.velocity, time.time())
+        elif self.clockFollower is not None and midi_msg.type in _clock_types:
+            self.clockFollower.receive(midi_msg, self.clock.now())
+
+    def push_input(self, msg_type, note, velocity, timestamp):
+        """
+        Parses an input message, queueing its note in the inputParser and the harmonicState, and triggers
+        the buffer full event every midiBufferLen notes. It must be called always by the same thread
+        (the midi input thread, or the callback thread of the input port).
+
+        :param msg_type: NOTE_ON or NOTE_OFF
+        :param note: midi note value
+        :param velocity: midi velocity value
+        :param timestamp: timestamp of the message in seconds
+        """
+        if self.recorder is None:
+            self._parse_input(msg_type, note, timestamp)
+        else:
+            with self.recorder.record_input(msg_type, note, velocity, timestamp):
+                self._parse_input(msg_type, note, timestamp)
+        if self.inputLatency is not None:
+            self.inputLatency.observe(time.time() - timestamp)
+
+        self.receivedNotes = self.receivedNotes + 1
+        if self.receivedNotes >= self.midiBufferLen:
+            self.receivedNotes = 0
+
+            # triggering the event
+            self.bufferFullEvent.set()
+
+    def _parse_input(self, msg_type, note, timestamp):
+        """
+        Utility method that passes an input message to the inputParser and the harmonicState.
 
-        # generated sequence for the rhythmic symbols
-        rhythm_generated_sequence = []
+        :param msg_type: NOTE_ON or NOTE_OFF
+        :param note: midi note value
+        :param timestamp: timestamp of the message in seconds
+        """
+        self.inputParser.push(msg_type, note, timestamp)
+        if msg_type == NOTE_ON:
+            self.harmonicState.push_pitch_class(note % 12)
 
-        # sequence of note in the format accepted by the sequencer
-        sequencer_input = []
+    def _read_input(self):
+        """
+        Utility method that returns the context in which the generation reads the parsed input,
+        recorded to replay the input messages between the same generation steps.
 
-        # midi notes to be played by the sequencer for the chord generation
-        chord_input = []
+        :return: context manager
+        """
+        return self.recorder.sync() if self.recorder is not None else contextlib.nullcontext()
 
-        # end of local variables =============================
+    def _play_midi(self):
+        """
+        This thread generates a melody using two Markov Chains, one for the
+        note sequence and one for the rhythmic sequence. It then uses a combination
+        of these sequences, and the current chord as an input for the midi sequencer.
+        """
 
         # =================================================
         # Initialization
@@ -311,29 +506,8 @@ class MuseEchoes:
         # synchronization with change_scale thread
         self.changeScaleDoneEvent.wait()
 
-        # initializing all the objects =======
-        with self.lock:  # critical section
-            # the first scale is also set here
-            self.harmonicState.push_notes(self.noteBuffer)
-
-            # getting the first chord
-            current_chord = self._degree_to_chord(self.chordSequence[self.measureCount])
-        # end of critical section
-
-        rhythmic_input_sequence, note_input_sequence = self._parse_midi_notes(current_chord)
-
-        # fallback in case the sequences are empty
-        if not rhythmic_input_sequence or not note_input_sequence:
-            rhythmic_input_sequence = ['r1']
-            note_input_sequence = ['x']
-
-        print('DEBUGG')
-        print(note_input_sequence)
-        print(rhythmic_input_sequence)
-        notes_markov_chain.learn(note_input_sequence)
-        rhythm_markov_chain.learn(rhythmic_input_sequence)
-        print('DEBUGG')
-        # end of initialization ==============================
+        if not self.generationInitialized:
+            self._initialize_generation()
 
         # =================================================
         # Sequence and chord generation loop
@@ -346,44 +520,19 @@ class MuseEchoes:
             # synchronization with change_scale thread
             self.changeScaleDoneEvent.wait()
 
-            # getting the current, first chords and midi channel
-            with self.lock:  # critical section
-                current_chord = self._degree_to_chord(self.chordSequence[self.measureCount])
-                first_chord = self._degree_to_chord('I')
-                midi_channel = self.midiMapping[self.midiMappingIndex]
-            # end of critical section
-
-            # parsing the rhythm and the notes
-            rhythmic_input_sequence, note_input_sequence = self._parse_midi_notes(current_chord)
-
-            # training the markov chains
-            if note_input_sequence and rhythmic_input_sequence:
-                notes_markov_chain.learn(note_input_sequence)
-                rhythm_markov_chain.learn(rhythmic_input_sequence)
-
-            # generating the new sequences that fits in one measure
-            rhythm_generated_sequence = rhythm_markov_chain.generate(generated_sequence_max_length)
-            rhythm_generated_sequence = melodically.clip_rhythmic_sequence(rhythmic_input_sequence, 1)
-            note_generated_sequence = notes_markov_chain.generate(len(rhythm_generated_sequence))
-            midi_generated_sequence = self._generate_midi_sequence(note_generated_sequence, first_chord)
-
-            # TODO: understand why some sequence are empty
-
-            # playing the sequencer
-            chord_input = self._generate_midi_chord(current_chord)
-            if rhythm_generated_sequence:
-                sequencer_input = [{'note': x, 'duration': y} for x, y in
-                                   zip(midi_generated_sequence, rhythm_generated_sequence)]
-                self.sequencer.play(sequencer_input, chord_input, rhythm_note, midi_channel)
-            else:
-                self.sequencer.play([], chord_input, rhythm_note, midi_channel)
+            # generating and playing the measure
+            measure = self._generate_measure()
+            self.sequencer.play(measure['sequence'], measure['chord_notes'], measure['rhythm_note'],
+                                measure['midi_channel'], measure['start_time'])
+            self._notify_measure(measure)
+            if self.recorder is not None:
+                self.recorder.flush()
+            self._update_snapshot()
 
             # logging to the console
-            print('abstract melody: {}'.format(note_generated_sequence))
-            print('rhythmic pattern: {}'.format(rhythm_generated_sequence))
-            print('midi notes: {}'.format(midi_generated_sequence))
-            print('chord: {}'.format(current_chord))
-            print()
+            self.logger.log('abstract melody: {}\nrhythmic pattern: {}\nmidi notes: {}\nchord: {}\n',
+                            measure['abstract_melody'], measure['rhythmic_pattern'],
+                            measure['midi_notes'], measure['chord'])
 
         # end of the loop ====================================
 
@@ -394,9 +543,6 @@ class MuseEchoes:
         using a Markov chain trained on the beatles chord database.
         """
 
-        # markov chain trained on The Beatles chord database
-        chords_markov_chain = markov_chain.chord_markov_chain
-
         # waiting for the midiBuffer to be full
         self.bufferFullEvent.wait()
 
@@ -406,40 +552,487 @@ class MuseEchoes:
             self.changeScaleEvent.clear()
 
             # updating the scale and the chords
+            midi_channel, start_time = self._update_scale()
+            self.logger.log('scale: {}\nnext chords: {}\nmidi channel: {}',
+                            self.currentScale, self.chordSequence, midi_channel)
+
+            # notifying the scale change on the downbeat of the new scale
+            self._notify_scale(midi_channel, start_time)
+
+            # synchronization with play_midi thread
+            self.changeScaleDoneEvent.set()
+
+    def render(self, input_records, measures):
+        """
+        Runs the generation pipeline on a virtual clock, as fast as the CPU allows,
+        without the threads and the midi ports. The measures are played by the
+        sequencer attribute starting from time 0, while the input records are fed
+        to push_input when the virtual clock reaches their timestamp.
+
+        :param input_records: list of (type, note, velocity, timestamp) tuples sorted by timestamp, with NOTE_ON/NOTE_OFF types
+        :param measures: number of measures to render
+        :return: list of the measures generated by _generate_measure
+        """
+        # the timestamps of the input records are virtual, the input latency is meaningless
+        self.inputLatency = None
+
+        # the generation starts from the first measure, without waiting for the input notes
+        self.bufferFullEvent.set()
+
+        beats_per_measure = self.tempoMap.beatsPerMeasure
+        input_index = 0
+        result = []
+        for measure in range(measures):
+            # the measure is prepared at the end of the previous one, as in the _fire_events thread
+            virtual_time = self.tempoMap.time_at((measure + 1) * beats_per_measure)
+            while input_index < len(input_records) and input_records[input_index][3] < virtual_time:
+                self.push_input(*input_records[input_index])
+                input_index = input_index + 1
+
+            result.append(self.process_measure(self.tempoMap.time_at(measure * beats_per_measure)))
+        return result
+
+    def process_measure(self, start_time):
+        """
+        Prepares and plays a measure in the calling thread, doing in sequence the
+        work of the _fire_events, _change_scale and _play_midi threads. It is used
+        to drive the application without its threads, from a virtual clock or from
+        the ticks of a shared scheduler.
+        The generation starts from the first scale change following the buffer full
+        event, before that the measures are only counted.
+
+        :param start_time: absolute clock time of the downbeat of the measure
+        :return: measure generated by _generate_measure, or None if the generation is not started yet
+        """
+        with self.lock:  # critical section
+            self.measureStartTime = start_time
+            measure_counter = self.measureCount
+        # end of critical section
+        self._update_tempo(start_time)
+
+        if measure_counter == 0 and self.bufferFullEvent.is_set():
+            midi_channel, _ = self._update_scale()
+            self._notify_scale(midi_channel, start_time)
+
+        measure_counter = measure_counter + 1
+        if measure_counter >= self.measuresForScaleChange:
+            measure_counter = 0
+        with self.lock:  # critical section
+            self.measureCount = measure_counter
+        # end of critical section
+
+        if not self.generationInitialized:
+            if not self.currentScale:
+                return None
+            self._initialize_generation()
+
+        generated = self._generate_measure()
+        self.sequencer.play(generated['sequence'], generated['chord_notes'], generated['rhythm_note'],
+                            generated['midi_channel'], generated['start_time'])
+        self._notify_measure(generated)
+        if self.recorder is not None:
+            self.recorder.flush()
+        self._update_snapshot()
+        return generated
+
+    def set_bpm(self, bpm, beat=None):
+        """
+        Changes the tempo of all the parts and of the measure grid on a beat.
+
+        :param bpm: new beats per minutes
+        :param beat: beat position of the change in the tempoMap, if None the first measure not rendered yet is used
+        :return: beat position of the change
+        """
+        return self.ramp_bpm(bpm, 0, beat)
+
+    def ramp_bpm(self, bpm, beats, beat=None, curve='linear'):
+        """
+        Changes the tempo of all the parts and of the measure grid gradually over some beats (see TempoMap.ramp).
+        By default the ramp starts on the first measure not rendered yet, so
+        that the measures already sent to the sequencer are not affected.
+
+        :param bpm: target beats per minutes
+        :param beats: length of the ramp in beats
+        :param beat: beat position of the start of the ramp in the tempoMap, if None the first measure not rendered yet is used
+        :param curve: 'linear' or 'exponential'
+        :return: beat position of the start of the ramp
+        """
+        if beat is None:
             with self.lock:  # critical section
-                self.chordSequence = chords_markov_chain.sample(self.measuresForScaleChange)
-                self.harmonicState.push_notes(self.noteBuffer)
-                self.noteBuffer = []
-                self.currentScale = self.harmonicState.get_mode_notes()
-                self.midiMappingIndex = self.harmonicState.currentMode['mode_index']
-                midi_channel = self.midiMapping[self.midiMappingIndex]
-                print('scale: {}'.format(self.currentScale))
-                print('next chords: {}'.format(self.chordSequence))
-                print('midi channel: {}'.format(midi_channel))
-                self.oscClient.send_message('/touchdesigner/mode', midi_channel - 1)
+                measure_start_time = self.measureStartTime
             # end of critical section
+            beat = self.tempoMap.next_measure(max(measure_start_time, self.clock.now()))
+        return self.tempoMap.ramp(bpm, beats, beat, curve)
 
-            # synchronization with play_midi thread
+    def get_snapshot(self):
+        """
+        Gets the learned state of the session: the note and rhythm Markov chains,
+        the harmonic state and the position in the scale and in the chord progression.
+        It must be called by the thread generating the measures.
+
+        :return: nested dictionary of json values and numpy arrays (see snapshot.py)
+        """
+        return self._capture_snapshot()()
+
+    def _capture_snapshot(self):
+        """
+        Utility method that copies the learned state of the session, cheaply enough for the
+        thread generating the measures: the Markov chains are exported later, by the caller
+        of the returned function (e.g. the thread of the snapshotWriter).
+
+        :return: function building the snapshot (see get_snapshot), returning None if a copy of a chain was replaced
+        """
+        with self.lock:  # critical section
+            position = {
+                'measure_count': self.measureCount,
+                'chord_sequence': list(self.chordSequence),
+                'current_scale': list(self.currentScale),
+                'midi_mapping_index': self.midiMappingIndex,
+                'generation_initialized': self.generationInitialized
+            }
+        # end of critical section
+        snapshot_time = time.time()
+        notes = self.notesMarkovChain.copy()
+        rhythm = self.rhythmMarkovChain.copy()
+        harmonic_state = self.harmonicState.get_state()
+        parameters = {
+            'markov_chains_order': self.markovChainsOrder,
+            'measures_for_scale_change': self.measuresForScaleChange,
+            'harmonic_buffer_size': self.harmonicState.bufferSize,
+            'harmonic_decay': self.harmonicState.decay
+        }
+
+        def build():
+            notes_state = notes.get_state()
+            rhythm_state = rhythm.get_state()
+            if notes_state is None or rhythm_state is None:
+                return None
+            return {
+                'time': snapshot_time,
+                'parameters': parameters,
+                'position': position,
+                'notes': notes_state,
+                'rhythm': rhythm_state,
+                'harmonic_state': harmonic_state
+            }
+        return build
+
+    def restore_snapshot(self, path):
+        """
+        Restores the learned state of a session from a snapshot, before the session starts.
+        If the generation was already initialized, the session plays its first measure
+        without waiting for the input notes. If the harmonic state of the snapshot has
+        different parameters, only the Markov chains are restored, and the session starts
+        from the first scale change as a new one.
+
+        :param path: path of the snapshot
+        """
+        start = time.perf_counter()
+        state = read_snapshot(path)
+        parameters = state['parameters']
+        if parameters['markov_chains_order'] != self.markovChainsOrder or \
+                parameters['measures_for_scale_change'] != self.measuresForScaleChange:
+            raise ValueError('the snapshot has order {} and {} measures for a scale change'.format(
+                parameters['markov_chains_order'], parameters['measures_for_scale_change']))
+
+        self.notesMarkovChain.set_state(state['notes'])
+        self.rhythmMarkovChain.set_state(state['rhythm'])
+        if parameters['harmonic_buffer_size'] != self.harmonicState.bufferSize or \
+                parameters['harmonic_decay'] != self.harmonicState.decay:
+            # the scale and the chords of the snapshot follow its harmonic state, they are restored only with it
+            self.logger.log('snapshot {}: only the markov chains are restored, the harmonic state has buffer size {} '
+                            'and decay {}', path, parameters['harmonic_buffer_size'], parameters['harmonic_decay'])
+            return
+
+        self.harmonicState.set_state(state['harmonic_state'])
+        position = state['position']
+        with self.lock:  # critical section
+            self.measureCount = position['measure_count']
+            self.chordSequence = position['chord_sequence']
+            self.currentScale = position['current_scale']
+            self.midiMappingIndex = position['midi_mapping_index']
+            self.generationInitialized = position['generation_initialized']
+        # end of critical section
+        if self.generationInitialized:
+            # the scale and the chords of the snapshot are played until the next scale change
+            self.bufferFullEvent.set()
             self.changeScaleDoneEvent.set()
 
+        self.logger.log('snapshot {} restored in {:.1f} ms', path, (time.perf_counter() - start) * 1e3)
+
+    def _update_snapshot(self):
+        """
+        Utility method called after each generated measure, that passes a
+        snapshot to the snapshotWriter every snapshotMeasures measures.
+        """
+        if self.snapshotWriter is None:
+            return
+        self._measuresSinceSnapshot = self._measuresSinceSnapshot + 1
+        if self._measuresSinceSnapshot >= self.snapshotMeasures:
+            self._measuresSinceSnapshot = 0
+            # the chains are exported by the thread of the writer
+            self.snapshotWriter.submit(self._capture_snapshot())
+
+    def _update_tempo(self, start_time):
+        """
+        Utility method that follows the tempo map on the downbeat of a measure.
+        The input notes are parsed with the durations of the new tempo, computed once for each tempo.
+
+        :param start_time: absolute clock time of the downbeat of the measure
+        """
+        bpm = self.tempoMap.bpm_at(self.tempoMap.beat_at(start_time))
+        if bpm != self.bpm:
+            if self.recorder is None:
+                self._set_tempo(bpm)
+            else:
+                # the lock of the recorder is taken before the one of the object
+                with self.recorder.record_tempo(bpm):
+                    self._set_tempo(bpm)
+
+    def _set_tempo(self, bpm):
+        """
+        Utility method that changes the tempo of the input parsing.
+
+        :param bpm: new beats per minutes
+        """
+        with self.lock:  # critical section
+            self.bpm = bpm
+            self.durations = durations(bpm, triplets=False)
+        # end of critical section
+        self.inputParser.set_durations(self.durations)
+
+    def _notify_scale(self, midi_channel, start_time):
+        """
+        Utility method that sends the mode and the root of a new scale through osc, on its first downbeat.
+
+        :param midi_channel: midi channel of the new scale
+        :param start_time: absolute clock time of the first downbeat of the scale
+        """
+        if self.oscClient is not None:
+            root = self.harmonicState.currentMode['root']
+            self._schedule_osc(start_time, [(self.oscAddress, midi_channel - 1), (self.oscPath + '/root', root)])
+
+    def _notify_measure(self, measure):
+        """
+        Utility method that sends the chord, the measure count and the melody notes
+        of a measure through osc, on its downbeat.
+
+        :param measure: dictionary returned by _generate_measure
+        """
+        if self.oscClient is not None:
+            self._schedule_osc(measure['start_time'], [(self.oscPath + '/chord', measure['chord']),
+                                                       (self.oscPath + '/measure', measure['measure_count']),
+                                                       (self.oscPath + '/notes', measure['midi_notes'])])
+
+    def _schedule_osc(self, start_time, messages):
+        """
+        Utility method that schedules osc messages on a downbeat, in advance by the latency offsets of
+        the destinations: the destinations with different offsets receive the messages separately.
+        The messages are timetagged with the wall-clock time of their event.
+
+        :param start_time: absolute clock time of the downbeat
+        :param messages: list of (osc address, value) tuples
+        """
+        send = self.oscClient.send_message
+        latency_groups = getattr(self.oscClient, 'latencyGroups', None)
+        if latency_groups is None:
+            # osc client without latency offsets nor timetags (e.g. the SimpleUDPClient of pythonosc)
+            self.scheduler.schedule_many([(start_time, send, (address, value), 0, None) for address, value in messages])
+            return
+
+        wall_clock_offset = time.time() - self.clock.now()
+        events = []
+        for latency, destinations in latency_groups:
+            deadline = start_time - latency
+            for address, value in messages:
+                events.append((deadline, send, (address, value, destinations, deadline + wall_clock_offset), 0, None))
+        self.scheduler.schedule_many(events)
+
+    def _initialize_generation(self):
+        """
+        Utility method used to train the Markov Chains on the first input notes.
+        """
+        with self.lock:  # critical section
+            measure_count = self.measureCount
+
+            # getting the first chord
+            current_chord = self._degree_to_chord(self.chordSequence[self.measureCount])
+        # end of critical section
+        if self.recorder is not None:
+            self.recorder.record_initialization(measure_count)
+
+        rhythmic_input_sequence, note_input_sequence = self._parse_midi_notes(current_chord)
+
+        # fallback in case the sequences are empty
+        if not rhythmic_input_sequence or not note_input_sequence:
+            metrics.empty_sequences.labels(sequence='initial_input').inc()
+            rhythmic_input_sequence = ['r1']
+            note_input_sequence = ['x']
+
+        self.notesMarkovChain.learn(note_input_sequence)
+        self.rhythmMarkovChain.learn(rhythmic_input_sequence)
+        self.generationInitialized = True
+
+    def _generate_measure(self):
+        """
+        Utility method that parses the input notes, trains the Markov Chains
+        and generates the melody and the chord of the next measure.
+
+        :return: dictionary containing the arguments of Sequencer.play and the generated sequences
+        """
+        generation_start = time.perf_counter()
+
+        # getting the current, first chords and midi channel
+        with self.lock:  # critical section
+            current_chord = self._degree_to_chord(self.chordSequence[self.measureCount])
+            first_chord = self._degree_to_chord('I')
+            midi_channel = self.midiMapping[self.midiMappingIndex]
+            start_time = self.measureStartTime
+            measure_count = self.measureCount
+        # end of critical section
+        if self.recorder is not None:
+            self.recorder.record_measure(start_time, measure_count)
+
+        # parsing the rhythm and the notes
+        rhythmic_input_sequence, note_input_sequence = self._parse_midi_notes(current_chord)
+
+        # training the markov chains
+        if note_input_sequence and rhythmic_input_sequence:
+            self.notesMarkovChain.learn(note_input_sequence)
+            self.rhythmMarkovChain.learn(rhythmic_input_sequence)
+        else:
+            # no input in the last measure, the chains keep their previous training
+            metrics.empty_sequences.labels(sequence='measure_input').inc()
+
+        # generating the new sequences that fits in one measure
+        if self.melodyCandidates > 1:
+            rhythm_generated_sequence, note_generated_sequence, midi_generated_sequence = \
+                self._generate_best_melody(first_chord, current_chord)
+        else:
+            rhythm_generated_sequence = self.rhythmMarkovChain.generate(self.generatedSequenceMaxLength)
+            rhythm_generated_sequence = melodically.clip_rhythmic_sequence(rhythm_generated_sequence, 1)
+            note_generated_sequence = self.notesMarkovChain.generate(len(rhythm_generated_sequence))
+            midi_generated_sequence = self._generate_midi_sequence(note_generated_sequence, first_chord)
+        if not rhythm_generated_sequence:
+            # the clipped sequence is empty, the measure has no melody
+            metrics.empty_sequences.labels(sequence='generated').inc()
+
+        # sequence of note in the format accepted by the sequencer
+        sequencer_input = [{'note': x, 'duration': y} for x, y in
+                           zip(midi_generated_sequence, rhythm_generated_sequence)]
+
+        chord_notes = self._generate_midi_chord(current_chord)
+        metrics.generation_time.observe(time.perf_counter() - generation_start)
+
+        return {
+            'sequence': sequencer_input,
+            'chord_notes': chord_notes,
+            'rhythm_note': self.rhythmMidiNote,
+            'midi_channel': midi_channel,
+            'start_time': start_time,
+            'abstract_melody': note_generated_sequence,
+            'rhythmic_pattern': rhythm_generated_sequence,
+            'midi_notes': midi_generated_sequence,
+            'chord': current_chord,
+            'measure_count': measure_count
+        }
+
+    def _update_scale(self):
+        """
+        Utility method that updates the scale with the mode estimated by the harmonicState,
+        and generates the chord succession of the new scale.
+
+        :return: midi channel of the new scale, absolute clock time of its first downbeat
+        """
+        # markov chain trained on The Beatles chord database, loaded on first use
+        chords_markov_chain = self.chordSampler if self.chordSampler is not None else get_chord_markov_chain()
+
+        with self.lock:  # critical section
+            start_time = self.measureStartTime
+            previous_chords = self.chordSequence
+        # end of critical section
+        if self.recorder is not None:
+            self.recorder.record_scale(start_time)
+        with self._read_input():
+            current_scale = self.harmonicState.get_mode_notes()
+
+        # the chords are sampled outside the critical section, with a pool they are a round trip to a worker
+        chord_sequence = self._sample_chords(chords_markov_chain, previous_chords)
+
+        with self.lock:  # critical section
+            self.chordSequence = chord_sequence
+            self.currentScale = current_scale
+            self.midiMappingIndex = self.harmonicState.currentMode['mode_index']
+            midi_channel = self.midiMapping[self.midiMappingIndex]
+        # end of critical section
+        return midi_channel, start_time
+
+    def _sample_chords(self, chords_markov_chain, previous_chords):
+        """
+        Utility method that samples the chord progression of a new scale. With constraints, the
+        progression follows the previous one, and it is sampled freely if no progression can satisfy them.
+
+        :param chords_markov_chain: ChordMarkovChain or RemoteChordSampler
+        :param previous_chords: chord progression of the previous scale
+        :return: list of chord degrees in roman notation
+        """
+        if self.chordConstraints is not None:
+            try:
+                return chords_markov_chain.sample_constrained(self.measuresForScaleChange,
+                                                              previous=previous_chords,
+                                                              rng=self.rng,
+                                                              **self.chordConstraints)
+            except ValueError as e:
+                self.logger.log('chord constraints ignored after {}: {}', previous_chords, e)
+        return chords_markov_chain.sample(self.measuresForScaleChange, self.rng)
+
     def _parse_midi_notes(self, current_chord):
         """
-        Utility method used to parse the note and rhythmic sequences
-        from the midiNoteQueue.
+        Utility method used to get the note and rhythmic sequences
+        parsed by the inputParser since the last measure.
 
         :param current_chord: chord in melodically notation
         :return: rhythmic_input_sequence, note_input_sequence lists
         """
-        rhythmic_input_sequence = []
-        note_input_sequence = []
-        with self.lock:  # critical section
-            notes = self.midiNoteQueue.get_notes()
-            rhythmic_input_sequence = melodically.parse_rhythm(self.midiNoteQueue, self.durations)
-            note_input_sequence = [melodically.parse_musical_note(note, current_chord) for note in notes]
-            self.midiNoteQueue.clear()  # clearing the note queue
-        # end of the critical section
+        with self._read_input():
+            rhythmic_input_sequence, pitch_classes = self.inputParser.take()
+
+        # the notes are classified on the chord of the measure
+        symbols = self.harmonyTable.pitchClassSymbols[current_chord]
+        note_input_sequence = [symbols[pitch_class] for pitch_class in pitch_classes]
         return rhythmic_input_sequence, note_input_sequence
 
+    def _generate_best_melody(self, chord, current_chord):
+        """
+        Utility method that samples melodyCandidates rhythms and abstract melodies at once,
+        clips them to one measure and returns the one with the best score on the current chord
+        (see melody_scoring.score_melodies).
+
+        :param chord: chord in melodically notation used to generate the midi notes
+        :param current_chord: chord in melodically notation played in the measure
+        :return: rhythmic sequence, abstract melody and midi notes of the best candidate
+        """
+        count = self.melodyCandidates
+        rhythm_symbols, rhythm_indices = self.rhythmMarkovChain.generate_batch(count, self.generatedSequenceMaxLength)
+        durations, rests = melody_scoring.rhythm_table(tuple(rhythm_symbols))
+        lengths, filled = melody_scoring.clip_lengths(durations[rhythm_indices])
+
+        length = int(lengths.max())
+        note_symbols, note_indices = self.notesMarkovChain.generate_batch(count, length)
+        if note_indices.shape[1] < length:
+            return [], [], []  # the notes chain is empty
+
+        midi_notes = self.harmonyTable.melody_batch(melody_scoring.class_table(tuple(note_symbols))[note_indices], chord,
+                                                    self.rng)
+        scores = melody_scoring.score_melodies(midi_notes, rests[rhythm_indices[:, :length]], lengths, filled,
+                                               self.harmonyTable.chordPitchClasses[current_chord])
+
+        best = int(np.argmax(scores))
+        length = int(lengths[best])
+        return ([rhythm_symbols[i] for i in rhythm_indices[best, :length].tolist()],
+                [note_symbols[i] for i in note_indices[best, :length].tolist()],
+                midi_notes[best, :length].tolist())
+
     def _generate_midi_sequence(self, note_sequence, chord):
         """
         Utility method used to generate a midi sequence from an abstract
@@ -449,18 +1042,7 @@ class MuseEchoes:
         :param chord: chord in melodically notation
         :return: midi sequence of the melody
         """
-        c_tones = melodically.chord_tones[chord]['c']
-        l_tones = melodically.chord_tones[chord]['l']
-        result = []
-        for note in note_sequence:
-            if note == 'c':  # chord tone
-                result.append(self._midi_random_note_pick(c_tones))
-            elif note == 'l':  # color tone
-                result.append(self._midi_random_note_pick(l_tones))
-            else:  # random tone
-                result.append(self._midi_random_note_pick(melodically.musical_notes))
-
-        return result
+        return self.harmonyTable.melody(note_sequence, chord, self.rng)
 
     def _generate_midi_chord(self, chord):
         """
@@ -470,20 +1052,7 @@ class MuseEchoes:
         :param chord: chord in melodically notation
         :return: list of notes composing the chord
         """
-        random_octaves = [random.randint(self.chordOctaveRange[0], self.chordOctaveRange[1]) for i in range(4)]
-        return melodically.chord_to_midi(chord, random_octaves)
-
-    def _midi_random_note_pick(self, note_collection):
-        """
-        Utility method used to pick a random note from a note_collection,
-        generating a midi note between the octaves specified in the
-        melodyOctaveRange method.
-
-        :param note_collection: list of notes in std notation
-        :return: midi value of the picked note
-        """
-        return melodically.std_to_midi(random.choice(note_collection),
-                                       random.randint(self.melodyOctaveRange[0], self.melodyOctaveRange[1]))
+        return self.harmonyTable.chord_voicing(chord, self.rng)
 
     def _degree_to_chord(self, degree):
         """
@@ -493,9 +1062,5 @@ class MuseEchoes:
         :param degree: chord degree in roman notation
         :return: chord in melodically notation
         """
-        degree_number = degrees.index(degree)
         current_mode = self.harmonicState.currentMode
-        root = current_mode['root']
-        mode_index = current_mode['mode_index']
-        chord = melodically.modes_chords_dict[root][mode_index][degree_number]
-        return chord
+        return self.harmonyTable.chord(current_mode['root'], current_mode['mode_index'], degree)
@@ -0,0 +1,256 @@
+import time
+import asyncio
+import threading
+from collections import deque
+from collections.abc import Iterable
+from pythonosc.osc_message_builder import OscMessageBuilder
+from pythonosc.osc_bundle_builder import OscBundleBuilder
+from muses_echoes import metrics
+
+"""
+Non-blocking osc output.
+
+The messages are queued by the music threads and sent by an asyncio loop
+running in its own thread, packed in timestamped osc bundles and sent to
+all the destinations. The queue is bounded: under backpressure the oldest
+messages are dropped, and a destination that can't keep up skips frames,
+so the music threads never wait for the network.
+"""
+
+# max size in bytes of a bundle (a frame with more messages is split)
+_MAX_DATAGRAM = 8192
+
+# bytes of a bundle besides its messages: the #bundle string and the timetag, then the size of each message
+_BUNDLE_HEADER_SIZE = 16
+_ELEMENT_SIZE = 4
+
+# seconds waited before retrying to open an unreachable destination
+_RETRY_TIME = 1.0
+
+
+class OscOutput:
+    """
+    Osc client sending bundles to many destinations from an asyncio loop.
+    It can replace the SimpleUDPClient of pythonosc.
+
+    With a rate, the queued messages are sent as one frame (a bundle) at a fixed
+    frequency; without a rate, each message wakes up the loop and is sent at once.
+    The messages are packed in bundles by timetag: the wall-clock time of their
+    event, or the time they were queued if they don't have one.
+
+    The destinations can have latency offsets (e.g. the rendering of the visuals):
+    the destinations sharing the same offset form a group, listed in latencyGroups,
+    and a message can be sent to the destinations of a single group.
+    """
+
+    def __init__(self, destinations, rate=None, queue_size=256, max_buffer=65536, latencies=None):
+        """
+        Constructor.
+
+        :param destinations: list of (ip, port) tuples receiving all the messages
+        :param rate: frames per second, if None the messages are sent as soon as they are queued
+        :param queue_size: max number of queued messages, the oldest ones are dropped when it is full
+        :param max_buffer: bytes waiting in the socket of a destination above which its frames are dropped
+        :param latencies: dictionary of the latency offsets in seconds by (ip, port) tuple, None disables them
+        """
+        self.destinations = [tuple(destination) for destination in destinations]
+        self.rate = rate
+        self.maxBuffer = max_buffer
+
+        # (latency offset, tuple of destinations) tuples, the destinations are None if all of them share the offset
+        latencies = latencies if latencies is not None else {}
+        groups = {}
+        for destination in self.destinations:
+            groups.setdefault(latencies.get(destination, 0.0), []).append(destination)
+        if len(groups) == 1:
+            self.latencyGroups = [(latency, None) for latency in groups]
+        else:
+            self.latencyGroups = [(latency, tuple(group)) for latency, group in groups.items()]
+
+        # queue of (address, value, destinations, timetag) tuples, appended by the music threads
+        self._queue = deque(maxlen=queue_size)
+
+        # statistics
+        self.droppedMessages = 0
+        self.sentFrames = 0
+        self.droppedFrames = {destination: 0 for destination in self.destinations}
+
+        # metrics of the output
+        self.droppedCounter = metrics.osc_dropped.labels(stage='queue')
+        self.droppedFrameCounter = metrics.osc_dropped.labels(stage='destination')
+
+        # udp transports of the destinations, None until they are opened
+        self._transports = {destination: None for destination in self.destinations}
+
+        # tasks opening the transports
+        self._openTasks = []
+
+        self._loop = asyncio.new_event_loop()
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self._ready.wait()
+
+    def send_message(self, address, value, destinations=None, timetag=None):
+        """
+        Queues a message, without blocking.
+
+        :param address: osc address
+        :param value: argument of the message, or list of arguments
+        :param destinations: tuple of the (ip, port) destinations of the message (see latencyGroups), None sends it to all of them
+        :param timetag: wall-clock time of the event of the message (as time.time()), if None the current time is used
+        """
+        if len(self._queue) == self._queue.maxlen:
+            self.droppedMessages = self.droppedMessages + 1
+            self.droppedCounter.inc()
+        self._queue.append((address, value, destinations, timetag if timetag is not None else time.time()))
+        if self.rate is None:
+            self._loop.call_soon_threadsafe(self._flush)
+
+    def get_stats(self):
+        """
+        Gets the statistics of the output.
+
+        sent_frames: number of frames sent to at least one destination
+        dropped_messages: messages dropped because the queue was full
+        dropped_frames: frames dropped for each destination, because it was not reachable or too slow
+
+        :return: dictionary of statistics
+        """
+        return {
+            'sent_frames': self.sentFrames,
+            'dropped_messages': self.droppedMessages,
+            'dropped_frames': {'{}:{}'.format(*d): count for d, count in self.droppedFrames.items()}
+        }
+
+    def close(self):
+        """
+        Sends the queued messages and stops the loop.
+        """
+        def stop():
+            self._flush()
+            for task in self._openTasks:
+                task.cancel()
+            for transport in self._transports.values():
+                if transport is not None:
+                    transport.close()
+            self._loop.stop()
+        self._loop.call_soon_threadsafe(stop)
+        self._thread.join()
+
+    def _run(self):
+        """
+        Thread running the asyncio loop.
+        """
+        asyncio.set_event_loop(self._loop)
+        self._openTasks = [self._loop.create_task(self._open(destination)) for destination in self.destinations]
+        if self.rate is not None:
+            self._loop.call_soon(self._tick)
+        self._loop.call_soon(self._ready.set)
+        self._loop.run_forever()
+        # letting the cancelled tasks end before closing the loop
+        self._loop.run_until_complete(asyncio.gather(*self._openTasks, return_exceptions=True))
+        self._loop.close()
+
+    async def _open(self, destination):
+        """
+        Opens the transport of a destination, retrying until it succeeds.
+        The host name is resolved here, in the loop.
+
+        :param destination: (ip, port) tuple
+        """
+        logged = False
+        while True:
+            try:
+                transport, _ = await self._loop.create_datagram_endpoint(asyncio.DatagramProtocol,
+                                                                         remote_addr=destination)
+                self._transports[destination] = transport
+                return
+            except OSError as e:
+                if not logged:
+                    metrics.get_logger().log('osc destination {}:{} not available: {}', *destination, e)
+                    logged = True
+                await asyncio.sleep(_RETRY_TIME)
+
+    def _tick(self):
+        """
+        Sends a frame and schedules the next one.
+        """
+        self._flush()
+        self._loop.call_later(1 / self.rate, self._tick)
+
+    def _flush(self):
+        """
+        Sends the queued messages to their destinations.
+        """
+        if not self._queue:
+            return
+
+        # messages of the frame by destinations and timetag, the messages sent to all the destinations have the None key
+        frames = {}
+        while self._queue:
+            address, value, destinations, timetag = self._queue.popleft()
+            frames.setdefault((destinations, timetag), []).append(self._build_message(address, value))
+
+        # the destinations dropping the frame, each one counted once
+        dropped = set()
+        sent = False
+        for (destinations, timetag), messages in frames.items():
+            datagrams = self._build_datagrams(messages, timetag)
+            for destination in destinations if destinations is not None else self.destinations:
+                transport = self._transports[destination]
+                if transport is None or transport.get_write_buffer_size() > self.maxBuffer:
+                    # the destination is not reachable yet or can't keep up
+                    dropped.add(destination)
+                    continue
+                for datagram in datagrams:
+                    transport.sendto(datagram)
+                sent = True
+        for destination in dropped:
+            self.droppedFrames[destination] = self.droppedFrames[destination] + 1
+            self.droppedFrameCounter.inc()
+        if sent:
+            self.sentFrames = self.sentFrames + 1
+
+    @staticmethod
+    def _build_datagrams(messages, timestamp):
+        """
+        Utility method that packs messages in bundles, splitting the bundles larger than a datagram.
+        A single message larger than a datagram is sent alone in its bundle.
+
+        :param messages: list of OscMessage objects
+        :param timestamp: timetag of the bundles
+        :return: list of datagrams
+        """
+        datagrams = []
+        bundle = OscBundleBuilder(timestamp)
+        size = _BUNDLE_HEADER_SIZE
+        for message in messages:
+            element_size = _ELEMENT_SIZE + message.size
+            if size > _BUNDLE_HEADER_SIZE and size + element_size > _MAX_DATAGRAM:
+                datagrams.append(bundle.build().dgram)
+                bundle = OscBundleBuilder(timestamp)
+                size = _BUNDLE_HEADER_SIZE
+            bundle.add_content(message)
+            size = size + element_size
+        datagrams.append(bundle.build().dgram)
+        return datagrams
+
+    @staticmethod
+    def _build_message(address, value):
+        """
+        Utility method that builds an osc message, as SimpleUDPClient.send_message.
+
+        :param address: osc address
+        :param value: argument of the message, or list of arguments
+        :return: OscMessage object
+        """
+        builder = OscMessageBuilder(address=address)
+        if value is None:
+            pass
+        elif not isinstance(value, Iterable) or isinstance(value, (str, bytes)):
+            builder.add_arg(value)
+        else:
+            for v in value:
+                builder.add_arg(v)
+        return builder.build()
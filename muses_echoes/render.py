@@ -0,0 +1,90 @@
+import sys
+import time
+import mido
+from muses_echoes.muses import MuseEchoes
+from muses_echoes.sequencer import MidiFileSequencer
+from muses_echoes.input_parser import NOTE_ON, NOTE_OFF
+
+"""
+Offline rendering of Muses' Echoes.
+
+The generation pipeline runs on a virtual clock as fast as the CPU allows,
+without midi ports, osc and wall-clock sleeps, and the melody, chord and
+rhythm parts are written as the tracks of a Standard MIDI File.
+
+usage: python -m muses_echoes.render [input midi file] [output midi file] [measures] [seed]
+"""
+
+
+def midi_file_records(path):
+    """
+    Reads the note messages of a midi file as input records.
+
+    :param path: path of the midi file
+    :return: list of (type, note, velocity, timestamp) tuples sorted by timestamp
+    """
+    records = []
+    timestamp = 0.0
+    for msg in mido.MidiFile(path):
+        timestamp = timestamp + msg.time
+        if msg.type == 'note_on' or msg.type == 'note_off':
+            msg_type = NOTE_ON if msg.type == 'note_on' and msg.velocity > 0 else NOTE_OFF
+            records.append((msg_type, msg.note, msg.velocity, timestamp))
+    return records
+
+
+def note_list_records(notes, velocity=64):
+    """
+    Converts a list of notes into input records.
+
+    :param notes: list of (onset, midi note, duration) tuples, with onsets and durations in seconds
+    :param velocity: velocity of the notes
+    :return: list of (type, note, velocity, timestamp) tuples sorted by timestamp
+    """
+    records = []
+    for onset, note, duration in notes:
+        records.append((NOTE_ON, note, velocity, onset))
+        records.append((NOTE_OFF, note, 0, onset + duration))
+    records.sort(key=lambda r: (r[3], r[0]))
+    return records
+
+
+def render(input_records, measures, output_path=None, **kwargs):
+    """
+    Renders a number of measures from a list of input records.
+
+    :param input_records: list of (type, note, velocity, timestamp) tuples sorted by timestamp
+    :param measures: number of measures to render
+    :param output_path: path of the midi file to write, if None the file is not written
+    :param kwargs: additional parameters of the MuseEchoes constructor
+    :return: (mido.MidiFile, measures per second) tuple
+    """
+    bpm = kwargs.pop('bpm', 74)
+    sequencer = MidiFileSequencer(bpm=bpm)
+    muses = MuseEchoes(midi_in_port=None,
+                       midi_sequence_out_port=None,
+                       midi_chord_out_port=None,
+                       midi_rhythm_out_port=None,
+                       osc_ip=None,
+                       bpm=bpm,
+                       sequencer=sequencer,
+                       **kwargs)
+
+    start = time.perf_counter()
+    muses.render(input_records, measures)
+    elapsed = time.perf_counter() - start
+
+    midi_file = sequencer.to_midi_file()
+    if output_path is not None:
+        midi_file.save(output_path)
+    return midi_file, measures / elapsed if elapsed > 0 else float('inf')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) <= 3:
+        print('usage: python -m muses_echoes.render [input midi file] [output midi file] [measures] [seed]')
+        exit(-1)
+
+    seed = int(sys.argv[4]) if len(sys.argv) > 4 else None
+    _, throughput = render(midi_file_records(sys.argv[1]), int(sys.argv[3]), sys.argv[2], seed=seed)
+    print('rendered {} measures in {} ({:.1f} measures per second)'.format(sys.argv[3], sys.argv[2], throughput))
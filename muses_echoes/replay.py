@@ -0,0 +1,444 @@
+import sys
+import json
+import time
+import struct
+import threading
+from contextlib import contextmanager
+import numpy as np
+from muses_echoes.muses import MuseEchoes
+from muses_echoes.sequencer import MidiFileSequencer
+from muses_echoes.generation_pool import GenerationPool
+from muses_echoes.tempo import CONSTANT, LINEAR, EXPONENTIAL
+
+"""
+Deterministic record and replay of the sessions.
+
+A SessionRecorder logs, in a compact binary file, the parameters and the seed
+of a MuseEchoes object, its timestamped input messages and the steps of the
+generation (scale changes and measures), in the order in which they were seen
+by the generation, together with the changes of the tempo map and of the tempo
+of the input parsing. The replay feeds the log to a new MuseEchoes on a virtual
+clock: the random generator starts from the same seed and the input reaches
+the generation between the same steps, so the output is bit-identical to the
+recorded one, and the time spent on each measure can be profiled and compared
+between versions on the exact same performance.
+
+usage: python -m muses_echoes.replay [session log] [output midi file] [timings json file]
+"""
+
+# first bytes of a session log
+_MAGIC = b'MELG'
+
+# version of the log format
+_VERSION = 1
+
+# version and length of the json header, following the magic bytes
+_header_struct = struct.Struct('<HI')
+
+# kind, type, note, velocity, count and time of a log entry
+_entry_struct = struct.Struct('<BBBBId')
+
+# numpy type of a log entry, with the same layout of _entry_struct
+entry_dtype = np.dtype([
+    ('kind', np.uint8),
+    ('type', np.uint8),
+    ('note', np.uint8),
+    ('velocity', np.uint8),
+    ('count', '<u4'),
+    ('time', '<f8')
+])
+
+# kinds of the log entries
+INPUT = 0  # input message, with its type, note, velocity and timestamp
+READ = 1  # the generation reads the parsed input
+SCALE = 2  # scale change, with the downbeat of the new scale
+INITIALIZATION = 3  # first training of the markov chains, with the measure count
+MEASURE = 4  # generation of a measure, with its downbeat and the measure count
+TEMPO = 5  # tempo change of the input parsing, with the new bpm
+TEMPO_SEGMENT = 6  # field of a new segment of the tempo map, with the curve, the index of the field and its value
+
+# fields of a segment of the tempo map, each one in its own TEMPO_SEGMENT entry
+_segment_fields = ('start_beat', 'start_time', 'start_bpm', 'rate')
+
+# curves of the tempo segments, by their code in the TEMPO_SEGMENT entries
+_curves = (CONSTANT, LINEAR, EXPONENTIAL)
+
+
+class SessionRecorder:
+    """
+    Recorder of a MuseEchoes session, passed to its constructor.
+
+    The entries are appended to a memory buffer, written to the file
+    once per measure. The input messages and the reads of the parsed
+    input share a lock, so that the log keeps the order in which the
+    input is applied by the input thread and read by the generation.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor.
+
+        :param path: path of the session log
+        """
+        self.path = path
+
+        # lock ordering the entries written by the input and the generation threads
+        self.lock = threading.Lock()
+
+        # entries not written to the file yet
+        self._buffer = bytearray()
+
+        self._file = open(path, 'wb')
+
+    def write_header(self, parameters):
+        """
+        Writes the parameters of the session at the beginning of the log.
+
+        :param parameters: json serializable dictionary of the MuseEchoes parameters, including the seed
+        """
+        header = json.dumps(parameters).encode('utf-8')
+        self._file.write(_MAGIC + _header_struct.pack(_VERSION, len(header)) + header)
+        self._file.flush()
+
+    @contextmanager
+    def record_input(self, msg_type, note, velocity, timestamp):
+        """
+        Records an input message, that must be applied inside the context.
+
+        :param msg_type: NOTE_ON or NOTE_OFF
+        :param note: midi note value
+        :param velocity: midi velocity value
+        :param timestamp: timestamp of the message in seconds
+        """
+        with self.lock:  # critical section
+            self._buffer += _entry_struct.pack(INPUT, msg_type, note, velocity, 0, timestamp)
+            yield
+        # end of critical section
+
+    @contextmanager
+    def sync(self):
+        """
+        Records a read of the parsed input, that must be done inside the context.
+        """
+        with self.lock:  # critical section
+            self._buffer += _entry_struct.pack(READ, 0, 0, 0, 0, 0.0)
+            yield
+        # end of critical section
+
+    @contextmanager
+    def record_tempo(self, bpm):
+        """
+        Records a tempo change of the input parsing, that must be applied inside the context.
+
+        :param bpm: new beats per minutes
+        """
+        with self.lock:  # critical section
+            self._buffer += _entry_struct.pack(TEMPO, 0, 0, 0, 0, bpm)
+            yield
+        # end of critical section
+
+    def record_tempo_segments(self, segments):
+        """
+        Records the new segments of a change of the tempo map, used as a listener of the TempoMap.
+
+        :param segments: list of [start beat, start time, start bpm, curve, rate] lists (see TempoMap.get_segments)
+        """
+        with self.lock:  # critical section
+            for start_beat, start_time, start_bpm, curve, rate in segments:
+                for field, value in enumerate((start_beat, start_time, start_bpm, rate)):
+                    self._buffer += _entry_struct.pack(TEMPO_SEGMENT, _curves.index(curve), field, 0, 0, value)
+        # end of critical section
+
+    def record_scale(self, start_time):
+        """
+        Records a scale change.
+
+        :param start_time: absolute clock time of the first downbeat of the scale
+        """
+        self._record(SCALE, 0, start_time)
+
+    def record_initialization(self, measure_count):
+        """
+        Records the first training of the markov chains.
+
+        :param measure_count: measure counter of the MuseEchoes object
+        """
+        self._record(INITIALIZATION, measure_count, 0.0)
+
+    def record_measure(self, start_time, measure_count):
+        """
+        Records the generation of a measure.
+
+        :param start_time: absolute clock time of the downbeat of the measure
+        :param measure_count: measure counter of the MuseEchoes object
+        """
+        self._record(MEASURE, measure_count, start_time)
+
+    def flush(self):
+        """
+        Writes the buffered entries to the file.
+        """
+        with self.lock:  # critical section
+            data = bytes(self._buffer)
+            self._buffer.clear()
+        # end of critical section
+        if data:
+            self._file.write(data)
+            self._file.flush()
+
+    def close(self):
+        """
+        Writes the buffered entries and closes the file.
+        """
+        self.flush()
+        self._file.close()
+
+    def _record(self, kind, count, timestamp):
+        """
+        Utility method that appends a generation step to the buffer.
+
+        :param kind: kind of the entry
+        :param count: measure count
+        :param timestamp: time of the entry in seconds
+        """
+        with self.lock:  # critical section
+            self._buffer += _entry_struct.pack(kind, 0, 0, 0, count, timestamp)
+        # end of critical section
+
+
+def read_log(path):
+    """
+    Reads a session log.
+
+    :param path: path of the session log
+    :return: (parameters dictionary, numpy array of entries with entry_dtype) tuple
+    """
+    with open(path, 'rb') as log_file:
+        data = log_file.read()
+    if data[:len(_MAGIC)] != _MAGIC:
+        raise ValueError('{} is not a session log'.format(path))
+    offset = len(_MAGIC)
+    version, header_length = _header_struct.unpack_from(data, offset)
+    if version != _VERSION:
+        raise ValueError('unsupported session log version {}'.format(version))
+    offset = offset + _header_struct.size
+    parameters = json.loads(data[offset:offset + header_length].decode('utf-8'))
+    offset = offset + header_length
+    # an incomplete last entry (the session was killed while writing) is ignored
+    count = (len(data) - offset) // entry_dtype.itemsize
+    entries = np.frombuffer(data, dtype=entry_dtype, count=count, offset=offset)
+    return parameters, entries
+
+
+class _LogPlayer:
+    """
+    Replays the entries of a session log, replacing the recorder of a MuseEchoes object.
+    The generation steps are run in the order of the log, and the input
+    messages are pushed when the generation reads the parsed input.
+    The tempo changes are applied at their position in the log.
+    """
+
+    def __init__(self, entries):
+        """
+        Constructor.
+
+        :param entries: numpy array of log entries
+        """
+        self.entries = entries.tolist()
+        self.muses = None
+
+        # index of the next entry
+        self._cursor = 0
+
+        # time origin of the replay, the first generation step starts from time 0
+        steps = entries[(entries['kind'] == SCALE) | (entries['kind'] == MEASURE)]
+        self._origin = float(steps['time'].min()) if len(steps) > 0 else 0.0
+
+        # values of the fields of the tempo segment being read
+        self._segmentValues = []
+
+    def load_tempo_map(self, segments):
+        """
+        Replaces the tempo map of the replay with the one recorded in the header, moved to the time origin of the replay.
+
+        :param segments: list of [start beat, start time, start bpm, curve, rate] lists (see TempoMap.get_segments)
+        """
+        self.muses.tempoMap.replace_segments(segments, -self._origin)
+
+    def write_header(self, parameters):
+        pass
+
+    @contextmanager
+    def record_input(self, msg_type, note, velocity, timestamp):
+        yield
+
+    @contextmanager
+    def record_tempo(self, bpm):
+        yield
+
+    def record_tempo_segments(self, segments):
+        pass
+
+    @contextmanager
+    def sync(self):
+        """
+        Pushes the input messages and applies the tempo changes preceding the next read.
+        """
+        while self._cursor < len(self.entries):
+            kind, msg_type, note, velocity, _, timestamp = self.entries[self._cursor]
+            self._cursor = self._cursor + 1
+            if kind == READ:
+                break
+            if kind == INPUT:
+                self.muses.push_input(msg_type, note, velocity, timestamp)
+            elif kind == TEMPO or kind == TEMPO_SEGMENT:
+                self._apply_tempo(kind, msg_type, note, timestamp)
+            else:
+                raise ValueError('the session log is out of order at entry {}'.format(self._cursor - 1))
+        yield
+
+    def _apply_tempo(self, kind, curve, field, value):
+        """
+        Utility method that applies a TEMPO entry, or a field of a TEMPO_SEGMENT entry.
+        The segments are applied to the tempo map when their last field is read.
+
+        :param kind: TEMPO or TEMPO_SEGMENT
+        :param curve: code of the curve of the segment
+        :param field: index of the field of the segment
+        :param value: bpm of the input parsing, or value of the field
+        """
+        if kind == TEMPO:
+            self.muses._set_tempo(value)
+            return
+        if field != len(self._segmentValues):
+            raise ValueError('the session log is out of order at entry {}'.format(self._cursor - 1))
+        self._segmentValues.append(value)
+        if len(self._segmentValues) == len(_segment_fields):
+            start_beat, start_time, start_bpm, rate = self._segmentValues
+            self._segmentValues = []
+            self.muses.tempoMap.replace_segments([[start_beat, start_time, start_bpm, _curves[curve], rate]],
+                                                 -self._origin)
+
+    def record_scale(self, start_time):
+        pass
+
+    def record_initialization(self, measure_count):
+        pass
+
+    def record_measure(self, start_time, measure_count):
+        pass
+
+    def flush(self):
+        pass
+
+    def run(self):
+        """
+        Runs the generation steps of the log, measuring the time spent on each measure.
+        The time of the scale changes and of the first training is added to the following measure.
+
+        :return: list of the measures generated by _generate_measure, with their processing_time in seconds
+        """
+        muses = self.muses
+        result = []
+        processing_time = 0.0
+        while self._cursor < len(self.entries):
+            kind, msg_type, note, velocity, count, timestamp = self.entries[self._cursor]
+            self._cursor = self._cursor + 1
+            start = time.perf_counter()
+            if kind == INPUT:
+                muses.push_input(msg_type, note, velocity, timestamp)
+                continue
+            elif kind == TEMPO or kind == TEMPO_SEGMENT:
+                self._apply_tempo(kind, msg_type, note, timestamp)
+                continue
+            elif kind == SCALE:
+                with muses.lock:  # critical section
+                    muses.measureStartTime = timestamp - self._origin
+                # end of critical section
+                muses._update_scale()
+            elif kind == INITIALIZATION:
+                with muses.lock:  # critical section
+                    muses.measureCount = count
+                # end of critical section
+                muses._initialize_generation()
+            elif kind == MEASURE:
+                with muses.lock:  # critical section
+                    muses.measureStartTime = timestamp - self._origin
+                    muses.measureCount = count
+                # end of critical section
+                generated = muses._generate_measure()
+                muses.sequencer.play(generated['sequence'], generated['chord_notes'], generated['rhythm_note'],
+                                     generated['midi_channel'], generated['start_time'])
+                generated['processing_time'] = processing_time + time.perf_counter() - start
+                result.append(generated)
+                processing_time = 0.0
+                continue
+            else:
+                raise ValueError('the session log is out of order at entry {}'.format(self._cursor - 1))
+            processing_time = processing_time + time.perf_counter() - start
+        return result
+
+
+def replay(path, output_path=None, generation_pool=None):
+    """
+    Replays a session log on a virtual clock, as fast as the CPU allows.
+
+    :param path: path of the session log
+    :param output_path: path of the midi file to write, if None the file is not written
+    :param generation_pool: GenerationPool used if the session was recorded with one, if None a pool is created when needed
+    :return: (mido.MidiFile, list of the generated measures with their processing_time) tuple
+    """
+    parameters, entries = read_log(path)
+    if parameters.pop('restored_snapshot', False):
+        raise ValueError('{} was recorded after restoring a snapshot, it can\'t be replayed'.format(path))
+    tempo_segments = parameters.pop('tempo_segments', None)
+    # the corrections of the midi clock are replayed from the changes of the tempo map
+    parameters.pop('midi_clock', None)
+    player = _LogPlayer(entries)
+
+    # the remote chains are seeded differently from the local ones
+    own_pool = None
+    if parameters.pop('remote_generation') and generation_pool is None:
+        generation_pool = own_pool = GenerationPool(1)
+    try:
+        sequencer = MidiFileSequencer(bpm=parameters['bpm'])
+        muses = MuseEchoes(midi_in_port=None,
+                           midi_sequence_out_port=None,
+                           midi_chord_out_port=None,
+                           midi_rhythm_out_port=None,
+                           osc_ip=None,
+                           sequencer=sequencer,
+                           generation_pool=generation_pool,
+                           recorder=player,
+                           **parameters)
+        # the timestamps of the input records are not from this run, the input latency is meaningless
+        muses.inputLatency = None
+        player.muses = muses
+        if tempo_segments is not None:
+            player.load_tempo_map(tempo_segments)
+        measures = player.run()
+    finally:
+        if own_pool is not None:
+            own_pool.close()
+
+    midi_file = sequencer.to_midi_file()
+    if output_path is not None:
+        midi_file.save(output_path)
+    return midi_file, measures
+
+
+if __name__ == '__main__':
+    if len(sys.argv) <= 2:
+        print('usage: python -m muses_echoes.replay [session log] [output midi file] [timings json file]')
+        exit(-1)
+
+    _, replayed = replay(sys.argv[1], sys.argv[2])
+    timings = [m['processing_time'] for m in replayed]
+    if len(sys.argv) > 3:
+        with open(sys.argv[3], 'w') as timings_file:
+            json.dump(timings, timings_file, indent=2)
+    if timings:
+        print('replayed {} measures in {}: mean {:.1f} us, max {:.1f} us'.format(
+            len(timings), sys.argv[2], np.mean(timings) * 1e6, np.max(timings) * 1e6))
+    else:
+        print('no measures in {}'.format(sys.argv[1]))
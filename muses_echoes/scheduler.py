@@ -0,0 +1,156 @@
+import heapq
+import itertools
+import threading
+from muses_echoes.clock import Clock
+from muses_echoes import metrics
+
+
+class Scheduler:
+    """
+    Event queue served by a single timing thread.
+
+    The events are callbacks with an absolute clock deadline, kept in a
+    priority heap. The timing thread sleeps on a condition variable until
+    shortly before the earliest deadline (waking up earlier if a new event
+    is pushed in front of the heap), then waits for the exact deadline on
+    the shared Clock and executes the callback.
+    Events with the same deadline are executed by ascending priority, and
+    then in the order they were scheduled.
+    A failing callback (e.g. a closed port) is logged and skipped, so that
+    the timing thread keeps serving the other events.
+    """
+
+    def __init__(self, clock=None):
+        """
+        Constructor.
+
+        :param clock: Clock used to wait for the deadlines, if None a new one is created
+        """
+
+        # clock used to wait the deadlines
+        self.clock = clock if clock is not None else Clock()
+
+        # heap of (deadline, priority, counter, stream, callback, args) tuples
+        self._heap = []
+
+        # tie breaker preserving the scheduling order of simultaneous events
+        self._counter = itertools.count()
+
+        # condition used to wake up the timing thread when the heap changes
+        self._condition = threading.Condition()
+
+        # flag used to stop the timing thread
+        self._running = False
+
+        # timing thread
+        self._thread = None
+
+        # histograms of the send lateness for each stream
+        self._lateness = {}
+
+        # number of callbacks that raised an exception
+        self.errors = 0
+
+        self.logger = metrics.get_logger()
+
+    def start(self):
+        """
+        Starts the timing thread, if it is not already running.
+        """
+        with self._condition:  # critical section
+            if self._running:
+                return
+            self._running = True
+            self._thread = threading.Thread(target=self._run)
+        # end of critical section
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stops the timing thread, discarding the pending events.
+        """
+        with self._condition:  # critical section
+            self._running = False
+            self._heap = []
+            self._condition.notify()
+        # end of critical section
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+
+    def schedule(self, deadline, callback, args=(), priority=0, stream=None):
+        """
+        Pushes a new event in the queue.
+
+        :param deadline: absolute clock time of the event
+        :param callback: function called at the deadline
+        :param args: tuple of arguments passed to the callback
+        :param priority: events with the same deadline are executed by ascending priority
+        :param stream: optional name of the event stream used for the clock statistics
+        """
+        with self._condition:  # critical section
+            event = (deadline, priority, next(self._counter), stream, callback, args)
+            heapq.heappush(self._heap, event)
+            if self._heap[0] is event:
+                # the new event is the earliest one
+                self._condition.notify()
+        # end of critical section
+
+    def schedule_many(self, events):
+        """
+        Pushes a batch of events in the queue, acquiring the lock only once.
+
+        :param events: iterable of (deadline, callback, args, priority, stream) tuples
+        """
+        with self._condition:  # critical section
+            for deadline, callback, args, priority, stream in events:
+                heapq.heappush(self._heap, (deadline, priority, next(self._counter), stream, callback, args))
+            self._condition.notify()
+        # end of critical section
+
+    def pending(self):
+        """
+        Number of events waiting in the queue.
+
+        :return: integer
+        """
+        with self._condition:  # critical section
+            return len(self._heap)
+        # end of critical section
+
+    def _run(self):
+        """
+        Timing thread loop.
+        """
+        spin_threshold = self.clock.spinThreshold
+        while True:
+            with self._condition:  # critical section
+                while True:
+                    if not self._running:
+                        return
+                    if not self._heap:
+                        self._condition.wait()
+                        continue
+                    remaining = self._heap[0][0] - self.clock.now()
+                    if remaining > spin_threshold:
+                        # sleeping until the spin phase, a new earlier event wakes the thread up
+                        self._condition.wait(remaining - spin_threshold)
+                        continue
+                    deadline, _, _, stream, callback, args = heapq.heappop(self._heap)
+                    break
+            # end of critical section
+
+            self.clock.wait_until(deadline, stream)
+            try:
+                callback(*args)
+            except Exception as e:  # a failing event must never stop the timing thread
+                self.errors = self.errors + 1
+                self.logger.log('scheduled event of {} failed: {!r}', stream if stream is not None else 'scheduler', e)
+                continue
+
+            if stream is not None:
+                # time between the deadline and the end of the callback (i.e. the actual send time)
+                lateness = self._lateness.get(stream)
+                if lateness is None:
+                    lateness = metrics.send_lateness.labels(stream=stream)
+                    self._lateness[stream] = lateness
+                lateness.observe(self.clock.now() - deadline)
@@ -1,125 +1,386 @@
 import melodically
-import threading
 import mido
-import time
+from muses_echoes.clock import Clock
+from muses_echoes.scheduler import Scheduler
+from muses_echoes.tempo import TempoMap
+
+# priorities of the events sharing the same deadline
+# (a note_off must always precede the note_on of the following measure)
+_NOTE_OFF_PRIORITY = 0
+_NOTE_ON_PRIORITY = 1
+
+# velocity of the notes (the default of mido)
+_VELOCITY = 64
 
 
 class Sequencer:
-    def __init__(self, sequence_port, chord_port, rhythm_port, bpm=74):
-        # TODO: comments
-        self.sequenceOutPort = sequence_port
-        self.chordOutPort = chord_port
-        self.rhythmOutPort = rhythm_port
-        self.bpm = bpm
-        self.midiChannel = 0
-        self.durations = melodically.get_durations(self.bpm)
-        self.thread1 = threading.Thread(target=self.run_sequences)
-        self.thread2 = threading.Thread(target=self.run_chords)
-        self.thread3 = threading.Thread(target=self.run_rhythm)
-        self.playSequenceEvent = threading.Event()
-        self.playChordEvent = threading.Event()
-        self.playRhythmEvent = threading.Event()
-        self.lock = threading.Lock()
-        self.sequence = []
-        self.chord_notes = []
-        self.rhythmNote = 24
-
-        self.thread1.start()
-        self.thread2.start()
-        self.thread3.start()
-
-    def set_bpm(self, bpm):
-        self.durations = melodically.get_durations(bpm)
-        self.bpm = bpm
-
-    def play(self, sequence, chord_notes, rhythm_note, midi_channel):
-        # critical section
-        with self.lock:
-            self.sequence = sequence
-            self.chord_notes = chord_notes
-            self.midiChannel = midi_channel
-            self.rhythmNote = rhythm_note
-        # end of critical section
-
-        self.playChordEvent.set()
-        self.playRhythmEvent.set()
-        if sequence:
-            self.playSequenceEvent.set()
-
-    def run_rhythm(self):
+    """
+    Midi sequencer playing the melody, the chords and the rhythm
+    on three different output ports.
+
+    The sequencer doesn't own any timing thread: each call to the
+    play method translates the measure into timestamped midi messages
+    and pushes them in the heap of a Scheduler, whose single timing
+    thread serves all the output ports.
+
+    The positions of the notes are computed in beats, and turned into clock
+    times by a TempoMap shared with the other timing threads, so that the
+    tempo changes and the ramps land on the same beats for all the parts.
+
+    The note messages are built only once for each (type, channel, note)
+    and cached together with their encoded bytes. On the rtmidi ports the
+    bytes are written directly to the backend, skipping the validation of
+    mido, while the notes of a chord sharing the same time are sent by a
+    single event, in one burst.
+
+    Each port can have a latency offset (e.g. the audio buffer of the soft
+    synth it drives): the messages of its part are scheduled earlier by the
+    offset, so that the parts sound together on the beat.
+    """
+
+    def __init__(self, sequence_port, chord_port, rhythm_port, bpm=74, clock=None, scheduler=None, name=None,
+                 tempo_map=None, latencies=None):
+        """
+        Constructor.
+
+        :param sequence_port: name of the midi output port for the melody, or an already opened port
+        :param chord_port: name of the midi output port for the chords, or an already opened port
+        :param rhythm_port: name of the midi output port for the rhythm, or an already opened port
+        :param bpm: beats per minutes
+        :param clock: Clock shared with the other timing threads, if None a new one is created
+        :param scheduler: Scheduler used to send the messages, if None a new one is created
+        :param name: name prefixed to the parts in the scheduler streams, used when a scheduler is shared
+        :param tempo_map: TempoMap shared with the other timing threads, if None a new one is created from bpm
+        :param latencies: dictionary of the latency offsets in seconds by output port name (see latency.py), None disables them
+        """
+        if scheduler is None:
+            scheduler = Scheduler(clock)
+        self.scheduler = scheduler
+        self.clock = self.scheduler.clock
+        self._init_arrangement(bpm, tempo_map)
+
+        # output ports for each part of the arrangement
+        self.outPorts = {
+            'melody': self._open_output(sequence_port),
+            'chords': self._open_output(chord_port),
+            'rhythm': self._open_output(rhythm_port)
+        }
+
+        # seconds each part is sent in advance, to compensate the latency of its port
+        self.latencies = {part: 0.0 for part in self.outPorts}
+        if latencies is not None:
+            for part, port in self.outPorts.items():
+                self.latencies[part] = latencies.get(getattr(port, 'name', None), 0.0)
+
+        # scheduler stream of each part, used for the timing statistics
+        self.streams = {part: part if name is None else '{}.{}'.format(name, part) for part in self.outPorts}
+
+        # rtmidi objects of the ports, None for the ports using other backends
+        self.backends = {part: self._rtmidi_backend(port) for part, port in self.outPorts.items()}
+
+        self.scheduler.start()
+
+    def _init_arrangement(self, bpm, tempo_map=None, clock=None):
+        """
+        Utility method that initializes the tempo and the parts of the arrangement.
+
+        :param bpm: initial beats per minutes
+        :param tempo_map: TempoMap shared with the other timing threads, if None a new one is created from bpm
+        :param clock: Clock of the new TempoMap, if None the one of the sequencer is used
+        """
+        self.tempoMap = tempo_map if tempo_map is not None else TempoMap(
+            bpm, clock=clock if clock is not None else self.clock)
+
+        # durations of the rhythmic figures in beats
+        self.beatDurations = melodically.normalized_durations
+
+        # rhythmic pattern of the rhythm part
         # rhythm_sequence = ['4', '4', '4', '4']
-        rhythm_sequence = ['2', '2']
-        trigger_time = 0.05
-        rhythm_sequence = melodically.clip_rhythmic_sequence(rhythm_sequence, 1)
-        with mido.open_output(self.rhythmOutPort) as outport:
-            while True:
-                self.playRhythmEvent.wait()
-                self.playRhythmEvent.clear()
-
-                with self.lock:  # critical section
-                    rhythm_note = self.rhythmNote
-                    channel = self.midiChannel - 1
-                    durations = self.durations.copy()
-                # end of critical section
-
-                note_on = mido.Message('note_on', note=rhythm_note, channel=channel)
-                note_off = mido.Message('note_off', note=rhythm_note, channel=channel)
-
-                for step in rhythm_sequence:
-                    outport.send(note_on)
-                    time.sleep(trigger_time)
-                    outport.send(note_off)
-                    time.sleep(durations[step] - trigger_time)
-
-    def run_sequences(self):
-        with mido.open_output(self.sequenceOutPort) as outport:
-            while True:
-                self.playSequenceEvent.wait()
-                self.playSequenceEvent.clear()
-
-                with self.lock:  # critical section
-                    sequence = self.sequence.copy()
-                    channel = self.midiChannel - 1
-                # end of critical section
-
-                for step in sequence:
-                    with self.lock:  # critical section
-                        duration = self.durations[step['duration'].replace('r', '')]
-                    # end of critical section
-
-                    note_on = mido.Message('note_on', note=step['note'], channel=channel)
-                    note_off = mido.Message('note_off', note=step['note'], channel=channel)
-
-                    if 'r' not in step['duration']:
-                        outport.send(note_on)
-
-                    time.sleep(duration)
-
-                    if 'r' not in step['duration']:
-                        outport.send(note_off)
-
-    def run_chords(self):
-        with self.lock:  # critical section
-            one_measure_seconds = self.durations['1']
-        # end of critical section
-
-        with mido.open_output(self.chordOutPort) as outport:
-            while True:
-                self.playChordEvent.wait()
-                self.playChordEvent.clear()
-
-                with self.lock:  # critical section
-                    chord_notes = self.chord_notes.copy()
-                    channel = self.midiChannel - 1
-                # end of critical section
-
-                messages_note_on = [mido.Message('note_on', note=x, channel=channel) for x in chord_notes]
-                messages_note_off = [mido.Message('note_off', note=x, channel=channel) for x in chord_notes]
-
-                for note_on in messages_note_on:
-                    outport.send(note_on)
-
-                time.sleep(one_measure_seconds)
-
-                for note_off in messages_note_off:
-                    outport.send(note_off)
+        self.rhythmSequence = melodically.clip_rhythmic_sequence(['2', '2'], 1)
+
+        # duration in seconds of the triggers of the rhythm part
+        self.triggerTime = 0.05
+
+        # (mido message, encoded bytes) tuples of the notes: {(type, channel, note): entry}
+        self._noteCache = {}
+
+    @staticmethod
+    def _open_output(port):
+        """
+        Utility method that opens an output port from its name.
+        Objects that are not port names are considered already opened ports.
+
+        :param port: name of the port or object exposing a send method
+        :return: port object
+        """
+        if isinstance(port, str):
+            return mido.open_output(port)
+        return port
+
+    @staticmethod
+    def _rtmidi_backend(port):
+        """
+        Utility method that gets the rtmidi object of a mido port, used to send the encoded bytes directly.
+
+        :param port: port object
+        :return: rtmidi.MidiOut object, or None if the port doesn't use the rtmidi backend
+        """
+        backend = getattr(port, '_rt', None)
+        if backend is not None and hasattr(backend, 'send_message'):
+            return backend
+        return None
+
+    def close(self):
+        """
+        Closes the output ports opened by the sequencer.
+        The pending messages of the ports must be already sent.
+        """
+        for port in self.outPorts.values():
+            if hasattr(port, 'close'):
+                port.close()
+
+    def set_bpm(self, bpm, beat=None):
+        """
+        Changes the tempo of all the parts on a beat (see TempoMap.set_bpm).
+
+        :param bpm: new beats per minutes
+        :param beat: beat position of the change, if None the next beat boundary is used
+        :return: beat position of the change
+        """
+        return self.tempoMap.set_bpm(bpm, beat)
+
+    def set_latency(self, part, latency):
+        """
+        Changes the latency offset of a part, from the next played measure.
+
+        :param part: name of the part ('melody', 'chords' or 'rhythm')
+        :param latency: seconds the messages of the part are sent in advance
+        """
+        if part not in self.latencies:
+            raise ValueError('unknown part {}'.format(part))
+        self.latencies[part] = latency
+
+    def play(self, sequence, chord_notes, rhythm_note, midi_channel, start_time=None):
+        """
+        Plays a measure on the three output ports, pushing
+        all its midi messages in the scheduler.
+
+        :param sequence: list of dictionaries with a midi note and a rhythmic duration
+        :param chord_notes: list of midi notes of the chord
+        :param rhythm_note: midi note of the rhythmic part
+        :param midi_channel: midi channel starting from 1
+        :param start_time: absolute clock time of the downbeat, if None the measure starts immediately
+        """
+        if start_time is None:
+            start_time = self.clock.now()
+
+        # the measure is laid out in beats, looking up the tempo segment only once if it doesn't change tempo
+        start_beat = self.tempoMap.beat_at(start_time)
+        time_at = self.tempoMap.time_function(start_beat, start_beat + self.tempoMap.beatsPerMeasure)
+
+        channel = midi_channel - 1
+        events = []
+        self._melody_events(events, sequence, channel, start_time, start_beat, time_at)
+        self._chord_events(events, chord_notes, channel, start_time, start_beat, time_at)
+        self._rhythm_events(events, rhythm_note, channel, start_time, start_beat, time_at)
+        self._dispatch(events)
+
+    def _dispatch(self, events):
+        """
+        Utility method that pushes the events of a measure in the scheduler,
+        each one in advance by the latency offset of its part.
+
+        :param events: list of (deadline, priority, part, notes) tuples
+        """
+        scheduled = []
+        latencies = self.latencies
+        for deadline, priority, part, notes in events:
+            if len(notes) > 1:
+                callback, args = self._send_burst, (part, notes)
+            elif self.backends[part] is not None:
+                callback, args = self.backends[part].send_message, (notes[0][1],)
+            else:
+                callback, args = self.outPorts[part].send, (notes[0][0],)
+            scheduled.append((deadline - latencies[part], callback, args, priority, self.streams[part]))
+        self.scheduler.schedule_many(scheduled)
+
+    def _send_burst(self, part, notes):
+        """
+        Utility method that sends many notes at once on the port of a part.
+
+        :param part: name of the part
+        :param notes: list of (mido message, encoded bytes) tuples
+        """
+        backend = self.backends[part]
+        if backend is not None:
+            for _, data in notes:
+                backend.send_message(data)
+        else:
+            port = self.outPorts[part]
+            for message, _ in notes:
+                port.send(message)
+
+    def _note(self, msg_type, note, channel):
+        """
+        Utility method that gets a cached note message, building it on first use.
+
+        :param msg_type: 'note_on' or 'note_off'
+        :param note: midi note
+        :param channel: midi channel starting from 0
+        :return: (mido message, encoded bytes) tuple
+        """
+        key = (msg_type, channel, note)
+        entry = self._noteCache.get(key)
+        if entry is None:
+            message = mido.Message(msg_type, note=note, velocity=_VELOCITY, channel=channel)
+            entry = (message, message.bytes())
+            self._noteCache[key] = entry
+        return entry
+
+    def _melody_events(self, events, sequence, channel, start_time, start_beat, time_at):
+        """
+        Utility method that appends the melody messages to a list of events.
+
+        :param events: list of (deadline, priority, part, notes) tuples
+        :param sequence: list of dictionaries with a midi note and a rhythmic duration
+        :param channel: midi channel starting from 0
+        :param start_time: absolute clock time of the downbeat
+        :param start_beat: beat position of the downbeat
+        :param time_at: function mapping the beat positions of the measure to absolute clock times
+        """
+        step_beat = start_beat
+        step_time = start_time
+        for step in sequence:
+            step_beat = step_beat + self.beatDurations[step['duration'].replace('r', '')]
+            end_time = time_at(step_beat)
+            if 'r' not in step['duration']:
+                note_on = self._note('note_on', step['note'], channel)
+                note_off = self._note('note_off', step['note'], channel)
+                events.append(self._event(step_time, 'melody', (note_on,), _NOTE_ON_PRIORITY))
+                events.append(self._event(end_time, 'melody', (note_off,), _NOTE_OFF_PRIORITY))
+            step_time = end_time
+
+    def _chord_events(self, events, chord_notes, channel, start_time, start_beat, time_at):
+        """
+        Utility method that appends the chord messages to a list of events.
+
+        :param events: list of (deadline, priority, part, notes) tuples
+        :param chord_notes: list of midi notes of the chord
+        :param channel: midi channel starting from 0
+        :param start_time: absolute clock time of the downbeat
+        :param start_beat: beat position of the downbeat
+        :param time_at: function mapping the beat positions of the measure to absolute clock times
+        """
+        if not chord_notes:
+            return
+        # all the notes of the chord are sent in one burst
+        end_time = time_at(start_beat + self.beatDurations['1'])
+        notes_on = tuple(self._note('note_on', note, channel) for note in chord_notes)
+        notes_off = tuple(self._note('note_off', note, channel) for note in chord_notes)
+        events.append(self._event(start_time, 'chords', notes_on, _NOTE_ON_PRIORITY))
+        events.append(self._event(end_time, 'chords', notes_off, _NOTE_OFF_PRIORITY))
+
+    def _rhythm_events(self, events, rhythm_note, channel, start_time, start_beat, time_at):
+        """
+        Utility method that appends the rhythm messages to a list of events.
+
+        :param events: list of (deadline, priority, part, notes) tuples
+        :param rhythm_note: midi note of the rhythmic part
+        :param channel: midi channel starting from 0
+        :param start_time: absolute clock time of the downbeat
+        :param start_beat: beat position of the downbeat
+        :param time_at: function mapping the beat positions of the measure to absolute clock times
+        """
+        note_on = (self._note('note_on', rhythm_note, channel),)
+        note_off = (self._note('note_off', rhythm_note, channel),)
+        step_beat = start_beat
+        step_time = start_time
+        for step in self.rhythmSequence:
+            events.append(self._event(step_time, 'rhythm', note_on, _NOTE_ON_PRIORITY))
+            events.append(self._event(step_time + self.triggerTime, 'rhythm', note_off, _NOTE_OFF_PRIORITY))
+            step_beat = step_beat + self.beatDurations[step]
+            step_time = time_at(step_beat)
+
+    @staticmethod
+    def _event(deadline, part, notes, priority):
+        """
+        Utility method that builds the event sending some notes on the port of a part.
+
+        :param deadline: absolute clock time of the notes
+        :param part: name of the part ('melody', 'chords' or 'rhythm')
+        :param notes: tuple of (mido message, encoded bytes) tuples, see _note
+        :param priority: priority of the event
+        :return: (deadline, priority, part, notes) tuple
+        """
+        return deadline, priority, part, notes
+
+
+class MidiFileSequencer(Sequencer):
+    """
+    Sequencer writing the measures in a Standard MIDI File instead of
+    sending them to the output ports, with one track for each part.
+    The start times of the measures are interpreted as seconds from
+    the beginning of the file. The file has the tempo of the tempo map
+    at its beginning: after a tempo change the notes keep their times
+    in seconds.
+    """
+
+    def __init__(self, bpm=74, ticks_per_beat=480, tempo_map=None):
+        """
+        Constructor.
+
+        :param bpm: beats per minutes
+        :param ticks_per_beat: resolution of the midi file
+        :param tempo_map: TempoMap of the measures, if None a new one is created from bpm
+        """
+        self._init_arrangement(bpm, tempo_map, Clock())
+        self.ticksPerBeat = ticks_per_beat
+
+        # events of each part
+        self.partEvents = {'melody': [], 'chords': [], 'rhythm': []}
+
+    def play(self, sequence, chord_notes, rhythm_note, midi_channel, start_time=None):
+        if start_time is None:
+            raise ValueError('the start time is needed to write a measure in a midi file')
+        super().play(sequence, chord_notes, rhythm_note, midi_channel, start_time)
+
+    def _dispatch(self, events):
+        """
+        Utility method that stores the events of a measure.
+
+        :param events: list of (deadline, priority, part, notes) tuples
+        """
+        for event in events:
+            self.partEvents[event[2]].append(event)
+
+    def to_midi_file(self):
+        """
+        Builds the midi file containing the played measures.
+
+        :return: mido.MidiFile object
+        """
+        midi_file = mido.MidiFile(ticks_per_beat=self.ticksPerBeat)
+        tempo = mido.bpm2tempo(self.tempoMap.bpm_at(self.tempoMap.beat_at(0.0)))
+        for part, events in self.partEvents.items():
+            track = mido.MidiTrack()
+            track.append(mido.MetaMessage('track_name', name=part, time=0))
+            if part == 'melody':
+                track.append(mido.MetaMessage('set_tempo', tempo=tempo, time=0))
+
+            last_tick = 0
+            # sorting by time and priority, keeping the order of the simultaneous events
+            for deadline, _, _, notes in sorted(events, key=lambda e: (e[0], e[1])):
+                tick = int(round(mido.second2tick(deadline, self.ticksPerBeat, tempo)))
+                for message, _ in notes:
+                    track.append(message.copy(time=tick - last_tick))
+                    last_tick = tick
+            midi_file.tracks.append(track)
+        return midi_file
+
+    def save(self, path):
+        """
+        Writes the played measures in a midi file.
+
+        :param path: path of the midi file
+        """
+        self.to_midi_file().save(path)
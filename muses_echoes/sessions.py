@@ -0,0 +1,333 @@
+import queue
+import threading
+import time
+import mido
+from muses_echoes.muses import MuseEchoes
+from muses_echoes.sequencer import Sequencer
+from muses_echoes.scheduler import Scheduler
+from muses_echoes.chords import get_chord_markov_chain
+from muses_echoes.latency import load_latencies
+from muses_echoes import metrics
+
+"""
+Multi-session server of Muses' Echoes.
+
+A SessionManager hosts many independent MuseEchoes sessions (one for each
+room) in the same process. Every session has its own ports, tempo, harmonic
+state and Markov chains, while the timing thread of the scheduler, the
+chord model and the osc socket are shared. The sessions don't own any
+thread: the measures are ticked by the shared scheduler and generated by
+a single worker thread, and the input notes are received by the callbacks
+of the midi input ports.
+"""
+
+# seconds waited after the last measure of a removed session before closing its output ports
+_close_margin = 0.1
+
+
+class Session:
+    """
+    Session hosted by a SessionManager, with its timing and cpu statistics.
+    """
+
+    def __init__(self, name, muses, input_port):
+        """
+        Constructor.
+
+        :param name: name of the session
+        :param muses: MuseEchoes object of the session
+        :param input_port: opened midi input port, or None
+        """
+        self.name = name
+        self.muses = muses
+        self.inputPort = input_port
+
+        # False when the session is removed, the next tick closes its ports
+        self.active = True
+
+        # number of measures processed by the worker
+        self.measures = 0
+
+        # cpu time used by the worker for the session, in seconds
+        self.cpuTime = 0.0
+
+        # wall time spent processing the measures, in seconds
+        self.processingTimeSum = 0.0
+        self.processingTimeMax = 0.0
+
+        # delay between the ticks and the start of their processing, in seconds
+        self.tickLatenessSum = 0.0
+        self.tickLatenessMax = 0.0
+
+        # metrics of the session
+        self.cpuCounter = metrics.session_cpu_time.labels(session=name)
+        self.processingHistogram = metrics.session_processing_time.labels(session=name)
+
+    def get_stats(self):
+        """
+        Gets the statistics of the session.
+
+        measures: number of processed measures
+        cpu_time: cpu time used by the session in seconds
+        cpu_per_measure: mean cpu time per measure in seconds
+        processing_mean, processing_max: wall time spent processing a measure in seconds
+        tick_lateness_mean, tick_lateness_max: delay of the worker in processing the ticks in seconds
+        send: clock statistics of the midi messages of each part (see Clock.get_stats)
+
+        :return: dictionary of statistics
+        """
+        count = max(self.measures, 1)
+        clock_stats = self.muses.clock.get_stats()
+        streams = getattr(self.muses.sequencer, 'streams', {})
+        return {
+            'measures': self.measures,
+            'cpu_time': self.cpuTime,
+            'cpu_per_measure': self.cpuTime / count,
+            'processing_mean': self.processingTimeSum / count,
+            'processing_max': self.processingTimeMax,
+            'tick_lateness_mean': self.tickLatenessSum / count,
+            'tick_lateness_max': self.tickLatenessMax,
+            'send': {part: clock_stats[stream] for part, stream in streams.items() if stream in clock_stats}
+        }
+
+
+class SessionManager:
+    """
+    Hosts many MuseEchoes sessions in a single process.
+
+    The manager owns the only timing thread (the one of the shared Scheduler)
+    and a worker thread. For each session, the scheduler fires a tick
+    lookahead measures before every downbeat; the tick only queues the
+    session, and the worker prepares the measure with MuseEchoes.process_measure,
+    pushing its messages back in the scheduler and scheduling the following tick.
+    A slow generation therefore never delays the midi messages of the other sessions.
+    Sessions can be added and removed while the manager is running.
+    """
+
+    def __init__(self, osc_ip="127.0.0.1", osc_port=1337, metrics_port=None, osc_destinations=None,
+                 latency_config=None):
+        """
+        Constructor.
+
+        :param osc_ip: ip string for the osc node receiving the scales of all the sessions, None disables osc
+        :param osc_port: port string the osc node receiving the scales of all the sessions
+        :param osc_destinations: list of (ip, port) tuples of the osc nodes, replacing osc_ip and osc_port
+        :param metrics_port: localhost port of the metrics endpoint, None disables the endpoint
+        :param latency_config: path of the json file of the latency offsets of the output ports and of the osc destinations (see latency.py), None disables them
+        """
+
+        # lock used to protect the sessions dictionary
+        self.lock = threading.Lock()
+
+        # timing thread shared by all the sessions
+        self.scheduler = Scheduler()
+        self.clock = self.scheduler.clock
+
+        # latency offsets of the midi output ports of all the sessions and of the osc destinations
+        self.midiLatencies, osc_latencies = load_latencies(latency_config) if latency_config is not None else (None, None)
+
+        # osc output shared by all the sessions
+        if osc_destinations is None and osc_ip is not None:
+            osc_destinations = [(osc_ip, osc_port)]
+        self.oscClient = None
+        if osc_destinations:
+            # asyncio and pythonosc are imported only when osc is used
+            from muses_echoes.osc_output import OscOutput
+            self.oscClient = OscOutput(osc_destinations, latencies=osc_latencies)
+
+        # sessions by name
+        self.sessions = {}
+
+        # queue of (session, tick deadline, downbeat beat) tuples waiting for the worker, None stops the worker
+        self._ticks = queue.SimpleQueue()
+
+        # worker thread generating the measures
+        self._worker = None
+
+        self.logger = metrics.get_logger()
+
+        # exposing the metrics on localhost
+        self.metricsServer = metrics.MetricsServer(metrics_port) if metrics_port is not None else None
+
+    def start(self):
+        """
+        Starts the scheduler and the worker thread, without blocking.
+        The read-only chord model is loaded here, once for all the sessions.
+        """
+        get_chord_markov_chain()
+        self.scheduler.start()
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, daemon=True)
+            self._worker.start()
+        if self.metricsServer is not None:
+            self.metricsServer.start()
+
+    def stop(self):
+        """
+        Removes all the sessions, stops the scheduler and waits for the worker to process the queued ticks.
+        The output ports of the sessions are closed without waiting for their scheduled messages.
+        """
+        with self.lock:  # critical section
+            sessions = list(self.sessions.values())
+        # end of critical section
+        for session in sessions:
+            self.remove_session(session.name)
+        self.scheduler.stop()
+        if self._worker is not None:
+            self._ticks.put(None)
+            self._worker.join()
+            self._worker = None
+
+        # the final ticks of the sessions and the closing of their ports were discarded by the scheduler,
+        # their output ports are closed and their snapshots are written here
+        for session in sessions:
+            session.muses.sequencer.close()
+            if session.muses.snapshotWriter is not None:
+                session.muses.snapshotWriter.close()
+        if self.metricsServer is not None:
+            self.metricsServer.stop()
+
+    def add_session(self, name, midi_in_port,
+                    midi_sequence_out_port, midi_chord_out_port, midi_rhythm_out_port,
+                    lookahead_measures=1, osc_address=None, **kwargs):
+        """
+        Adds a new session, that starts playing from its next measure.
+
+        :param name: unique name of the session
+        :param midi_in_port: name of the midi input port, or None for a session without input
+        :param midi_sequence_out_port: name of the midi output port for the melody, or an already opened port
+        :param midi_chord_out_port: name of the midi output port for the chords, or an already opened port
+        :param midi_rhythm_out_port: name of the midi output port for the rhythm, or an already opened port
+        :param lookahead_measures: number of measures generated in advance, at least 1 to never delay the downbeats
+        :param osc_address: osc address receiving the mode of the session, if None /[name]/touchdesigner/mode is used
+        :param kwargs: additional parameters of the MuseEchoes constructor (bpm, midi_mapping, seed, ...)
+        :return: Session object
+        """
+        with self.lock:  # critical section
+            if name in self.sessions:
+                raise ValueError('a session named {} already exists'.format(name))
+        # end of critical section
+
+        bpm = kwargs.pop('bpm', 74)
+        sequencer = Sequencer(sequence_port=midi_sequence_out_port,
+                              chord_port=midi_chord_out_port,
+                              rhythm_port=midi_rhythm_out_port,
+                              bpm=bpm,
+                              scheduler=self.scheduler,
+                              name=name,
+                              latencies=self.midiLatencies)
+        muses = MuseEchoes(midi_in_port=midi_in_port,
+                           midi_sequence_out_port=midi_sequence_out_port,
+                           midi_chord_out_port=midi_chord_out_port,
+                           midi_rhythm_out_port=midi_rhythm_out_port,
+                           bpm=bpm,
+                           osc_ip=None,
+                           lookahead_measures=lookahead_measures,
+                           sequencer=sequencer,
+                           scheduler=self.scheduler,
+                           osc_client=self.oscClient,
+                           osc_address=osc_address if osc_address is not None else '/{}/touchdesigner/mode'.format(name),
+                           **kwargs)
+
+        # the input notes are parsed by the callback thread of the port
+        input_port = None
+        if midi_in_port is not None:
+            input_port = mido.open_input(midi_in_port, callback=muses.receive_midi)
+
+        session = Session(name, muses, input_port)
+        with self.lock:  # critical section
+            self.sessions[name] = session
+        # end of critical section
+
+        # the first downbeat is a measure boundary of the tempo map of the session
+        downbeat_beat = muses.tempoMap.next_measure(self.clock.now()) + lookahead_measures * muses.tempoMap.beatsPerMeasure
+        self._schedule_tick(session, downbeat_beat)
+        return session
+
+    def remove_session(self, name):
+        """
+        Removes a session. Its input port is closed immediately, while the
+        measures already generated are played before closing the output ports.
+        The last snapshot of the session is written by the worker, after its last measure.
+
+        :param name: name of the session
+        """
+        with self.lock:  # critical section
+            session = self.sessions.pop(name)
+            session.active = False
+        # end of critical section
+
+        if session.inputPort is not None:
+            session.inputPort.close()
+
+        metrics.session_cpu_time.remove(session=name)
+        metrics.session_processing_time.remove(session=name)
+
+    def get_stats(self):
+        """
+        Gets the statistics of all the sessions.
+
+        :return: dictionary of session statistics by name (see Session.get_stats)
+        """
+        with self.lock:  # critical section
+            sessions = list(self.sessions.values())
+        # end of critical section
+        return {session.name: session.get_stats() for session in sessions}
+
+    def _schedule_tick(self, session, downbeat_beat):
+        """
+        Utility method that schedules the tick preparing the measure of a downbeat.
+        The downbeats are beat positions, so that they stay on the measure boundaries after the tempo changes.
+
+        :param session: Session object
+        :param downbeat_beat: beat position of the downbeat of the measure in the tempo map of the session
+        """
+        tempo_map = session.muses.tempoMap
+        deadline = tempo_map.time_at(downbeat_beat - session.muses.lookaheadMeasures * tempo_map.beatsPerMeasure)
+        self.scheduler.schedule(deadline, self._ticks.put, ((session, deadline, downbeat_beat),))
+
+    def _run(self):
+        """
+        Worker thread loop, processing the ticks of all the sessions.
+        """
+        while True:
+            tick = self._ticks.get()
+            if tick is None:
+                break  # the manager is stopped
+            session, deadline, downbeat_beat = tick
+            downbeat = session.muses.tempoMap.time_at(downbeat_beat)
+
+            if not session.active:
+                # the measures already scheduled end on this downbeat
+                self.scheduler.schedule(downbeat + _close_margin, session.muses.sequencer.close)
+
+                # no measure of the session is processed anymore, its last snapshot is written
+                if session.muses.snapshotWriter is not None:
+                    session.muses.snapshotWriter.close()
+                continue
+
+            start = time.perf_counter()
+            cpu_start = time.thread_time()
+            try:
+                generated = session.muses.process_measure(downbeat)
+            except Exception as e:  # a failing session must not stop the others
+                self.logger.log('[{}] measure failed: {}', session.name, e)
+                generated = None
+            cpu_time = time.thread_time() - cpu_start
+            processing_time = time.perf_counter() - start
+
+            session.measures = session.measures + 1
+            session.cpuTime = session.cpuTime + cpu_time
+            session.processingTimeSum = session.processingTimeSum + processing_time
+            session.processingTimeMax = max(session.processingTimeMax, processing_time)
+            lateness = start - deadline
+            session.tickLatenessSum = session.tickLatenessSum + lateness
+            session.tickLatenessMax = max(session.tickLatenessMax, lateness)
+            session.cpuCounter.inc(cpu_time)
+            session.processingHistogram.observe(processing_time)
+
+            if generated is not None:
+                self.logger.log('[{}] chord: {} midi notes: {}', session.name, generated['chord'],
+                                generated['midi_notes'])
+
+            self._schedule_tick(session, downbeat_beat + session.muses.tempoMap.beatsPerMeasure)
@@ -0,0 +1,240 @@
+import os
+import json
+import mmap
+import time
+import struct
+import threading
+import numpy as np
+from muses_echoes import metrics
+
+"""
+Snapshots of the learned state of a session.
+
+A snapshot is a nested dictionary of json values and numpy arrays (the
+Markov chains in compressed sparse rows, the histogram of the harmonic
+state, the position in the chord progression). The file starts with a
+json header describing the values and the layout of the arrays, followed
+by the raw arrays, aligned so that they are read in place from a memory
+map: restoring a snapshot doesn't parse or copy the arrays.
+
+The snapshots are written by a SnapshotWriter thread to a temporary file,
+synced and renamed over the previous snapshot, so a crash while writing
+always leaves the last complete snapshot on disk.
+"""
+
+# first bytes of a snapshot
+_MAGIC = b'MESN'
+
+# version of the snapshot format
+_VERSION = 1
+
+# version and length of the json header, following the magic bytes
+_header_struct = struct.Struct('<HI')
+
+# alignment in bytes of the arrays in the file
+_ALIGNMENT = 16
+
+# key of the json objects replacing the arrays in the header
+_ARRAY_KEY = '__array__'
+
+
+def _split_arrays(value, arrays):
+    """
+    Utility function that replaces the numpy arrays of a nested dictionary with references.
+
+    :param value: json value, numpy array, or dictionary of them
+    :param arrays: list receiving the arrays, in the order of their references
+    :return: json value
+    """
+    if isinstance(value, np.ndarray):
+        arrays.append(np.ascontiguousarray(value))
+        return {_ARRAY_KEY: len(arrays) - 1}
+    if isinstance(value, dict):
+        return {key: _split_arrays(item, arrays) for key, item in value.items()}
+    return value
+
+
+def _join_arrays(value, arrays):
+    """
+    Utility function that replaces the references of a nested dictionary with their arrays.
+
+    :param value: json value with references
+    :param arrays: list of the arrays
+    :return: nested dictionary with the arrays
+    """
+    if isinstance(value, dict):
+        if _ARRAY_KEY in value:
+            return arrays[value[_ARRAY_KEY]]
+        return {key: _join_arrays(item, arrays) for key, item in value.items()}
+    return value
+
+
+def write_snapshot(path, state):
+    """
+    Writes a snapshot, replacing the previous one atomically.
+
+    :param path: path of the snapshot
+    :param state: nested dictionary of json values and numpy arrays
+    """
+    arrays = []
+    values = _split_arrays(state, arrays)
+
+    # the offsets of the arrays are relative to the (aligned) end of the header
+    layout = []
+    offset = 0
+    for array in arrays:
+        layout.append([offset, array.dtype.str, list(array.shape)])
+        offset = offset + -(-array.nbytes // _ALIGNMENT) * _ALIGNMENT
+    header = json.dumps({'values': values, 'arrays': layout}).encode('utf-8')
+    start = len(_MAGIC) + _header_struct.size + len(header)
+    padding = -start % _ALIGNMENT
+
+    temporary_path = path + '.tmp'
+    with open(temporary_path, 'wb') as f:
+        f.write(_MAGIC + _header_struct.pack(_VERSION, len(header)) + header + bytes(padding))
+        for array in arrays:
+            f.write(array.tobytes())
+            f.write(bytes(-array.nbytes % _ALIGNMENT))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary_path, path)
+
+
+def read_snapshot(path):
+    """
+    Reads a snapshot from a memory map of the file. The arrays are read-only views of the map.
+
+    :param path: path of the snapshot
+    :return: nested dictionary of json values and numpy arrays
+    """
+    with open(path, 'rb') as f:
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    if data[:len(_MAGIC)] != _MAGIC:
+        raise ValueError('{} is not a snapshot'.format(path))
+    offset = len(_MAGIC)
+    if len(data) < offset + _header_struct.size:
+        raise ValueError('{} is truncated'.format(path))
+    version, header_length = _header_struct.unpack_from(data, offset)
+    if version != _VERSION:
+        raise ValueError('unsupported snapshot version {}'.format(version))
+    offset = offset + _header_struct.size
+    header = json.loads(bytes(data[offset:offset + header_length]).decode('utf-8'))
+    offset = offset + header_length
+    offset = offset + -offset % _ALIGNMENT
+
+    arrays = []
+    for array_offset, dtype, shape in header['arrays']:
+        dtype = np.dtype(dtype)
+        count = int(np.prod(shape))
+        if offset + array_offset + count * dtype.itemsize > len(data):
+            raise ValueError('{} is truncated'.format(path))
+        arrays.append(np.frombuffer(data, dtype=dtype, count=count, offset=offset + array_offset).reshape(shape))
+    return _join_arrays(header['values'], arrays)
+
+
+class SnapshotWriter:
+    """
+    Thread writing the snapshots of a session in the background.
+    Only the last submitted snapshot is written: if the disk is slower than
+    the submissions, the intermediate snapshots are skipped. A snapshot can be
+    submitted as a function building it, called by the thread of the writer, so
+    that the serialization of the state is done in the background too.
+    """
+
+    def __init__(self, path):
+        """
+        Constructor.
+
+        :param path: path of the snapshot
+        """
+        self.path = path
+
+        # condition protecting the pending snapshot
+        self.condition = threading.Condition()
+
+        # snapshot waiting to be written, None if there isn't any
+        self._pending = None
+
+        self._closed = False
+
+        # statistics
+        self.writtenSnapshots = 0
+        self.skippedSnapshots = 0
+        self.lastWriteTime = None
+
+        self.logger = metrics.get_logger()
+
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, state):
+        """
+        Queues a snapshot, without blocking. The arrays of the state must not be modified afterwards.
+
+        :param state: nested dictionary of json values and numpy arrays, or function returning it (or None to skip it)
+        """
+        with self.condition:  # critical section
+            if self._pending is not None:
+                self.skippedSnapshots = self.skippedSnapshots + 1
+            self._pending = state
+            self.condition.notify()
+        # end of critical section
+
+    def get_stats(self):
+        """
+        Gets the statistics of the writer.
+
+        written_snapshots: number of snapshots written
+        skipped_snapshots: snapshots replaced by a newer one before being written
+        last_write_time: seconds spent writing the last snapshot, None before the first one
+
+        :return: dictionary of statistics
+        """
+        return {
+            'written_snapshots': self.writtenSnapshots,
+            'skipped_snapshots': self.skippedSnapshots,
+            'last_write_time': self.lastWriteTime
+        }
+
+    def close(self):
+        """
+        Writes the pending snapshot and stops the thread.
+        """
+        with self.condition:  # critical section
+            self._closed = True
+            self.condition.notify()
+        # end of critical section
+        self._thread.join()
+
+    def _run(self):
+        """
+        Thread writing the pending snapshots.
+        """
+        while True:
+            with self.condition:  # critical section
+                while self._pending is None and not self._closed:
+                    self.condition.wait()
+                state = self._pending
+                self._pending = None
+                closed = self._closed
+            # end of critical section
+
+            if callable(state):
+                try:
+                    state = state()
+                except Exception as e:  # a snapshot that can't be built must not stop the writer
+                    self.logger.log('snapshot {} not built: {}', self.path, e)
+                    state = None
+                else:
+                    if state is None:
+                        self.skippedSnapshots = self.skippedSnapshots + 1
+            if state is not None:
+                start = time.perf_counter()
+                try:
+                    write_snapshot(self.path, state)
+                    self.writtenSnapshots = self.writtenSnapshots + 1
+                    self.lastWriteTime = time.perf_counter() - start
+                except OSError as e:
+                    self.logger.log('snapshot {} not written: {}', self.path, e)
+            if closed:
+                break
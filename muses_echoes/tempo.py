@@ -0,0 +1,318 @@
+import bisect
+import math
+import threading
+from functools import lru_cache
+import melodically
+from muses_echoes.clock import Clock
+
+"""
+Tempo map shared by the timing threads.
+
+The positions of the music are expressed in beats, and the tempo map turns
+them into absolute clock times (and back). The map is a list of segments,
+each one starting on a beat: a constant tempo, or a linear or exponential
+ramp of the beats per minute. Every part reads the same map, so a tempo
+change lands on the same beat for the melody, the chords, the rhythm and
+the measure grid. The segments are replaced all at once on each change,
+and the readers never take a lock.
+"""
+
+# tolerance on the beat positions computed from clock times
+_epsilon = 1e-6
+
+# curves of the tempo ramps
+CONSTANT = 'constant'
+LINEAR = 'linear'
+EXPONENTIAL = 'exponential'
+
+
+@lru_cache(maxsize=256)
+def durations(bpm, triplets=True):
+    """
+    Gets the durations of the rhythmic figures at a tempo, computed once for each tempo.
+    The returned dictionary is shared and must not be modified.
+
+    :param bpm: beats per minutes
+    :param triplets: if False, the triplets are removed from the figures
+    :return: dictionary containing the durations in seconds for each rhythmic figure
+    """
+    figures = melodically.get_durations(bpm)
+    if not triplets:
+        for figure in ('16t', '8t', '4t'):
+            del figures[figure]
+    return figures
+
+
+class _TempoSegment:
+    """
+    Segment of the tempo map, from its start beat to the start of the following segment.
+    The tempo of a ramp is a linear or an exponential function of the beat position,
+    and the time of a beat is the closed form of the integral of 60 / bpm.
+    """
+
+    __slots__ = ('startBeat', 'startTime', 'startBpm', 'curve', 'rate')
+
+    def __init__(self, start_beat, start_time, start_bpm, curve=CONSTANT, rate=0.0):
+        """
+        Constructor.
+
+        :param start_beat: beat position of the start of the segment
+        :param start_time: absolute clock time of the start of the segment
+        :param start_bpm: beats per minutes at the start of the segment
+        :param curve: CONSTANT, LINEAR or EXPONENTIAL
+        :param rate: bpm added per beat (LINEAR) or log of the bpm ratio per beat (EXPONENTIAL)
+        """
+        self.startBeat = start_beat
+        self.startTime = start_time
+        self.startBpm = start_bpm
+        self.curve = curve if rate != 0 else CONSTANT
+        self.rate = rate
+
+    def bpm_at(self, beat):
+        x = beat - self.startBeat
+        if self.curve == LINEAR:
+            return self.startBpm + self.rate * x
+        if self.curve == EXPONENTIAL:
+            return self.startBpm * math.exp(self.rate * x)
+        return self.startBpm
+
+    def time_at(self, beat):
+        x = beat - self.startBeat
+        if self.curve == LINEAR:
+            return self.startTime + 60 / self.rate * math.log1p(self.rate * x / self.startBpm)
+        if self.curve == EXPONENTIAL:
+            return self.startTime - 60 / (self.startBpm * self.rate) * math.expm1(-self.rate * x)
+        return self.startTime + x * 60 / self.startBpm
+
+    def beat_at(self, time):
+        t = time - self.startTime
+        if self.curve == LINEAR:
+            return self.startBeat + self.startBpm * math.expm1(self.rate * t / 60) / self.rate
+        if self.curve == EXPONENTIAL:
+            return self.startBeat - math.log1p(-t * self.startBpm * self.rate / 60) / self.rate
+        return self.startBeat + t * self.startBpm / 60
+
+
+class TempoMap:
+    """
+    Map between beat positions and absolute clock times, with instant tempo changes
+    and tempo ramps starting on beat boundaries.
+
+    Beat 0 is at the origin time, and the first tempo extends to the beats before it.
+    A change replaces the segments following its beat, so the last change always wins.
+    """
+
+    # max number of segments kept, the oldest ones are dropped and the first kept tempo extends to the beats before it
+    _maxSegments = 256
+
+    def __init__(self, bpm, origin=0.0, beats_per_measure=4, clock=None):
+        """
+        Constructor.
+
+        :param bpm: initial beats per minutes
+        :param origin: absolute clock time of beat 0
+        :param beats_per_measure: number of beats of a measure
+        :param clock: Clock giving the current time, used to find the next beat of a change, if None a new one is created
+        """
+        if bpm <= 0:
+            raise ValueError('the tempo must be positive, not {}'.format(bpm))
+
+        self.beatsPerMeasure = beats_per_measure
+        self.clock = clock if clock is not None else Clock()
+
+        # lock serializing the changes (the readers use the segments without locking)
+        self.lock = threading.Lock()
+
+        # (start beats, start times, segments) tuple, replaced at each change
+        self._segments = ([0.0], [origin], [_TempoSegment(0.0, origin, bpm)])
+
+        # functions called with the new segments (see get_segments) after each change, inside the critical section
+        self.listeners = []
+
+    def segment_at(self, beat):
+        """
+        Gets the segment containing a beat position.
+
+        :param beat: beat position
+        :return: (segment, beat position of the end of the segment) tuple, the end is inf for the last segment
+        """
+        beats, _, segments = self._segments
+        index = max(bisect.bisect_right(beats, beat) - 1, 0)
+        end = beats[index + 1] if index + 1 < len(beats) else math.inf
+        return segments[index], end
+
+    def bpm_at(self, beat):
+        """
+        Gets the tempo at a beat position.
+
+        :param beat: beat position
+        :return: beats per minutes
+        """
+        return self.segment_at(beat)[0].bpm_at(beat)
+
+    def time_at(self, beat):
+        """
+        Gets the absolute clock time of a beat position.
+
+        :param beat: beat position
+        :return: absolute clock time in seconds
+        """
+        return self.segment_at(beat)[0].time_at(beat)
+
+    def beat_at(self, time):
+        """
+        Gets the beat position of an absolute clock time.
+
+        :param time: absolute clock time in seconds
+        :return: beat position
+        """
+        _, times, segments = self._segments
+        index = max(bisect.bisect_right(times, time) - 1, 0)
+        return segments[index].beat_at(time)
+
+    def time_function(self, start_beat, end_beat):
+        """
+        Gets a function mapping the beats of a range to absolute clock times.
+        If the range is inside one segment, the segment is looked up only once.
+
+        :param start_beat: first beat position of the range
+        :param end_beat: last beat position of the range
+        :return: function of a beat position returning an absolute clock time
+        """
+        segment, end = self.segment_at(start_beat)
+        return segment.time_at if end_beat <= end else self.time_at
+
+    def durations_at(self, beat):
+        """
+        Gets the durations of the rhythmic figures at the tempo of a beat position.
+
+        :param beat: beat position
+        :return: shared dictionary containing the durations in seconds for each rhythmic figure
+        """
+        return durations(self.bpm_at(beat))
+
+    def next_measure(self, time):
+        """
+        Gets the first measure boundary following an absolute clock time.
+        A time on a downbeat (up to the rounding of the clock times) gives the following downbeat.
+
+        :param time: absolute clock time in seconds
+        :return: beat position of the downbeat
+        """
+        return (math.floor(self.beat_at(time) / self.beatsPerMeasure + _epsilon) + 1) * self.beatsPerMeasure
+
+    def next_beat(self):
+        """
+        Gets the first beat boundary following the current time.
+
+        :return: integer beat position
+        """
+        return math.floor(self.beat_at(self.clock.now())) + 1
+
+    def set_bpm(self, bpm, beat=None):
+        """
+        Changes the tempo instantly on a beat.
+
+        :param bpm: new beats per minutes
+        :param beat: beat position of the change, if None the next beat boundary is used
+        :return: beat position of the change
+        """
+        return self.ramp(bpm, 0, beat)
+
+    def ramp(self, bpm, beats, beat=None, curve=LINEAR):
+        """
+        Changes the tempo gradually over some beats, starting on a beat.
+        The tempo stays at the target bpm after the ramp.
+
+        :param bpm: target beats per minutes
+        :param beats: length of the ramp in beats, 0 changes the tempo instantly
+        :param beat: beat position of the start of the ramp, if None the next beat boundary is used
+        :param curve: LINEAR or EXPONENTIAL, the bpm is a linear or an exponential function of the beats
+        :return: beat position of the start of the ramp
+        """
+        if bpm <= 0:
+            raise ValueError('the tempo must be positive, not {}'.format(bpm))
+        if beats < 0:
+            raise ValueError('the length of a ramp can\'t be negative')
+        if curve not in (LINEAR, EXPONENTIAL):
+            raise ValueError('unknown tempo curve {}'.format(curve))
+
+        with self.lock:  # critical section
+            if beat is None:
+                beat = self.next_beat()
+            current = self.segment_at(beat)[0]
+            start_bpm = current.bpm_at(beat)
+            start_time = current.time_at(beat)
+
+            if beats > 0 and bpm != start_bpm:
+                if curve == LINEAR:
+                    rate = (bpm - start_bpm) / beats
+                else:
+                    rate = math.log(bpm / start_bpm) / beats
+                ramp = _TempoSegment(beat, start_time, start_bpm, curve, rate)
+                self._replace_from(beat, [ramp, _TempoSegment(beat + beats, ramp.time_at(beat + beats), bpm)])
+            else:
+                self._replace_from(beat, [_TempoSegment(beat, start_time, bpm)])
+        # end of critical section
+        return beat
+
+    def locate(self, beat, time, bpm):
+        """
+        Places a beat at an absolute clock time, with a new tempo from that beat on.
+        Unlike the other changes, the time of the beat jumps: it is used to
+        follow the transport of an external clock (start, continue, song position).
+
+        :param beat: beat position
+        :param time: absolute clock time of the beat
+        :param bpm: beats per minutes from the beat on
+        """
+        if bpm <= 0:
+            raise ValueError('the tempo must be positive, not {}'.format(bpm))
+        with self.lock:  # critical section
+            self._replace_from(beat, [_TempoSegment(beat, time, bpm)])
+        # end of critical section
+
+    def get_segments(self):
+        """
+        Gets the segments of the map, used to record it.
+
+        :return: list of [start beat, start time, start bpm, curve, rate] lists
+        """
+        return [[s.startBeat, s.startTime, s.startBpm, s.curve, s.rate] for s in self._segments[2]]
+
+    def replace_segments(self, segments, time_offset=0.0):
+        """
+        Replaces the segments following the start beat of the first new segment, reproducing recorded changes.
+
+        :param segments: list of [start beat, start time, start bpm, curve, rate] lists (see get_segments)
+        :param time_offset: seconds added to the start times of the segments
+        """
+        tail = [_TempoSegment(start_beat, start_time + time_offset, start_bpm, curve, rate)
+                for start_beat, start_time, start_bpm, curve, rate in segments]
+        with self.lock:  # critical section
+            self._replace_from(tail[0].startBeat, tail)
+        # end of critical section
+
+    def _replace_from(self, beat, tail):
+        """
+        Utility method that replaces the segments following a beat. It must be called inside a critical section.
+
+        :param beat: beat position of the first new segment
+        :param tail: list of the new segments
+        """
+        beats, _, segments = self._segments
+        index = max(bisect.bisect_right(beats, beat) - 1, 0)
+        new_segments = segments[:index + 1] if beat > beats[index] else segments[:index]
+        new_segments = new_segments + tail
+        if len(new_segments) >= self._maxSegments:
+            new_segments = new_segments[len(new_segments) - self._maxSegments + 1:]
+        first = new_segments[0]
+        if first.curve != CONSTANT:
+            # the beats before a ramp keep its start tempo, instead of following the ramp backwards
+            # (the constant segment comes first in the lookups of the beats and the times before the ramp)
+            new_segments = [_TempoSegment(first.startBeat, first.startTime, first.startBpm)] + new_segments
+        self._segments = ([s.startBeat for s in new_segments], [s.startTime for s in new_segments], new_segments)
+        if self.listeners:
+            values = [[s.startBeat, s.startTime, s.startBpm, s.curve, s.rate] for s in tail]
+            for listener in self.listeners:
+                listener(values)
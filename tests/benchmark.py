@@ -0,0 +1,346 @@
+import os
+import sys
+import json
+import time
+import random
+import platform
+import tempfile
+import numpy as np
+from muses_echoes.clock import Clock
+from muses_echoes.muses import MuseEchoes
+from muses_echoes.sequencer import Sequencer
+from muses_echoes.markov_chain import MarkovChain
+from muses_echoes.chords import get_chord_markov_chain
+from muses_echoes.generation_pool import GenerationPool
+from muses_echoes.input_parser import NOTE_ON, NOTE_OFF
+from muses_echoes import metrics
+from muses_echoes.snapshot import write_snapshot
+
+"""
+Benchmark suite of the generation and sequencing hot paths.
+
+The midi ports and the osc client are replaced by in-memory stand-ins,
+so the suite runs on machines without midi hardware. The results are
+printed (or written to a file) as JSON, to be compared between releases.
+
+usage (from the repository root): python -m tests.benchmark [output json file] [--quick]
+"""
+
+
+class MemoryOutputPort:
+    """
+    In-memory stand-in for a mido output port, recording the sent messages.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock if clock is not None else Clock()
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append((self.clock.now(), msg))
+
+
+class MemoryOscClient:
+    """
+    In-memory stand-in for the pythonosc SimpleUDPClient, recording the sent messages.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send_message(self, address, value):
+        self.messages.append((address, value))
+
+
+def latency_stats(samples):
+    """
+    Summary statistics of a list of latencies.
+
+    :param samples: list of latencies in seconds
+    :return: dictionary of statistics in microseconds
+    """
+    values = np.array(samples) * 1e6
+    return {
+        'count': len(samples),
+        'mean_us': float(values.mean()),
+        'p50_us': float(np.percentile(values, 50)),
+        'p99_us': float(np.percentile(values, 99)),
+        'max_us': float(values.max())
+    }
+
+
+def random_input_records(rng, notes, start_time, bpm):
+    """
+    Generates random note_on/note_off records of eight notes.
+
+    :param rng: random.Random object
+    :param notes: number of notes
+    :param start_time: timestamp of the first note
+    :param bpm: beats per minutes
+    :return: list of (type, note, velocity, timestamp) tuples
+    """
+    eighth = 30 / bpm
+    records = []
+    for i in range(notes):
+        note = rng.randint(60, 72)
+        onset = start_time + i * eighth
+        records.append((NOTE_ON, note, 100, onset))
+        records.append((NOTE_OFF, note, 0, onset + eighth * 0.9))
+    return records
+
+
+def new_muses(**kwargs):
+    """
+    Creates a MuseEchoes object with in-memory ports and osc client.
+
+    :param kwargs: additional parameters of the MuseEchoes constructor
+    :return: MuseEchoes object
+    """
+    muses = MuseEchoes(midi_in_port=None,
+                       midi_sequence_out_port=MemoryOutputPort(),
+                       midi_chord_out_port=MemoryOutputPort(),
+                       midi_rhythm_out_port=MemoryOutputPort(),
+                       osc_ip=None,
+                       **kwargs)
+    muses.oscClient = MemoryOscClient()
+    return muses
+
+
+def benchmark_markov_chain(orders, lengths, repetitions):
+    """
+    Latency of MarkovChain.learn and MarkovChain.generate.
+    """
+    rng = random.Random(0)
+    symbols = ['c', 'l', 'x']
+    results = []
+    for order in orders:
+        for length in lengths:
+            chain = MarkovChain(order=order, inertia=0.78, rng=random.Random(1))
+            learn_samples = []
+            generate_samples = []
+            for _ in range(repetitions):
+                sequence = [rng.choice(symbols) for _ in range(length)]
+                start = time.perf_counter()
+                chain.learn(sequence)
+                learn_samples.append(time.perf_counter() - start)
+                start = time.perf_counter()
+                chain.generate(length)
+                generate_samples.append(time.perf_counter() - start)
+            results.append({
+                'order': order,
+                'length': length,
+                'learn': latency_stats(learn_samples),
+                'generate': latency_stats(generate_samples)
+            })
+    return results
+
+
+def benchmark_measure(measures, notes_per_measure, bpm=74, processes=0, candidates=1):
+    """
+    Full per-measure cost of the _play_midi loop (parsing, training, sampling and sequencing),
+    with the generation in the main process or in a GenerationPool of some worker processes,
+    sampling one or many candidate melodies.
+    """
+    generation_pool = GenerationPool(processes) if processes > 0 else None
+    muses = new_muses(bpm=bpm, seed=0, generation_pool=generation_pool, melody_candidates=candidates)
+    rng = random.Random(0)
+    measure_duration = muses.durations['1']
+    muses._update_scale()
+    muses._initialize_generation()
+
+    samples = []
+    for measure in range(measures):
+        for record in random_input_records(rng, notes_per_measure, measure * measure_duration, bpm):
+            muses.push_input(*record)
+        muses.measureCount = measure % muses.measuresForScaleChange
+        start = time.perf_counter()
+        generated = muses._generate_measure()
+        muses.sequencer.play(generated['sequence'], generated['chord_notes'], generated['rhythm_note'],
+                             generated['midi_channel'], muses.clock.now() + 3600)
+        samples.append(time.perf_counter() - start)
+    muses.scheduler.stop()
+    if generation_pool is not None:
+        generation_pool.close()
+    return latency_stats(samples)
+
+
+def benchmark_push_input(messages, notes_per_measure=16):
+    """
+    Latency of MuseEchoes.push_input on the midi input thread, with and without the input latency histogram.
+    """
+    rng = random.Random(0)
+    results = {}
+    for name, histogram in (('with_metric', metrics.input_latency), ('without_metric', None)):
+        muses = new_muses(seed=0)
+        muses.inputLatency = histogram
+        samples = []
+        measure_duration = muses.durations['1']
+        measure = 0
+        while len(samples) < messages:
+            for record in random_input_records(rng, notes_per_measure, measure * measure_duration, muses.bpm):
+                start = time.perf_counter()
+                muses.push_input(*record)
+                samples.append(time.perf_counter() - start)
+            muses.inputParser.take()
+            measure = measure + 1
+        muses.scheduler.stop()
+        results[name] = latency_stats(samples)
+    return results
+
+
+def benchmark_scale_change(changes, note_counts):
+    """
+    Cost of a scale change (mode estimate and chord sampling), for different amounts of input notes.
+    """
+    results = []
+    muses = new_muses(seed=0)
+    rng = random.Random(0)
+    for note_count in note_counts:
+        samples = []
+        for _ in range(changes):
+            for record in random_input_records(rng, note_count, 0, muses.bpm):
+                muses.push_input(*record)
+            start = time.perf_counter()
+            muses._update_scale()
+            samples.append(time.perf_counter() - start)
+        results.append({'notes': note_count, 'latency': latency_stats(samples)})
+    muses.scheduler.stop()
+    return results
+
+
+def benchmark_chord_progression(repetitions, length=4):
+    """
+    Latency of a chord progression, sampled freely and under constraints of increasing strictness.
+    The first constrained draw builds the cached sampling tables of the constraint set.
+    """
+    model = get_chord_markov_chain()
+    rng = np.random.default_rng(0)
+    constraint_sets = {
+        'free': None,
+        'last': {'last': ['I', 'V']},
+        'last_no_repeats': {'last': ['I', 'V'], 'no_repeats': True},
+        'first_last_no_repeats': {'first': ['IV', 'VI'], 'last': ['V'], 'no_repeats': True}
+    }
+    results = []
+    for name, constraints in constraint_sets.items():
+        samples = []
+        first_draw = 0.0
+        for repetition in range(repetitions + 1):
+            start = time.perf_counter()
+            if constraints is None:
+                model.sample(length, rng)
+            else:
+                model.sample_constrained(length, rng=rng, **constraints)
+            if repetition == 0:
+                first_draw = time.perf_counter() - start
+            else:
+                samples.append(time.perf_counter() - start)
+        results.append({'constraints': name, 'first_draw_us': first_draw * 1e6, 'latency': latency_stats(samples)})
+    return results
+
+
+def benchmark_snapshot(repetitions, trained_measures, notes_per_measure=16):
+    """
+    Cost of a snapshot of the learned state: capture on the generation thread,
+    serialization and write in the background and restore at startup, after some trained measures.
+    """
+    muses = new_muses(seed=0)
+    rng = random.Random(0)
+    measure_duration = muses.durations['1']
+    muses._update_scale()
+    muses._initialize_generation()
+    for measure in range(trained_measures):
+        for record in random_input_records(rng, notes_per_measure, measure * measure_duration, muses.bpm):
+            muses.push_input(*record)
+        muses.measureCount = measure % muses.measuresForScaleChange
+        muses._generate_measure()
+
+    # the restores are logged, away from the json results
+    metrics.get_logger().stream = sys.stderr
+    path = os.path.join(tempfile.mkdtemp(), 'snapshot.bin')
+    restored = new_muses(seed=1)
+    capture_samples = []
+    write_samples = []
+    restore_samples = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        build = muses._capture_snapshot()
+        capture_samples.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        write_snapshot(path, build())
+        write_samples.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        restored.restore_snapshot(path)
+        restore_samples.append(time.perf_counter() - start)
+    size = os.path.getsize(path)
+    os.remove(path)
+    muses.scheduler.stop()
+    restored.scheduler.stop()
+    return {
+        'note_contexts': muses.notesMarkovChain.context_count,
+        'rhythm_contexts': muses.rhythmMarkovChain.context_count,
+        'size_bytes': size,
+        'capture': latency_stats(capture_samples),
+        'write': latency_stats(write_samples),
+        'restore': latency_stats(restore_samples)
+    }
+
+
+def benchmark_sequencer_jitter(bpms, measures):
+    """
+    Timing jitter of the messages sent by the Sequencer, at different tempos.
+    """
+    results = []
+    for bpm in bpms:
+        clock = Clock()
+        sequencer = Sequencer(MemoryOutputPort(clock), MemoryOutputPort(clock), MemoryOutputPort(clock),
+                              bpm=bpm, clock=clock)
+        sequence = [{'note': 60 + i, 'duration': '8'} for i in range(8)]
+        start_time = clock.now() + 0.1
+        measure_duration = sequencer.tempoMap.durations_at(0)['1']
+        for measure in range(measures):
+            sequencer.play(sequence, [48, 52, 55], 36, 1, start_time + measure * measure_duration)
+        time.sleep(0.2 + measures * measure_duration)
+        sequencer.scheduler.stop()
+        stats = clock.get_stats()
+        results.append({
+            'bpm': bpm,
+            'parts': {part: {key: value * 1e6 if key != 'events' else value for key, value in part_stats.items()}
+                      for part, part_stats in stats.items()}
+        })
+    return results
+
+
+def run(quick=False):
+    """
+    Runs all the benchmarks.
+
+    :param quick: if True, fewer repetitions are used
+    :return: dictionary of results
+    """
+    repetitions = 50 if quick else 500
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'markov_chain': benchmark_markov_chain([1, 2, 3, 4], [4, 8, 16, 32], repetitions),
+        'measure': benchmark_measure(repetitions, 8),
+        'measure_generation_pool': benchmark_measure(repetitions, 8, processes=2),
+        'measure_melody_candidates': benchmark_measure(repetitions, 8, candidates=128),
+        'push_input': benchmark_push_input(repetitions * 20),
+        'scale_change': benchmark_scale_change(repetitions // 5, [8, 64, 512]),
+        'chord_progression': benchmark_chord_progression(repetitions * 20),
+        'snapshot': benchmark_snapshot(repetitions // 5, 2000),
+        'sequencer_jitter_us': benchmark_sequencer_jitter([74, 120, 180], 1 if quick else 4)
+    }
+
+
+if __name__ == '__main__':
+    arguments = [a for a in sys.argv[1:] if not a.startswith('--')]
+    results = run(quick='--quick' in sys.argv)
+    output = json.dumps(results, indent=2)
+    if arguments:
+        with open(arguments[0], 'w') as f:
+            f.write(output)
+    else:
+        print(output)
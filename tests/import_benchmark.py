@@ -0,0 +1,123 @@
+import sys
+import json
+import time
+import platform
+import subprocess
+import numpy as np
+
+"""
+Import time benchmark of the command line and of the entry modules.
+
+Each module is imported by a new interpreter, timed with -X importtime,
+and the startup of an empty interpreter is reported as the baseline.
+The modules imported by the command line before the port indices are
+validated are checked against the heavy subsystems, that must be loaded
+only after the validation (in the background while the ports are opened).
+
+usage (from the repository root): python -m tests.import_benchmark [output json file] [--repetitions=N]
+"""
+
+# entry modules of the package
+entry_modules = [
+    'muses_echoes.__main__',
+    'muses_echoes.muses',
+    'muses_echoes.sessions',
+    'muses_echoes.render',
+    'muses_echoes.replay'
+]
+
+# modules that must not be imported to print the usage of the command line
+heavy_modules = ['melodically', 'numpy', 'pythonosc', 'asyncio', 'http.server', 'multiprocessing']
+
+
+def import_profile(module):
+    """
+    Imports a module in a new interpreter, with -X importtime.
+
+    :param module: name of the module, None for an empty interpreter
+    :return: (wall time in seconds, dictionary of the cumulative import times in seconds by module) tuple
+    """
+    code = 'import {}'.format(module) if module is not None else 'pass'
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+    wall_time = time.perf_counter() - start
+    cumulative = {}
+    for line in process.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, total, name = line[len('import time:'):].split('|')
+        cumulative[name.strip()] = int(total) * 1e-6
+    return wall_time, cumulative
+
+
+def cli_usage_modules():
+    """
+    Runs the command line without arguments, so that it prints the usage.
+
+    :return: list of the heavy modules imported before printing the usage
+    """
+    code = ('import sys, runpy\n'
+            'sys.argv = ["muses_echoes"]\n'
+            'try:\n'
+            '    runpy.run_module("muses_echoes", run_name="__main__")\n'
+            'except BaseException:\n'
+            '    pass\n'
+            'sys.stderr.write("\\n".join(sys.modules))\n')
+    process = subprocess.run([sys.executable, '-c', code],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    imported = set(process.stderr.splitlines())
+    return [module for module in heavy_modules if module in imported]
+
+
+def benchmark_imports(modules, repetitions):
+    """
+    Measures the import time of some modules.
+
+    :param modules: list of module names
+    :param repetitions: number of interpreters started for each module
+    :return: dictionary of statistics by module, in milliseconds
+    """
+    baseline = np.median([import_profile(None)[0] for _ in range(repetitions)])
+    result = {'interpreter_startup_ms': baseline * 1e3}
+    for module in modules:
+        wall_times = []
+        import_times = []
+        for _ in range(repetitions):
+            wall_time, cumulative = import_profile(module)
+            wall_times.append(wall_time)
+            import_times.append(cumulative.get(module, 0.0))
+        result[module] = {
+            'import_ms': float(np.median(import_times)) * 1e3,
+            'wall_ms': float(np.median(wall_times)) * 1e3,
+            'wall_over_startup_ms': float(np.median(wall_times) - baseline) * 1e3
+        }
+    return result
+
+
+def run(repetitions):
+    """
+    Runs the import benchmark.
+
+    :param repetitions: number of interpreters started for each module
+    :return: dictionary of results
+    """
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'imports': benchmark_imports(entry_modules, repetitions),
+        'cli_usage_heavy_modules': cli_usage_modules()
+    }
+
+
+if __name__ == '__main__':
+    arguments = [a for a in sys.argv[1:] if not a.startswith('--')]
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    results = run(int(options.get('repetitions', 5)))
+    output = json.dumps(results, indent=2)
+    if arguments:
+        with open(arguments[0], 'w') as f:
+            f.write(output)
+    else:
+        print(output)
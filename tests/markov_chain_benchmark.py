@@ -0,0 +1,56 @@
+import random
+import timeit
+from muses_echoes.markov_chain import MarkovChain
+
+# benchmark of the native markov chain against the pomegranate one
+# usage (from the repository root): python -m tests.markov_chain_benchmark
+
+symbols = ['c', 'l', 'x']
+measures = 200
+sequence_length = 10
+order = 3
+inertia = 0.78
+
+
+class PomegranateMarkovChain:
+    """
+    The previous pomegranate implementation of the markov chain.
+    """
+
+    def __init__(self, pg, order=3, inertia=0.7):
+        self.pg = pg
+        self.markovChain = None
+        self.keepOldMelodies = inertia
+        self.order = order
+        self.isTheFirstMelody = True
+
+    def learn(self, sequence):
+        if self.isTheFirstMelody:
+            self.markovChain = self.pg.MarkovChain.from_samples([sequence], k=self.order)
+        else:
+            self.markovChain.fit([sequence], inertia=self.keepOldMelodies)
+
+    def generate(self, length):
+        return self.markovChain.sample(length)
+
+
+def run(chain, sequences):
+    for sequence in sequences:
+        chain.learn(sequence)
+        chain.generate(sequence_length)
+
+
+if __name__ == '__main__':
+    random.seed(0)
+    sequences = [[random.choice(symbols) for _ in range(sequence_length)] for _ in range(measures)]
+
+    implementations = [('native', lambda: MarkovChain(order=order, inertia=inertia))]
+    try:
+        import pomegranate
+        implementations.append(('pomegranate', lambda: PomegranateMarkovChain(pomegranate, order, inertia)))
+    except ImportError:
+        print('pomegranate not installed, skipping its benchmark')
+
+    for name, factory in implementations:
+        seconds = min(timeit.repeat(lambda: run(factory(), sequences), number=1, repeat=3))
+        print('{}: {:.3f} ms per measure (learn + generate)'.format(name, seconds / measures * 1000))
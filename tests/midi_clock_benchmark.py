@@ -0,0 +1,160 @@
+import sys
+import json
+import time
+import random
+import platform
+import numpy as np
+from muses_echoes.clock import Clock
+from muses_echoes.tempo import TempoMap
+from muses_echoes.midi_clock import MidiClockFollower, MidiClockGenerator, PPQN
+
+"""
+Benchmark of the synchronization with an external midi clock.
+
+A software clock with a random jitter drives a MidiClockFollower, and the
+beats of the steered tempo map are compared with the ideal (jitter-free)
+beats of the clock: the error of the map is the jitter that would reach
+the note timing. By default the ticks are fed on a virtual clock, with
+--realtime they are sent by a MidiClockGenerator thread.
+
+usage (from the repository root): python -m tests.midi_clock_benchmark [output json file] [--realtime]
+"""
+
+
+class _Message:
+    """
+    Minimal stand-in for a realtime mido message.
+    """
+
+    def __init__(self, msg_type):
+        self.type = msg_type
+
+
+_clock_message = _Message('clock')
+_start_message = _Message('start')
+
+
+# distance from the steady phase under which the map is considered settled after a tempo change, in seconds
+settle_tolerance = 0.002
+
+
+def follow_virtual(bpm, jitter, beats, tempo_change=None, seed=0):
+    """
+    Feeds the ticks of a jittered clock to a follower on a virtual clock.
+
+    :param bpm: tempo of the clock
+    :param jitter: standard deviation of the delay of the ticks in seconds
+    :param beats: number of beats
+    :param tempo_change: tempo from the second half of the beats, if None the tempo is constant
+    :param seed: seed of the jitter
+    :return: dictionary of results, with the errors in microseconds
+    """
+    rng = random.Random(seed)
+    tempo_map = TempoMap(bpm * 0.9)  # the internal tempo doesn't match the clock at first
+    follower = MidiClockFollower(tempo_map)
+
+    follower.receive(_start_message, 0.0)
+    ideal_time = 1.0
+    ideal_beats = []
+    for tick in range(beats * PPQN):
+        tick_bpm = tempo_change if tempo_change is not None and tick >= beats * PPQN // 2 else bpm
+        if tick % PPQN == 0:
+            ideal_beats.append(ideal_time)
+        follower.receive(_clock_message, ideal_time + abs(rng.gauss(0, jitter)))
+        ideal_time = ideal_time + 60 / (tick_bpm * PPQN)
+
+    # the first tick is placed on a beat of the map, the map is compared with the
+    # ideal beats after the first bars (and after the tempo change)
+    offset = round(tempo_map.beat_at(ideal_beats[0]))
+    settle = 16
+    errors = []
+    for beat, ideal in enumerate(ideal_beats):
+        if beat < settle or (tempo_change is not None and beats // 2 <= beat < beats // 2 + settle):
+            continue
+        errors.append(tempo_map.time_at(beat + offset) - ideal)
+    errors = np.array(errors)
+    # the mean error is a constant latency (the mean delay of the ticks), the rest is jitter
+    centered = errors - errors.mean()
+    stats = follower.get_stats()
+    settle_beats = None
+    if tempo_change is not None:
+        # beats after the change until the map stays within the tolerance of its steady phase
+        step = np.array([tempo_map.time_at(beat + offset) - ideal_beats[beat] for beat in range(beats // 2, beats)])
+        step = np.abs(step - step[len(step) // 2:].mean())
+        outside = np.nonzero(step > settle_tolerance)[0]
+        settle_beats = int(outside[-1]) + 1 if len(outside) > 0 else 0
+    return {
+        'bpm': bpm,
+        'tempo_change': tempo_change,
+        'input_jitter_us': jitter * 1e6,
+        'estimated_bpm': stats['bpm'],
+        'settle_beats': settle_beats,
+        'map_latency_us': float(errors.mean()) * 1e6,
+        'map_jitter_rms_us': float(np.sqrt((centered ** 2).mean())) * 1e6,
+        'map_jitter_max_us': float(np.abs(centered).max()) * 1e6,
+        'follower': {key: value * 1e6 if key.startswith(('jitter', 'phase')) else value
+                     for key, value in stats.items()}
+    }
+
+
+class _FollowerPort:
+    """
+    Output port stand-in passing the messages of a generator to a follower, timestamped on arrival.
+    """
+
+    def __init__(self, follower, clock):
+        self.follower = follower
+        self.clock = clock
+
+    def send(self, msg):
+        self.follower.receive(msg, self.clock.now())
+
+
+def follow_realtime(bpm, jitter, seconds):
+    """
+    Follows a MidiClockGenerator running in its own thread.
+
+    :param bpm: tempo of the generator
+    :param jitter: standard deviation of the delay of the ticks in seconds
+    :param seconds: duration of the run
+    :return: statistics of the follower, with the errors in microseconds
+    """
+    clock = Clock()
+    tempo_map = TempoMap(bpm * 0.9, clock=clock)
+    follower = MidiClockFollower(tempo_map)
+    generator = MidiClockGenerator(_FollowerPort(follower, clock), bpm, jitter=jitter, clock=clock, seed=0)
+    generator.start()
+    time.sleep(seconds)
+    generator.stop()
+    stats = follower.get_stats()
+    return {key: value * 1e6 if key.startswith(('jitter', 'phase')) else value for key, value in stats.items()}
+
+
+def run(realtime=False):
+    """
+    Runs the benchmark.
+
+    :param realtime: if True, the clock is also followed in real time
+    :return: dictionary of results
+    """
+    result = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'virtual': [follow_virtual(bpm, jitter, 256) for bpm in (90, 120, 174) for jitter in (0.0, 0.0005, 0.002)],
+        'tempo_change': [follow_virtual(120, 0.001, 256, tempo_change) for tempo_change in (124, 140)]
+    }
+    if realtime:
+        result['realtime'] = [follow_realtime(120, jitter, 5) for jitter in (0.0, 0.001)]
+    return result
+
+
+if __name__ == '__main__':
+    arguments = [a for a in sys.argv[1:] if not a.startswith('--')]
+    results = run(realtime='--realtime' in sys.argv)
+    output = json.dumps(results, indent=2)
+    if arguments:
+        with open(arguments[0], 'w') as f:
+            f.write(output)
+    else:
+        print(output)
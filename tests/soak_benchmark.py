@@ -0,0 +1,125 @@
+import sys
+import json
+import time
+import random
+import platform
+import resource
+from muses_echoes.muses import MuseEchoes
+from muses_echoes.sequencer import Sequencer
+from tests.benchmark import MemoryOscClient, random_input_records
+
+"""
+Soak benchmark of a long-running session.
+
+A MuseEchoes object plays many simulated measures, with random input notes
+on a virtual clock, while the resident memory of the process and the size
+of the Markov chains are sampled at regular intervals. The midi messages
+are sent by the real sequencer to ports discarding them, so that nothing
+in the benchmark itself grows with the number of measures.
+
+usage (from the repository root): python -m tests.soak_benchmark [output json file] [--measures=N]
+"""
+
+
+class NullOutputPort:
+    """
+    Stand-in for a mido output port, discarding the sent messages.
+    """
+
+    def send(self, msg):
+        pass
+
+
+def resident_memory():
+    """
+    Resident memory of the process, read from /proc on Linux (peak resident memory elsewhere).
+
+    :return: resident memory in megabytes
+    """
+    try:
+        with open('/proc/self/statm') as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize() / 2 ** 20
+    except OSError:
+        usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return usage / 2 ** 20 if sys.platform == 'darwin' else usage / 2 ** 10
+
+
+def soak(measures, samples=50, notes_per_measure=8, bpm=74):
+    """
+    Plays a number of simulated measures, sampling the memory of the process.
+
+    :param measures: number of measures
+    :param samples: number of memory samples
+    :param notes_per_measure: number of input notes of each measure
+    :param bpm: beats per minutes
+    :return: list of samples dictionaries
+    """
+    sequencer = Sequencer(NullOutputPort(), NullOutputPort(), NullOutputPort(), bpm=bpm)
+    muses = MuseEchoes(midi_in_port=None,
+                       midi_sequence_out_port=None,
+                       midi_chord_out_port=None,
+                       midi_rhythm_out_port=None,
+                       osc_ip=None,
+                       bpm=bpm,
+                       seed=0,
+                       sequencer=sequencer,
+                       scheduler=sequencer.scheduler)
+    muses.oscClient = MemoryOscClient()
+    muses.inputLatency = None
+    muses.bufferFullEvent.set()
+    rng = random.Random(0)
+    measure_duration = muses.durations['1']
+    interval = max(measures // samples, 1)
+
+    result = []
+    start = time.perf_counter()
+    for measure in range(measures):
+        for record in random_input_records(rng, notes_per_measure, measure * measure_duration, bpm):
+            muses.push_input(*record)
+        # the measures start in the past, so that their messages are sent at once
+        # instead of piling up in the scheduler of a session faster than real time
+        muses.process_measure(muses.clock.now() - measure_duration)
+        muses.oscClient.messages.clear()
+
+        if (measure + 1) % interval == 0 or measure == measures - 1:
+            result.append({
+                'measures': measure + 1,
+                'elapsed_s': time.perf_counter() - start,
+                'rss_mb': resident_memory(),
+                'note_contexts': muses.notesMarkovChain.context_count,
+                'rhythm_contexts': muses.rhythmMarkovChain.context_count
+            })
+    sequencer.scheduler.stop()
+    return result
+
+
+def run(measures):
+    """
+    Runs the soak benchmark.
+
+    :param measures: number of measures
+    :return: dictionary of results
+    """
+    samples = soak(measures)
+    # the growth is measured on the second half of the run, when the caches and the allocator are warm
+    warm = samples[len(samples) // 2]
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'timestamp': time.time(),
+        'measures': measures,
+        'rss_growth_mb': samples[-1]['rss_mb'] - warm['rss_mb'],
+        'samples': samples
+    }
+
+
+if __name__ == '__main__':
+    arguments = [a for a in sys.argv[1:] if not a.startswith('--')]
+    options = dict(a[2:].split('=', 1) for a in sys.argv[1:] if a.startswith('--') and '=' in a)
+    results = run(int(options.get('measures', 100000)))
+    output = json.dumps(results, indent=2)
+    if arguments:
+        with open(arguments[0], 'w') as f:
+            f.write(output)
+    else:
+        print(output)
@@ -0,0 +1,34 @@
+import numpy as np
+from muses_echoes.chords import get_chord_markov_chain
+
+"""
+Tests of the constrained sampling of the chord progressions.
+"""
+
+
+class _FixedRandom:
+    """
+    Random generator returning a fixed value.
+    """
+
+    def __init__(self, value):
+        self.value = value
+
+    def random(self):
+        return self.value
+
+
+def test_short_previous_progression_is_the_whole_context():
+    chain = get_chord_markov_chain()
+    assert chain.order == 3
+    previous = ['I', 'V']
+    i, j = (chain.symbols.index(degree) for degree in previous)
+
+    # the first chord follows both the previous chords, not only the last one
+    cumulative = np.cumsum(chain.transitions[2][i, j])
+    assert not np.allclose(chain.transitions[2][i, j], chain.transitions[1][j])
+    for value in np.linspace(0, 1, 41, endpoint=False).tolist():
+        chord = chain.sample_constrained(1, previous=previous, rng=_FixedRandom(value))[0]
+        expected = chain.symbols[min(int(np.searchsorted(cumulative, value * cumulative[-1], side='right')),
+                                     len(chain.symbols) - 1)]
+        assert chord == expected
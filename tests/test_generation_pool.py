@@ -0,0 +1,49 @@
+from muses_echoes.generation_pool import GenerationPool
+
+"""
+Tests of the models hosted by the worker processes of a GenerationPool.
+"""
+
+
+def test_batch_larger_than_the_capacity_is_split():
+    pool = GenerationPool(1, capacity=64)
+    try:
+        chain = pool.markov_chain(order=2, inertia=0.7, seed=0)
+        sequence = ['c4', 'l8', 'x16', 'c4', 'r4', 'l8', 'c8', 'x16']
+        chain.learn(sequence)
+
+        symbols, indices = chain.generate_batch(20, 16)
+        assert indices.shape == (20, 16)
+        assert set(symbols) == set(sequence)
+        assert indices.min() >= 0 and indices.max() < len(symbols)
+
+        # the sequences follow the learned transitions of order 1
+        transitions = set(zip(sequence, sequence[1:]))
+        for row in indices.tolist():
+            generated = [symbols[index] for index in row]
+            assert set(zip(generated, generated[1:])) <= transitions
+
+        # a sequence longer than the capacity is clipped, as in generate
+        _, indices = chain.generate_batch(3, 100)
+        assert indices.shape == (3, 64)
+    finally:
+        pool.close()
+
+
+def test_copy_exports_the_state_when_it_was_taken():
+    pool = GenerationPool(1)
+    try:
+        chain = pool.markov_chain(order=2, inertia=0.7, seed=0)
+        chain.learn(['c4', 'l8', 'x16', 'c4', 'l8'])
+        copy = chain.copy()
+        chain.learn(['r4', 'c2'])
+        assert sorted(copy.get_state()['symbols']) == ['c4', 'l8', 'x16']
+        assert sorted(chain.get_state()['symbols']) == ['c2', 'c4', 'l8', 'r4', 'x16']
+
+        # only the last copy is kept by the worker
+        replaced = chain.copy()
+        last = chain.copy()
+        assert replaced.get_state() is None
+        assert sorted(last.get_state()['symbols']) == ['c2', 'c4', 'l8', 'r4', 'x16']
+    finally:
+        pool.close()
@@ -0,0 +1,28 @@
+from muses_echoes.input_parser import StreamingParser, NOTE_ON, NOTE_OFF
+from muses_echoes.tempo import durations
+
+"""
+Tests of the StreamingParser of the input notes.
+"""
+
+
+def test_overlapping_notes_keep_the_sequences_in_step():
+    parser = StreamingParser(durations(120, triplets=False))
+    # a long C held under a short E: the E ends first, and is followed by a rest as in melodically.parse_rhythm
+    parser.push(NOTE_ON, 60, 10.0)
+    parser.push(NOTE_ON, 64, 10.25)
+    parser.push(NOTE_OFF, 64, 10.5)
+    parser.push(NOTE_OFF, 60, 12.0)
+    rhythm_sequence, pitch_classes = parser.take()
+    assert rhythm_sequence == ['8', 'r8', '1']
+    assert pitch_classes == [4, 0]
+
+
+def test_held_note_is_parsed_in_the_next_measure():
+    parser = StreamingParser(durations(120, triplets=False))
+    parser.push(NOTE_ON, 60, 10.0)
+    parser.push(NOTE_OFF, 60, 10.5)
+    parser.push(NOTE_ON, 67, 11.5)
+    assert parser.take() == (['4', 'r4'], [0])
+    parser.push(NOTE_OFF, 67, 12.5)
+    assert parser.take() == (['2'], [7])
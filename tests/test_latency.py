@@ -0,0 +1,83 @@
+import mido
+from muses_echoes.clock import Clock
+from muses_echoes.latency import calibrate, load_latencies, save_latencies
+
+"""
+Tests of the latency offsets and of their calibration through a loopback.
+"""
+
+
+class _Loopback:
+    """
+    Loopback input port, receiving the messages of the output ports after their latency.
+    """
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.pending = []
+
+    def iter_pending(self):
+        pending, self.pending = self.pending, []
+        return iter([msg for _, msg in pending])
+
+    def poll(self):
+        if self.pending and self.pending[0][0] <= self.clock.now():
+            return self.pending.pop(0)[1]
+        return None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+class _DelayedOutputPort:
+    """
+    Output port sending its messages to a loopback after some seconds.
+    """
+
+    def __init__(self, loopback, delay):
+        self.loopback = loopback
+        self.delay = delay
+
+    def send(self, msg):
+        self.loopback.pending.append((self.loopback.clock.now() + self.delay, msg))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+
+def _open_loopback(monkeypatch, delays):
+    """
+    Utility function that replaces the midi ports opened by the calibration with a loopback.
+
+    :param monkeypatch: pytest monkeypatch fixture
+    :param delays: dictionary of the latencies in seconds by output port name
+    """
+    loopback = _Loopback(Clock())
+    monkeypatch.setattr(mido, 'open_input', lambda name: loopback)
+    monkeypatch.setattr(mido, 'open_output', lambda name: _DelayedOutputPort(loopback, delays[name]))
+
+
+def test_offsets_are_written_and_read(tmp_path):
+    path = str(tmp_path / 'latency.json')
+    save_latencies(path, {'synth': 0.02}, {('127.0.0.1', 1337): 0.1})
+    assert load_latencies(path) == ({'synth': 0.02}, {('127.0.0.1', 1337): 0.1})
+
+
+def test_calibration_replaces_the_offsets_of_another_reference(tmp_path, monkeypatch):
+    path = str(tmp_path / 'latency.json')
+    save_latencies(path, {'synth': 0.5, 'drums': 0.0}, {('127.0.0.1', 1337): 0.1})
+    _open_loopback(monkeypatch, {'synth': 0.03, 'piano': 0.01})
+
+    results = calibrate(path, 'loopback', ['synth', 'piano'], pulses=2)
+    assert results['piano']['lost'] == 0
+    midi, osc = load_latencies(path)
+    assert set(midi) == {'synth', 'piano'}
+    assert midi['piano'] == 0
+    assert abs(midi['synth'] - 0.02) < 0.005
+    assert osc == {('127.0.0.1', 1337): 0.1}
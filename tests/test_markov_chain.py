@@ -0,0 +1,94 @@
+import random
+import tracemalloc
+import numpy as np
+from muses_echoes.markov_chain import MarkovChain
+
+"""
+Tests of MarkovChain.generate_batch.
+"""
+
+alphabet = ['c4', 'l8', 'x16', 'r4', 'c8', 'l4', 'x8', 'c16', 'r8', 'l16', 'x4', 'c2']
+
+
+def _trained_chain(order, measures, seed=0):
+    """
+    Utility function that learns random measures over a fixed alphabet, generating a batch after each one.
+
+    :param order: order of the markov chain
+    :param measures: number of learned measures
+    :param seed: random seed
+    :return: MarkovChain object
+    """
+    rng = random.Random(seed)
+    chain = MarkovChain(order=order, inertia=0.78, rng=np.random.default_rng(seed))
+    chain.learn(alphabet)
+    chain.generate_batch(16, 16)
+    for _ in range(measures):
+        chain.learn([rng.choice(alphabet) for _ in range(16)])
+        chain.generate_batch(16, 16)
+    return chain
+
+
+def test_batch_follows_the_transitions():
+    chain = MarkovChain(order=2, rng=np.random.default_rng(0))
+    chain.learn(['a', 'b', 'c'] * 8)
+    symbols, indices = chain.generate_batch(64, 12)
+    assert indices.shape == (64, 12)
+    for sequence in indices.tolist():
+        # every symbol after the first one follows from the previous one
+        generated = ''.join(symbols[i] for i in sequence)
+        assert generated[:3] in ('abc', 'bca', 'cab')
+        assert generated == generated[:3] * 4
+
+
+def test_batch_has_the_distribution_of_generate():
+    chain = MarkovChain(order=3, rng=np.random.default_rng(0))
+    chain.learn(['c4', 'l8', 'c4', 'x16', 'c4', 'l8', 'r4', 'c4', 'l8'])
+    symbols, indices = chain.generate_batch(20000, 6)
+    batch = np.bincount(indices[:, -1], minlength=len(symbols)) / 20000
+    single = np.zeros(len(symbols))
+    for _ in range(20000):
+        single[symbols.index(chain.generate(6)[-1])] += 1 / 20000
+    np.testing.assert_allclose(batch, single, atol=0.02)
+
+
+def test_incremental_table_matches_a_rebuilt_one():
+    for order in (3, 5):
+        chain = _trained_chain(order, 200)
+        rebuilt = MarkovChain(order=order)
+        rebuilt.set_state(chain.get_state())
+
+        # the same draws give the same sequences
+        chain.rng = np.random.default_rng(1)
+        rebuilt.rng = np.random.default_rng(1)
+        symbols, indices = chain.generate_batch(256, 16)
+        rebuilt_symbols, rebuilt_indices = rebuilt.generate_batch(256, 16)
+        assert symbols == rebuilt_symbols
+        np.testing.assert_array_equal(indices, rebuilt_indices)
+
+
+def test_new_symbol_is_generated():
+    chain = _trained_chain(3, 10)
+    chain.learn(['c4', 'l8', 'c1'])
+    symbols, indices = chain.generate_batch(256, 16)
+    assert 'c1' in symbols
+    assert (indices == symbols.index('c1')).any()
+
+
+def test_memory_grows_with_the_contexts_not_with_the_order():
+    tracemalloc.start()
+    try:
+        chain = _trained_chain(6, 20)
+        chain.generate_batch(128, 16)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    # 13 ** 6 possible histories of 12 symbols, a few hundred observed contexts
+    assert peak < 8 * 2 ** 20
+
+
+def test_batch_beyond_the_code_range_is_generated_one_by_one():
+    chain = _trained_chain(20, 5)
+    symbols, indices = chain.generate_batch(8, 30)
+    assert indices.shape == (8, 30)
+    assert set(indices.ravel().tolist()) <= set(range(len(symbols)))
@@ -0,0 +1,89 @@
+import io
+import time
+import threading
+import urllib.request
+from muses_echoes import metrics
+from muses_echoes.metrics import Registry, InstrumentedLock, AsyncLogger
+
+"""
+Tests of the metrics, of their Prometheus rendering and of the asynchronous logger.
+"""
+
+
+def test_counters_and_histograms_are_rendered():
+    registry = Registry()
+    counter = registry.counter('test_events_total', 'events', ('part',))
+    histogram = registry.histogram('test_seconds', 'durations', buckets=(0.1, 1.0))
+    counter.labels(part='melody').inc()
+    counter.labels(part='melody').inc(2)
+    counter.labels(part='chords').inc()
+    for value in (0.05, 0.5, 5.0):
+        histogram.observe(value)
+
+    # the same name gives the same metric
+    assert registry.counter('test_events_total', 'events', ('part',)) is counter
+
+    lines = registry.render().splitlines()
+    assert '# TYPE test_events_total counter' in lines
+    assert 'test_events_total{part="melody"} 3' in lines
+    assert 'test_events_total{part="chords"} 1' in lines
+    assert '# TYPE test_seconds histogram' in lines
+    assert 'test_seconds_bucket{le="0.1"} 1' in lines
+    assert 'test_seconds_bucket{le="1.0"} 2' in lines
+    assert 'test_seconds_bucket{le="+Inf"} 3' in lines
+    assert 'test_seconds_sum 5.55' in lines
+    assert 'test_seconds_count 3' in lines
+
+    counter.remove(part='chords')
+    assert 'test_events_total{part="chords"} 1' not in registry.render().splitlines()
+
+
+def test_instrumented_lock_measures_the_wait():
+    registry = Registry()
+    lock = InstrumentedLock('test', registry)
+    holding = threading.Event()
+
+    def hold():
+        with lock:
+            holding.set()
+            time.sleep(0.05)
+
+    thread = threading.Thread(target=hold)
+    thread.start()
+    holding.wait()
+    with lock:
+        pass
+    thread.join()
+
+    lines = registry.render().splitlines()
+    assert 'muses_lock_hold_seconds_count{lock="test"} 2' in lines
+    assert 'muses_lock_wait_seconds_count{lock="test"} 2' in lines
+    wait_sum = [line for line in lines if line.startswith('muses_lock_wait_seconds_sum')][0]
+    assert float(wait_sum.split()[-1]) > 0.01
+
+
+def test_server_exposes_the_registry():
+    registry = Registry()
+    registry.counter('test_scrapes_total', 'scrapes').inc()
+    server = metrics.MetricsServer(0, registry)
+    server.start()
+    try:
+        with urllib.request.urlopen('http://127.0.0.1:{}/metrics'.format(server.port), timeout=5) as response:
+            assert response.status == 200
+            assert 'test_scrapes_total 1' in response.read().decode('utf-8').splitlines()
+    finally:
+        server.stop()
+
+
+def test_logger_formats_the_messages_in_its_thread():
+    stream = io.StringIO()
+    logger = AsyncLogger(stream)
+    logger.log('measure {} chord {}', 3, 'I')
+    logger.log('broken {}')
+    deadline = time.time() + 5
+    while stream.getvalue().count('\n') < 2 and time.time() < deadline:
+        time.sleep(0.01)
+    # a broken message is reported, and the logger keeps running
+    lines = stream.getvalue().splitlines()
+    assert lines[0] == 'measure 3 chord I'
+    assert lines[1].startswith('logging error:')
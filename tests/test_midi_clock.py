@@ -0,0 +1,91 @@
+import time
+import mido
+from muses_echoes.tempo import TempoMap
+from muses_echoes.midi_clock import MidiClockFollower, MidiClockGenerator, PPQN
+
+"""
+Tests of the synchronization with an external midi clock.
+"""
+
+
+class _MemoryPort:
+    """
+    In-memory stand-in for a mido output port.
+    """
+
+    def __init__(self):
+        self.messages = []
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+
+def _follow(follower, bpm, beats, start_time=1.0):
+    """
+    Utility function that sends the ticks of a steady clock to a follower.
+
+    :param follower: MidiClockFollower object
+    :param bpm: tempo of the clock
+    :param beats: number of beats
+    :param start_time: time of the first tick
+    :return: time of the last tick
+    """
+    period = 60 / (bpm * PPQN)
+    tick = mido.Message('clock')
+    for i in range(beats * PPQN + 1):
+        follower.receive(tick, start_time + i * period)
+    return start_time + beats * PPQN * period
+
+
+def test_follower_locks_on_the_clock():
+    tempo_map = TempoMap(100)
+    follower = MidiClockFollower(tempo_map)
+    follower.receive(mido.Message('start'), 0.0)
+    last_tick = _follow(follower, 120, 16)
+
+    stats = follower.get_stats()
+    assert stats['running'] and stats['locked']
+    assert abs(stats['bpm'] - 120) < 1e-6
+    assert stats['phase_error_max'] < 1e-3
+    # the last tick is on a downbeat of the map
+    assert abs(tempo_map.beat_at(last_tick) - round(tempo_map.beat_at(last_tick))) < 1e-3
+    assert round(tempo_map.beat_at(last_tick)) % tempo_map.beatsPerMeasure == 0
+
+
+def test_continue_starts_from_the_song_position():
+    tempo_map = TempoMap(120)
+    follower = MidiClockFollower(tempo_map)
+    follower.receive(mido.Message('start'), 0.0)
+    _follow(follower, 120, 8)
+    follower.receive(mido.Message('stop'), 5.0)
+    assert not follower.get_stats()['running']
+
+    # continuing from the second beat of a measure of the song
+    follower.receive(mido.Message('songpos', pos=4), 5.0)
+    follower.receive(mido.Message('continue'), 5.0)
+    first_tick = 10.0
+    _follow(follower, 120, 4, first_tick)
+    assert follower.get_stats()['running']
+    assert round(tempo_map.beat_at(first_tick)) % tempo_map.beatsPerMeasure == 1
+
+
+def test_generator_sends_start_ticks_and_stop():
+    port = _MemoryPort()
+    generator = MidiClockGenerator(port, bpm=300)
+    generator.start()
+    while generator.ticks < PPQN:
+        time.sleep(0.01)
+    generator.stop()
+    types = [msg.type for msg in port.messages]
+    assert types[0] == 'start' and types[-1] == 'stop'
+    assert types.count('clock') >= PPQN
+
+    # a stopped generator doesn't send another stop
+    generator.stop()
+    assert [msg.type for msg in port.messages].count('stop') == 1
+
+
+def test_generator_not_started_sends_nothing():
+    port = _MemoryPort()
+    MidiClockGenerator(port).stop()
+    assert port.messages == []
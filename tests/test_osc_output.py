@@ -0,0 +1,97 @@
+import time
+import socket
+from pythonosc.osc_bundle import OscBundle
+from muses_echoes.osc_output import OscOutput
+
+"""
+Tests of the bundles sent by the OscOutput.
+"""
+
+
+def _receiver():
+    """
+    Utility function that opens a udp socket on localhost.
+
+    :return: (socket, (ip, port) destination) tuple
+    """
+    receiver = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    receiver.bind(('127.0.0.1', 0))
+    receiver.settimeout(0.05)
+    return receiver, receiver.getsockname()
+
+
+def _wait_until_reachable(output, receiver, timeout=5):
+    """
+    Utility function that sends messages until the destination receives one, and discards them.
+
+    :param output: OscOutput object
+    :param receiver: socket of the destination
+    :param timeout: seconds after which the destination is considered unreachable
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        output.send_message('/ping', 1)
+        try:
+            receiver.recv(65536)
+            break
+        except socket.timeout:
+            pass
+    else:
+        raise AssertionError('the destination is not reachable')
+    try:
+        while True:
+            receiver.recv(65536)
+    except socket.timeout:
+        pass
+
+
+def test_bundles_have_the_timetag_of_their_event():
+    receiver, destination = _receiver()
+    output = OscOutput([destination])
+    try:
+        _wait_until_reachable(output, receiver)
+        event_time = time.time() + 10
+        output.send_message('/chord', 'I', timetag=event_time)
+        bundle = OscBundle(receiver.recv(65536))
+        assert abs(bundle.timestamp - event_time) < 1e-3
+        assert bundle.content(0).address == '/chord'
+    finally:
+        output.close()
+        receiver.close()
+
+
+def test_large_frames_are_split_in_datagrams():
+    receiver, destination = _receiver()
+    output = OscOutput([destination], rate=5)
+    try:
+        _wait_until_reachable(output, receiver)
+        # 200 messages of about 140 bytes, queued between two frames
+        for i in range(200):
+            output.send_message('/notes', 'x' * 128)
+        datagrams = []
+        try:
+            while True:
+                receiver.settimeout(1)
+                datagrams.append(receiver.recv(65536))
+        except socket.timeout:
+            pass
+        assert len(datagrams) > 1
+        assert all(len(datagram) <= 8192 for datagram in datagrams)
+        assert sum(OscBundle(datagram).num_contents for datagram in datagrams) == 200
+    finally:
+        output.close()
+        receiver.close()
+
+
+def test_frames_dropped_by_every_destination_are_not_sent():
+    receiver, destination = _receiver()
+    # every frame exceeds the buffer of the destination
+    output = OscOutput([destination], max_buffer=-1)
+    try:
+        output.send_message('/chord', 'I')
+    finally:
+        output.close()
+        receiver.close()
+    stats = output.get_stats()
+    assert stats['sent_frames'] == 0
+    assert stats['dropped_frames'] == {'{}:{}'.format(*destination): 1}
@@ -0,0 +1,106 @@
+import mido
+import numpy as np
+from muses_echoes.muses import MuseEchoes
+from muses_echoes.render import note_list_records
+from muses_echoes.replay import SessionRecorder, replay
+from muses_echoes.sequencer import MidiFileSequencer
+
+"""
+Tests of the replay of the sessions recorded with tempo changes.
+"""
+
+
+def _midi_events(midi_file):
+    """
+    Utility function that lists the notes of a midi file, with their ticks from the first note.
+
+    :param midi_file: mido.MidiFile object
+    :return: list of (track index, tick, message bytes) tuples
+    """
+    events = []
+    for index, track in enumerate(midi_file.tracks):
+        tick = 0
+        for message in track:
+            tick = tick + message.time
+            if not message.is_meta:
+                events.append((index, tick, tuple(message.bytes())))
+    first = min(tick for _, tick, _ in events)
+    return [(index, tick - first, data) for index, tick, data in events]
+
+
+def _record_session(path, tempo_changes, measures=24, first_measure=5, **kwargs):
+    """
+    Utility function that records a session on a virtual clock, changing its tempo between the measures.
+
+    :param path: path of the session log
+    :param tempo_changes: dictionary of functions called with the MuseEchoes object before some measures
+    :param measures: number of measures
+    :param first_measure: index of the first measure in the tempo map, so that the replay moves the time origin
+    :param kwargs: additional parameters of the MuseEchoes constructor
+    :return: (mido.MidiFile, list of the generated measures) tuple
+    """
+    rng = np.random.default_rng(0)
+    sequencer = MidiFileSequencer(bpm=120)
+    recorder = SessionRecorder(path)
+    # the generation starts on the first measure, after its input notes
+    muses = MuseEchoes(None, None, None, None, osc_ip=None, bpm=120, seed=1, sequencer=sequencer, recorder=recorder,
+                       melody_candidates=16, midi_buffer_size=1, **kwargs)
+
+    tempo_map = muses.tempoMap
+    result = []
+    for measure in range(first_measure, first_measure + measures):
+        if measure in tempo_changes:
+            tempo_changes[measure](muses)
+
+        # the input notes of the previous measure, each one lasting a quarter of a beat at the current tempo
+        start = tempo_map.time_at((measure - 1) * tempo_map.beatsPerMeasure)
+        beat = 60 / tempo_map.bpm_at((measure - 1) * tempo_map.beatsPerMeasure)
+        notes = [(start + i * beat / 2, int(rng.integers(55, 80)), beat / 4) for i in range(8)]
+        for record in note_list_records(notes):
+            muses.push_input(*record)
+
+        generated = muses.process_measure(tempo_map.time_at(measure * tempo_map.beatsPerMeasure))
+        if generated is not None:
+            result.append(generated)
+    recorder.close()
+    muses.scheduler.stop()
+    return sequencer.to_midi_file(), result
+
+
+def test_replay_follows_the_tempo_changes(tmp_path):
+    path = str(tmp_path / 'session.log')
+    midi_file, measures = _record_session(path, {
+        9: lambda muses: muses.set_bpm(90),
+        14: lambda muses: muses.ramp_bpm(140, 8, curve='exponential'),
+        20: lambda muses: muses.tempoMap.locate(muses.tempoMap.next_measure(muses.measureStartTime),
+                                                muses.measureStartTime + 3.0, 100)
+    })
+    replayed_file, replayed = replay(path)
+    assert [m['midi_notes'] for m in replayed] == [m['midi_notes'] for m in measures]
+    assert [m['rhythmic_pattern'] for m in replayed] == [m['rhythmic_pattern'] for m in measures]
+    assert _midi_events(replayed_file) == _midi_events(midi_file)
+
+
+def test_replay_follows_the_midi_clock(tmp_path):
+    path = str(tmp_path / 'session.log')
+    rng = np.random.default_rng(1)
+    start_time = 10.0
+    period = 60 / (112 * 24)
+
+    def send_clock(muses):
+        # the ticks of the previous measure of the external clock, with a jitter of 1 ms
+        first_tick = (muses.measureCount + 1) * 96 if muses.clockFollower.running.is_set() else 0
+        if first_tick == 0:
+            muses.clockFollower.receive(mido.Message('start'), start_time)
+        for tick in range(first_tick, first_tick + 96):
+            muses.clockFollower.receive(mido.Message('clock'), start_time + tick * period + rng.normal(0, 1e-3))
+
+    midi_file, measures = _record_session(path, {measure: send_clock for measure in range(6, 29)}, midi_clock=True,
+                                           measures_for_scale_change=64)
+    replayed_file, replayed = replay(path)
+
+    # the measures follow the tempo of the clock
+    assert abs(measures[-1]['start_time'] - measures[-2]['start_time'] - 4 * 24 * period) < 5e-3
+    assert [m['midi_notes'] for m in replayed] == [m['midi_notes'] for m in measures]
+    assert [m['rhythmic_pattern'] for m in replayed] == [m['rhythmic_pattern'] for m in measures]
+    assert _midi_events(replayed_file) == _midi_events(midi_file)
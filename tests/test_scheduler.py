@@ -0,0 +1,77 @@
+import threading
+from muses_echoes.scheduler import Scheduler
+
+"""
+Tests of the timing thread of the Scheduler.
+"""
+
+
+def test_failing_callback_does_not_stop_the_timing_thread():
+    scheduler = Scheduler()
+    fired = threading.Event()
+
+    def fail():
+        raise OSError('port closed')
+
+    now = scheduler.clock.now()
+    scheduler.start()
+    try:
+        scheduler.schedule(now + 0.01, fail, stream='melody')
+        scheduler.schedule(now + 0.02, fired.set, stream='chords')
+        assert fired.wait(1.0)
+        assert scheduler.errors == 1
+    finally:
+        scheduler.stop()
+
+
+def test_events_are_executed_by_deadline_and_priority():
+    scheduler = Scheduler()
+    executed = []
+    done = threading.Event()
+
+    now = scheduler.clock.now()
+    # scheduled out of order before the thread starts, then pushed in front of a waiting thread
+    scheduler.schedule_many([(now + 0.3, executed.append, ('late',), 0, None),
+                             (now + 0.2, executed.append, ('second',), 1, None),
+                             (now + 0.2, executed.append, ('first',), 0, None),
+                             (now + 0.2, executed.append, ('third',), 1, None)])
+    scheduler.schedule(now + 0.4, done.set)
+    scheduler.start()
+    try:
+        scheduler.schedule(now + 0.1, executed.append, ('early',))
+        assert done.wait(1.0)
+        assert executed == ['early', 'first', 'second', 'third', 'late']
+        assert scheduler.pending() == 0
+    finally:
+        scheduler.stop()
+
+
+def test_events_are_not_executed_before_their_deadline():
+    scheduler = Scheduler()
+    times = []
+    done = threading.Event()
+
+    def record():
+        times.append(scheduler.clock.now())
+        done.set()
+
+    deadline = scheduler.clock.now() + 0.03
+    scheduler.start()
+    try:
+        scheduler.schedule(deadline, record, stream='melody')
+        assert done.wait(1.0)
+        assert times[0] >= deadline
+        assert scheduler.clock.get_stats()['melody']['events'] == 1
+    finally:
+        scheduler.stop()
+
+
+def test_stop_discards_the_pending_events():
+    scheduler = Scheduler()
+    fired = threading.Event()
+    scheduler.start()
+    scheduler.schedule(scheduler.clock.now() + 0.5, fired.set)
+    assert scheduler.pending() == 1
+    scheduler.stop()
+    assert scheduler.pending() == 0
+    assert not fired.wait(0.6)
@@ -0,0 +1,66 @@
+import os
+import time
+from muses_echoes.input_parser import NOTE_ON, NOTE_OFF
+from muses_echoes.sessions import SessionManager
+from muses_echoes.snapshot import read_snapshot
+
+"""
+Tests of the sessions hosted by a SessionManager.
+"""
+
+
+class _MemoryOutputPort:
+    """
+    In-memory stand-in for a mido output port.
+    """
+
+    def __init__(self):
+        self.messages = []
+        self.closed = False
+
+    def send(self, msg):
+        self.messages.append(msg)
+
+    def close(self):
+        self.closed = True
+
+
+def test_removed_session_writes_its_last_snapshot(tmp_path):
+    path = str(tmp_path / 'session.snapshot')
+    manager = SessionManager(osc_ip=None)
+    manager.start()
+    try:
+        session = manager.add_session('room', None, _MemoryOutputPort(), _MemoryOutputPort(), _MemoryOutputPort(),
+                                      bpm=600, seed=0, snapshot_path=path, snapshot_measures=1)
+        muses = session.muses
+        for i in range(16):
+            muses.push_input(NOTE_ON, 60 + i % 7, 90, time.time())
+            muses.push_input(NOTE_OFF, 60 + i % 7, 0, time.time() + 0.05)
+
+        deadline = time.time() + 10
+        while session.measures < 8 and time.time() < deadline:
+            time.sleep(0.05)
+        manager.remove_session('room')
+
+        # the worker writes the snapshot of the last processed measure on the final tick of the session
+        deadline = time.time() + 5
+        while time.time() < deadline:
+            if os.path.exists(path) and read_snapshot(path)['position']['measure_count'] == muses.measureCount:
+                break
+            time.sleep(0.05)
+        assert read_snapshot(path)['position']['measure_count'] == muses.measureCount
+        assert muses.snapshotWriter.get_stats()['written_snapshots'] > 0
+    finally:
+        manager.stop()
+
+
+def test_stopped_manager_closes_the_output_ports():
+    manager = SessionManager(osc_ip=None)
+    manager.start()
+    ports = [_MemoryOutputPort() for _ in range(6)]
+    manager.add_session('room 1', None, *ports[:3], bpm=120, seed=0)
+    manager.add_session('room 2', None, *ports[3:], bpm=120, seed=1)
+
+    # the sessions are removed before the downbeats closing their ports
+    manager.stop()
+    assert all(port.closed for port in ports)
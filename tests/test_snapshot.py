@@ -0,0 +1,128 @@
+import numpy as np
+import pytest
+from muses_echoes.muses import MuseEchoes
+from muses_echoes.render import note_list_records
+from muses_echoes.sequencer import MidiFileSequencer
+from muses_echoes.snapshot import SnapshotWriter, read_snapshot, write_snapshot
+
+"""
+Tests of the snapshots of the learned state of a session.
+"""
+
+
+def _new_muses(**kwargs):
+    """
+    Utility function that creates a MuseEchoes object playing into a midi file.
+
+    :param kwargs: additional parameters of the MuseEchoes constructor
+    :return: MuseEchoes object
+    """
+    return MuseEchoes(None, None, None, None, osc_ip=None, bpm=120, sequencer=MidiFileSequencer(bpm=120), **kwargs)
+
+
+def _trained_snapshot(path, measures=10):
+    """
+    Utility function that renders some measures and writes the snapshot of the session.
+
+    :param path: path of the snapshot
+    :param measures: number of rendered measures
+    :return: MuseEchoes object of the rendered session
+    """
+    rng = np.random.default_rng(0)
+    notes = [(i * 0.25, int(rng.integers(55, 80)), 0.2) for i in range(measures * 8)]
+    muses = _new_muses(seed=0)
+    muses.render(note_list_records(notes), measures)
+    muses.scheduler.stop()
+    write_snapshot(path, muses.get_snapshot())
+    return muses
+
+
+def test_snapshot_restores_the_session(tmp_path):
+    path = str(tmp_path / 'session.snapshot')
+    muses = _trained_snapshot(path)
+    restored = _new_muses(seed=1, snapshot_path=path)
+    try:
+        assert restored.notesMarkovChain.get_state()['symbols'] == muses.notesMarkovChain.get_state()['symbols']
+        assert restored.rhythmMarkovChain.context_count == muses.rhythmMarkovChain.context_count
+        assert restored.harmonicState.currentMode == muses.harmonicState.currentMode
+        assert restored.chordSequence == muses.chordSequence
+        assert restored.currentScale == muses.currentScale
+        assert restored.measureCount == muses.measureCount
+        assert restored.generationInitialized
+    finally:
+        restored.snapshotWriter.close()
+        restored.scheduler.stop()
+
+
+def test_incompatible_harmonic_state_restores_only_the_chains(tmp_path):
+    path = str(tmp_path / 'session.snapshot')
+    muses = _trained_snapshot(path)
+    restored = _new_muses(seed=1, snapshot_path=path, harmonic_decay=0.5)
+    try:
+        assert restored.rhythmMarkovChain.context_count == muses.rhythmMarkovChain.context_count
+        # the scale and the chords are not restored without the harmonic state they follow
+        assert restored.chordSequence == []
+        assert restored.currentScale == []
+        assert restored.measureCount == 0
+        assert not restored.generationInitialized
+    finally:
+        restored.snapshotWriter.close()
+        restored.scheduler.stop()
+
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / 'state.snapshot')
+    state = {'time': 1.5, 'nested': {'name': 'room', 'weights': np.arange(7, dtype=np.float32)},
+             'codes': np.arange(12, dtype=np.int64).reshape(3, 4)}
+    write_snapshot(path, state)
+    restored = read_snapshot(path)
+    assert restored['time'] == 1.5 and restored['nested']['name'] == 'room'
+    np.testing.assert_array_equal(restored['nested']['weights'], state['nested']['weights'])
+    np.testing.assert_array_equal(restored['codes'], state['codes'])
+    assert restored['codes'].dtype == np.int64
+
+    # a truncated or foreign file is refused
+    with open(path, 'rb') as f:
+        data = f.read()
+    with open(path, 'wb') as f:
+        f.write(data[:-8])
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+    with open(path, 'wb') as f:
+        f.write(b'not a snapshot')
+    with pytest.raises(ValueError):
+        read_snapshot(path)
+
+
+def test_writer_builds_and_writes_the_last_snapshot(tmp_path):
+    path = str(tmp_path / 'state.snapshot')
+    writer = SnapshotWriter(path)
+    for i in range(5):
+        writer.submit({'index': i})
+    # a snapshot can be built by the thread of the writer, or be skipped if its function returns None
+    writer.submit(lambda: {'index': 5})
+    writer.close()
+    assert read_snapshot(path) == {'index': 5}
+    stats = writer.get_stats()
+    assert stats['written_snapshots'] + stats['skipped_snapshots'] == 6
+    assert stats['written_snapshots'] >= 1
+
+    writer = SnapshotWriter(path)
+    writer.submit(lambda: None)
+    writer.close()
+    assert writer.get_stats() == {'written_snapshots': 0, 'skipped_snapshots': 1, 'last_write_time': None}
+    assert read_snapshot(path) == {'index': 5}
+
+
+def test_session_writes_its_snapshots_while_playing(tmp_path):
+    path = str(tmp_path / 'session.snapshot')
+    rng = np.random.default_rng(0)
+    notes = [(i * 0.25, int(rng.integers(55, 80)), 0.2) for i in range(80)]
+    muses = _new_muses(seed=0, snapshot_path=path, snapshot_measures=2)
+    muses.render(note_list_records(notes), 10)
+    muses.snapshotWriter.close()
+    muses.scheduler.stop()
+    assert muses.snapshotWriter.get_stats()['written_snapshots'] >= 1
+    state = read_snapshot(path)
+    assert state['notes']['symbols'] == muses.notesMarkovChain.get_state()['symbols']
+    assert state['position']['measure_count'] == muses.measureCount
@@ -0,0 +1,78 @@
+import math
+from muses_echoes.tempo import TempoMap
+
+"""
+Tests of the TempoMap.
+"""
+
+
+def test_tempo_change_lands_on_its_beat():
+    tempo_map = TempoMap(120, origin=10.0)
+    assert tempo_map.set_bpm(60, beat=8) == 8
+    assert tempo_map.time_at(8) == 14.0
+    assert tempo_map.time_at(10) == 16.0
+    assert tempo_map.bpm_at(7.9) == 120 and tempo_map.bpm_at(8) == 60
+    assert tempo_map.beat_at(16.0) == 10
+    assert tempo_map.durations_at(10)['4'] == 1.0
+
+    # a later change replaces the segments following its beat
+    tempo_map.set_bpm(240, beat=4)
+    assert tempo_map.bpm_at(8) == 240
+    assert tempo_map.time_at(8) == 13.0
+
+
+def test_ramps_integrate_the_tempo():
+    for curve in ('linear', 'exponential'):
+        tempo_map = TempoMap(60)
+        tempo_map.ramp(120, 8, beat=4, curve=curve)
+        assert math.isclose(tempo_map.bpm_at(12), 120) and tempo_map.bpm_at(20) == 120
+        assert 60 < tempo_map.bpm_at(8) < 120
+
+        # the time of a beat is the integral of 60 / bpm, the beat of a time is its inverse
+        steps = 10000
+        integral = sum(60 / tempo_map.bpm_at(4 + (i + 0.5) * 8 / steps) * 8 / steps for i in range(steps))
+        assert math.isclose(tempo_map.time_at(12) - tempo_map.time_at(4), integral, rel_tol=1e-6)
+        for beat in (2.5, 6, 11.75, 30):
+            assert math.isclose(tempo_map.beat_at(tempo_map.time_at(beat)), beat)
+
+
+def test_next_measure_and_listeners():
+    tempo_map = TempoMap(120)
+    changes = []
+    tempo_map.listeners.append(changes.append)
+    assert tempo_map.next_measure(0.0) == 4
+    assert tempo_map.next_measure(1.9) == 4
+    assert tempo_map.next_measure(2.0) == 8
+
+    tempo_map.ramp(90, 4, beat=8)
+    assert changes == [[[8, 4.0, 120, 'linear', -7.5], [12, changes[0][1][1], 90, 'constant', 0.0]]]
+
+    # the recorded changes are reproduced on another map
+    other = TempoMap(120)
+    other.replace_segments(changes[0])
+    for beat in (0, 9, 12, 20):
+        assert other.time_at(beat) == tempo_map.time_at(beat)
+
+
+def test_dropped_segments_keep_the_first_tempo():
+    tempo_map = TempoMap(120)
+    for i in range(1000):
+        tempo_map.ramp(60 if i % 2 else 180, 4, beat=8 * i)
+    # every ramp adds two segments, the oldest ones are dropped
+    segments = tempo_map.get_segments()
+    assert len(segments) < 1000
+
+    # the beats before the first kept segment are at its tempo, also before an accelerating ramp
+    first_beat = segments[0][0]
+    for beat in (first_beat - 10000, first_beat - 1):
+        assert tempo_map.bpm_at(beat) == segments[0][2]
+        assert math.isclose(tempo_map.beat_at(tempo_map.time_at(beat)), beat)
+
+
+def test_beats_before_a_ramp_keep_its_start_tempo():
+    tempo_map = TempoMap(60)
+    tempo_map.ramp(180, 8, beat=0)
+    assert tempo_map.bpm_at(-1000) == 60
+    assert math.isclose(tempo_map.time_at(-1000), -1000)
+    assert math.isclose(tempo_map.beat_at(-1000), -1000)
+    assert tempo_map.bpm_at(4) == 120